@@ -1,35 +1,56 @@
-from django.apps import AppConfig
+from django.apps import AppConfig, apps
+from django.core.exceptions import ImproperlyConfigured
 from django.db.models.signals import post_migrate
 
+
 def register_app_activity():
     """
     Create watchers for models defined in settings.py.
+    Each model's settings are validated and normalized into the registry once, here,
+    so the signal handlers never have to walk the settings themselves.
     Once created, they will be passed over
     Activity.objects.follow_model(), which lives in managers.py
+
+    Models are looked up in the app registry, so this runs no queries and works
+    before the database (or its migrations) exist. Content types are only
+    looked up when a model first needs one.
     """
     from django.conf import settings
-    from django.contrib.contenttypes.models import ContentType
 
+    from . import registry
     from .models import Activity
 
-    # TO-DO: Add check for existence of setting
-    if not hasattr(settings, 'ACTIVITY_MONITOR_MODELS'):
-        return
+    for item in get_model_settings(settings):
+        model = apps.get_model(item['model'])
+        registry.register(model, item)
+        Activity.objects.follow_model(model)
+    Activity.objects.follow_actors()
 
-    for item in settings.ACTIVITY_MONITOR_MODELS:
-        try:
-            app_label, model = item['model'].split('.', 1)
-            content_type = ContentType.objects.get(app_label=app_label, model=model)
-            model = content_type.model_class()
-            Activity.objects.follow_model(model)
 
-        except ContentType.DoesNotExist:
-            pass
+def get_model_settings(settings):
+    """
+    Returns the ACTIVITY_MONITOR_MODELS entries, checking each one names an installed model.
+    """
+    items = getattr(settings, 'ACTIVITY_MONITOR_MODELS', ())
+    if not isinstance(items, (list, tuple)):
+        raise ImproperlyConfigured("ACTIVITY_MONITOR_MODELS must be a list or tuple.")
+    for item in items:
+        if not isinstance(item, dict) or 'model' not in item:
+            raise ImproperlyConfigured("ACTIVITY_MONITOR_MODELS: {!r} has no 'model'.".format(item))
+        try:
+            apps.get_model(item['model'])
+        except (LookupError, ValueError):
+            raise ImproperlyConfigured(
+                "ACTIVITY_MONITOR_MODELS: '{}' isn't an installed model.".format(item['model'])
+            )
+    return items
 
 
 class ActivityMonitorConfig(AppConfig):
     name = 'activity_monitor'
     verbose_name = "Activity Monitor"
 
-    def setup(self):
+    def ready(self):
+        from . import registry
         register_app_activity()
+        post_migrate.connect(registry.clear_content_types, sender=self)
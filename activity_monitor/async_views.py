@@ -0,0 +1,44 @@
+"""
+Async versions of the archive, period and today views, for projects served over ASGI.
+
+Each request runs the view, queries and rendering together, in a single trip
+to a worker thread, and that thread isn't shared: concurrent requests run side
+by side instead of queueing for the one thread that sync views are confined to
+under ASGI. The database connection a request opens is closed again before its
+thread is given back. Needs asgiref (the "async" extra), which is only
+imported once a request comes in, so this module imports without it.
+"""
+from django.db import close_old_connections
+
+from .views import ActionList, ActionsForPeriod, ActionsForToday
+
+
+def as_async_view(view_class, **initkwargs):
+    """
+    Returns a coroutine view function for a class-based view.
+    """
+    view = view_class.as_view(**initkwargs)
+
+    def run(request, *args, **kwargs):
+        close_old_connections()
+        try:
+            response = view(request, *args, **kwargs)
+            if hasattr(response, 'render') and callable(response.render):
+                response.render()
+            return response
+        finally:
+            close_old_connections()
+
+    async def async_view(request, *args, **kwargs):
+        from asgiref.sync import sync_to_async
+        return await sync_to_async(run, thread_sensitive=False)(request, *args, **kwargs)
+    async_view.view_class = view_class
+    async_view.view_initkwargs = initkwargs
+    async_view.__name__ = view.__name__
+    async_view.__doc__ = view_class.__doc__
+    return async_view
+
+
+action_list = as_async_view(ActionList)
+actions_for_period = as_async_view(ActionsForPeriod)
+actions_for_today = as_async_view(ActionsForToday)
@@ -0,0 +1,131 @@
+"""
+Backfills activities for content that existed before its model was watched.
+
+Rather than re-saving every object (which fires every post_save receiver,
+bumps auto_now fields and holds whole tables in memory), each watched model
+is split into primary key ranges. Each range is streamed with
+iterator(chunk_size), turned into activities straight from the model's config,
+and written with bulk_create(ignore_conflicts=True), so existing activities
+are left alone and the backfill can be safely re-run or resumed.
+"""
+import datetime
+
+from django.db import connections, transaction
+from django.db.models import Max, Min
+
+from activity_monitor import caching, partitions, registry, rollups, routing
+from activity_monitor.models import Activity, ActivityRollup, ArchivedActivity
+
+
+def get_queryset(config, since=None):
+    """
+    Returns the queryset to backfill for a model,
+    limited to objects dated on or after since when the model has a date field.
+    """
+    qs = config.get_queryset()
+    if since and config.date_field:
+        qs = qs.filter(**{'{}__gte'.format(config.date_field): since})
+    return qs
+
+
+def get_ranges(config, since=None, range_size=50000):
+    """
+    Splits a model's primary keys into (low, high] ranges of at most range_size.
+    """
+    bounds = get_queryset(config, since).aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['low'] is None:
+        return []
+    return [
+        (low, min(low + range_size, bounds['high']))
+        for low in range(bounds['low'] - 1, bounds['high'], range_size)
+    ]
+
+
+def backfill_range(label, low, high, since=None, chunk_size=2000):
+    """
+    Builds and writes activities for one primary key range of a watched model.
+    Returns (label, low, high, scanned, written) so callers can checkpoint the range.
+    """
+    config = registry.get_config_for_label(label)
+    now = datetime.datetime.now()
+    qs = get_queryset(config, since).filter(pk__gt=low, pk__lte=high).order_by('pk')
+
+    scanned = written = 0
+    batch = []
+    for instance in qs.iterator(chunk_size=chunk_size):
+        scanned += 1
+        if not config.passes_check(instance):
+            continue
+        values = config.get_activity_values(instance, now, max_age=None)
+        if values is None:
+            continue
+        batch.append(Activity(content_type=config.content_type, object_id=instance.pk, **values))
+        if len(batch) >= chunk_size:
+            write_batch(config, batch)
+            written += len(batch)
+            batch = []
+    if batch:
+        write_batch(config, batch)
+        written += len(batch)
+    return label, low, high, scanned, written
+
+
+def write_batch(config, batch):
+    """
+    Inserts a batch of activities for one model, leaving any that already exist alone,
+    and adds the new ones to the rollups. Objects whose activity has been archived keep it.
+    """
+    caching.invalidate()
+    if partitions.enabled():
+        object_ids = [activity.object_id for activity in batch]
+        archived = set(ArchivedActivity.objects.filter(
+            content_type=config.content_type, object_id__gte=min(object_ids), object_id__lte=max(object_ids)
+        ).values_list('object_id', flat=True))
+        batch = [activity for activity in batch if activity.object_id not in archived]
+        if not batch:
+            return
+    if not rollups.enabled():
+        Activity.objects.bulk_create(batch, ignore_conflicts=True)
+        return
+    object_ids = [activity.object_id for activity in batch]
+    with transaction.atomic(using=routing.db_for_write(Activity)):
+        # The batch is in primary key order, so a range finds the existing ones.
+        existing = set(Activity.objects.order_by().filter(
+            content_type=config.content_type, object_id__gte=min(object_ids), object_id__lte=max(object_ids)
+        ).values_list('object_id', flat=True))
+        Activity.objects.bulk_create(batch, ignore_conflicts=True)
+        ActivityRollup.objects.apply(
+            (activity.content_type_id, activity.verb, activity.timestamp, 1)
+            for activity in batch if activity.object_id not in existing
+        )
+
+
+def _backfill_range_star(args):
+    return backfill_range(*args)
+
+
+def _close_connections():
+    # Forked workers must not share the parent's database connections.
+    connections.close_all()
+
+
+def run(tasks, workers=1):
+    """
+    Runs (label, low, high, since, chunk_size) tasks, yielding each result as it completes.
+    With more than one worker, tasks are spread over a process pool.
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield backfill_range(*task)
+        return
+
+    import multiprocessing
+
+    _close_connections()
+    pool = multiprocessing.get_context('fork').Pool(workers, initializer=_close_connections)
+    try:
+        for result in pool.imap_unordered(_backfill_range_star, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,190 @@
+"""
+Cached results for the activity template tags.
+
+Every cache key carries the current "activity generation", a counter kept in
+the cache itself. Writing or deleting activities bumps the generation once the
+transaction commits, which orphans every cached result at once, so tag output
+is reused for as long as nothing has changed and no longer than its timeout.
+
+The cache alias is set with ACTIVITY_MONITOR_CACHE (default "default") and
+the timeout with ACTIVITY_MONITOR_CACHE_TIMEOUT (default 300 seconds).
+A timeout of 0 turns caching off.
+
+Fragments rendered from a single activity are cached separately, keyed on the
+activity's own stored values, and only when ACTIVITY_MONITOR_FRAGMENT_TIMEOUT
+(or the timeout passed in) is set.
+"""
+import functools
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from activity_monitor import routing
+from activity_monitor.signals import activity_changed
+
+GENERATION_KEY = 'activity_monitor:generation'
+DEFAULT_TIMEOUT = 300
+
+# The generation bump waiting on each connection's transaction, per thread.
+_pending = threading.local()
+
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+_missing = object()
+
+
+def get_cache():
+    return caches[getattr(settings, 'ACTIVITY_MONITOR_CACHE', 'default')]
+
+
+def is_shared():
+    """
+    True unless the cache is local to each process, or a dummy. A generation bumped
+    in one process is only seen by the others through a cache they all share.
+    """
+    from django.core.cache.backends.dummy import DummyCache
+    from django.core.cache.backends.locmem import LocMemCache
+    return not isinstance(get_cache(), (DummyCache, LocMemCache))
+
+
+def get_timeout(timeout=None):
+    if timeout is None:
+        return getattr(settings, 'ACTIVITY_MONITOR_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+    return timeout
+
+
+def get_generation():
+    """
+    Returns the current activity generation, starting one if the cache has none.
+    """
+    cache = get_cache()
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # Start from the clock rather than 1, so an evicted generation
+        # can't bring back results cached under an earlier one.
+        cache.add(GENERATION_KEY, int(time.time() * 1000), None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_generation():
+    """
+    Moves on to a new activity generation, invalidating every cached tag result,
+    and sends activity_changed to anything in this process waiting on new activity.
+    """
+    cache = get_cache()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, int(time.time() * 1000), None)
+    activity_changed.send(sender=None)
+
+
+def invalidate(using=None):
+    """
+    Bumps the generation once the current transaction on using commits,
+    so nothing can cache what other connections can't see yet.
+    A transaction only bumps it once, however many activities it touched.
+    Called whenever activities are written, so it also sticks this thread's
+    reads to using (see activity_monitor.routing).
+    """
+    if using is None:
+        from activity_monitor.models import Activity
+        using = routing.db_for_write(Activity)
+    # Whatever was just written, this thread should read it back from where it went.
+    routing.pin(using)
+    bump = getattr(_pending, using, None)
+    if bump is None:
+        bump = {'done': False}
+        setattr(_pending, using, bump)
+    # Each write registers a bump, since any of them may be rolled back on its own,
+    # but a transaction's writes share one, and only the first to run bumps.
+    transaction.on_commit(functools.partial(_bump_once, using, bump), using=using)
+
+
+def _bump_once(using, bump):
+    if getattr(_pending, using, None) is bump:
+        delattr(_pending, using)
+    if not bump['done']:
+        bump['done'] = True
+        bump_generation()
+
+
+def make_key(name, *parts):
+    """
+    Returns the cache key for a tag called with the given arguments, in the current generation.
+    """
+    digest = hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+    return 'activity_monitor:{}:{}:{}'.format(name, get_generation(), digest)
+
+
+def make_fragment_key(activity, *parts):
+    """
+    Returns the cache key for something rendered from a single activity.
+    Rather than the generation, the key carries a marker of the activity's stored
+    values, which change whenever an upsert or refresh rewrites it.
+    """
+    marker = (
+        activity.timestamp, activity.verb, activity.override_string, activity.target,
+        activity.actor_name, activity.absolute_url, activity.image_url,
+    )
+    digest = hashlib.md5(repr((marker,) + parts).encode('utf-8')).hexdigest()
+    return 'activity_monitor:fragment:{}:{}'.format(activity.pk, digest)
+
+
+def get_or_set(name, parts, func, timeout=None):
+    """
+    Returns the cached result of func for a tag and its arguments,
+    calling func and caching what it returns on a miss.
+    """
+    timeout = get_timeout(timeout)
+    if not timeout:
+        return func()
+    return _get_or_set(make_key(name, *parts), func, timeout)
+
+
+def get_or_set_fragment(activity, parts, func, timeout=None):
+    """
+    Like get_or_set(), for output rendered from one activity. Fragments aren't
+    cached unless there's a timeout, from the call or ACTIVITY_MONITOR_FRAGMENT_TIMEOUT.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'ACTIVITY_MONITOR_FRAGMENT_TIMEOUT', 0)
+    if not timeout or activity.pk is None:
+        return func()
+    return _get_or_set(make_fragment_key(activity, *parts), func, timeout)
+
+
+def _get_or_set(key, func, timeout):
+    cache = get_cache()
+    value = cache.get(key, _missing)
+    if value is not _missing:
+        _count('hits')
+        return value
+    _count('misses')
+    value = func()
+    cache.set(key, value, timeout)
+    return value
+
+
+def _count(stat):
+    with _stats_lock:
+        _stats[stat] += 1
+
+
+def get_stats():
+    """
+    Returns the hits and misses of this process since it started, or since reset_stats().
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        for stat in _stats:
+            _stats[stat] = 0
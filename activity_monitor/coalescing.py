@@ -0,0 +1,170 @@
+"""
+Skips re-saves of watched objects that can't change their activity.
+
+Models such as profiles, or topics with a view counter, are saved far more often
+than anything on their activity changes. With ACTIVITY_MONITOR_COALESCE set,
+each save is first reduced to a fingerprint of what its activity is built from:
+the date field, the check field, the user field's id and the str() of the
+object. If that matches the fingerprint from the last save that reached the
+database, the save is skipped before a single query.
+
+Fingerprints are kept either in a bounded in-process LRU ('local') or in the
+cache ('cache'). An LRU only knows about the saves its own process made, so
+'local' is only safe when a single process writes the watched models; with
+several writers, one could skip a save that undoes another's change. 'cache'
+compares against the fingerprint the last writer, in any process, applied.
+Deleting or editing activities directly moves on to a new epoch, kept in the
+cache, which retires every fingerprint at once.
+
+Things a fingerprint doesn't cover, such as a renamed actor, are picked up by
+the next save that does change one of the tracked fields, or by refresh_activity.
+Models watched through a custom manager aren't coalesced, since whether they
+belong in it can depend on any field.
+"""
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+
+from activity_monitor import caching
+from activity_monitor.utils import MAX_LENGTH
+
+EPOCH_KEY = 'activity_monitor:coalesce_epoch'
+DEFAULT_SIZE = 10000
+# How long a fingerprint is kept in the cache, in seconds.
+CACHE_TIMEOUT = 60 * 60 * 24
+
+_fingerprints = OrderedDict()
+_lock = threading.Lock()
+_stats = {'skipped': 0, 'applied': 0}
+
+
+def get_mode():
+    """
+    Returns ACTIVITY_MONITOR_COALESCE: None (off), 'local' or 'cache'.
+    """
+    return getattr(settings, 'ACTIVITY_MONITOR_COALESCE', None)
+
+
+def get_size():
+    return getattr(settings, 'ACTIVITY_MONITOR_COALESCE_SIZE', DEFAULT_SIZE)
+
+
+def applies_to(config):
+    return bool(get_mode()) and config.uses_default_manager
+
+
+def get_fingerprint(config, instance):
+    """
+    Returns a compact digest of the fields the instance's activity is built from.
+    """
+    parts = (
+        getattr(instance, config.date_field) if config.date_field else None,
+        getattr(instance, config.check) if config.check else None,
+        config.get_user_key(instance),
+        str(instance)[:MAX_LENGTH],
+    )
+    return hashlib.md5(repr(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def get_epoch():
+    cache = caching.get_cache()
+    epoch = cache.get(EPOCH_KEY)
+    if epoch is None:
+        cache.add(EPOCH_KEY, 0, None)
+        epoch = cache.get(EPOCH_KEY, 0)
+    return epoch
+
+
+def make_key(config, pk):
+    return 'activity_monitor:coalesce:{}:{}'.format(config.label, pk)
+
+
+def is_unchanged(config, pk, fingerprint):
+    """
+    True, and counted as skipped, if the last fingerprint applied for the object
+    matches. Otherwise the save is counted as applied.
+    """
+    entry = (get_epoch(), fingerprint)
+    key = make_key(config, pk)
+    if get_mode() == 'cache':
+        # Other processes write too, so only the shared entry says what was last applied.
+        unchanged = caching.get_cache().get(key) == entry
+    else:
+        with _lock:
+            unchanged = _fingerprints.get(key) == entry
+            if unchanged:
+                _fingerprints.move_to_end(key)
+    _count('skipped' if unchanged else 'applied')
+    return unchanged
+
+
+def remember(config, pk, fingerprint, using=None):
+    """
+    Records the fingerprint once the transaction writing the activity commits.
+    """
+    entry = (get_epoch(), fingerprint)
+    key = make_key(config, pk)
+
+    def store():
+        if get_mode() == 'cache':
+            caching.get_cache().set(key, entry, CACHE_TIMEOUT)
+        else:
+            _store(key, entry)
+    transaction.on_commit(store, using=using)
+
+
+def forget_all(using=None):
+    """
+    Retires every fingerprint, in every process, once the current transaction commits.
+    Called whenever activities are deleted or edited outside of the save path.
+    """
+    if get_mode():
+        transaction.on_commit(_bump_epoch, using=using)
+
+
+def _bump_epoch():
+    cache = caching.get_cache()
+    try:
+        cache.incr(EPOCH_KEY)
+    except ValueError:
+        cache.set(EPOCH_KEY, 1, None)
+    clear()
+
+
+def clear():
+    """
+    Empties this process's fingerprints.
+    """
+    with _lock:
+        _fingerprints.clear()
+
+
+def _store(key, entry):
+    with _lock:
+        _fingerprints[key] = entry
+        _fingerprints.move_to_end(key)
+        while len(_fingerprints) > get_size():
+            _fingerprints.popitem(last=False)
+
+
+def _count(stat):
+    with _lock:
+        _stats[stat] += 1
+
+
+def get_stats():
+    """
+    Returns the saves skipped and applied in this process since it started, or since reset_stats().
+    """
+    with _lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _lock:
+        for stat in _stats:
+            _stats[stat] = 0
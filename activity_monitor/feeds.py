@@ -0,0 +1,177 @@
+"""
+Machine-readable activity feeds, for other services to pull the stream from.
+
+Activities are exported in the order they were written, by id, a chunk at a
+time, each chunk picking up after the id of the last row of the one before.
+Timestamps aren't used for this: they come from the content, so an activity
+written later (by a backfill, say) can carry an older one, and would be
+missed by anything resuming from a timestamp. They're only shown.
+
+Only plain .values() rows are held, a chunk at a time, and the response is
+streamed, so memory use doesn't grow with the size of the export. Every row
+carries a cursor; pass the last one back as ?since= to pick up where a
+previous pull stopped. An activity is exported once, when it is first
+written; later changes to it aren't sent again.
+"""
+import json
+
+from collections import OrderedDict
+from xml.sax.saxutils import escape, quoteattr
+
+from django.contrib.contenttypes.models import ContentType
+from django.http import Http404, HttpResponseBadRequest, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.feedgenerator import get_tag_uri, rfc3339_date
+from django.views.generic import View
+
+from .models import Activity
+from .pagination import InvalidCursor, decode_stream_cursor, make_stream_cursor
+from .utils import get_actor_id
+
+FEED_FIELDS = (
+    'id', 'timestamp', 'actor_id', 'actor_name', 'verb', 'override_string',
+    'target', 'absolute_url', 'image_url', 'content_type_id', 'object_id',
+)
+
+
+class ActivityFeed(View):
+    """
+    Streams activities as NDJSON, JSON or Atom.
+
+    Takes these query parameters:
+    * since: a cursor from an earlier pull; only activities written after it are returned.
+    * actor: a username.
+    * include / exclude: comma-separated content type (model) names, as for show_new_activity.
+    * limit: the most activities to return.
+    """
+    chunk_size = 1000
+    content_types = {
+        'ndjson': 'application/x-ndjson',
+        'json': 'application/json',
+        'atom': 'application/atom+xml; charset=utf-8',
+    }
+
+    def get(self, request, format='ndjson'):
+        if format not in self.content_types:
+            raise Http404("No such feed format.")
+        try:
+            queryset = self.get_queryset()
+            limit = int(request.GET['limit']) if 'limit' in request.GET else None
+        except (InvalidCursor, ValueError):
+            return HttpResponseBadRequest("Invalid since or limit.")
+        # Worked out once, rather than validating the host for every row.
+        self.site_url = request.build_absolute_uri('/')[:-1]
+        rows = self.iter_rows(queryset, limit)
+        render = getattr(self, 'render_{}'.format(format))
+        return StreamingHttpResponse(render(rows), content_type=self.content_types[format])
+
+    def get_queryset(self):
+        params = self.request.GET
+        qs = Activity.objects.order_by()
+        if params.get('since'):
+            qs = qs.filter(pk__gt=decode_stream_cursor(params['since']))
+        if params.get('actor'):
+            actor_id = get_actor_id(params['actor'])
+            if actor_id is None:
+                return qs.none()
+            qs = qs.filter(actor_id=actor_id)
+        # Content types are resolved up front, so the export itself needs no join.
+        if params.get('include'):
+            qs = qs.filter(content_type_id__in=self.get_content_type_ids(params['include']))
+        if params.get('exclude'):
+            qs = qs.exclude(content_type_id__in=self.get_content_type_ids(params['exclude']))
+        return qs
+
+    def get_content_type_ids(self, names):
+        return list(ContentType.objects.filter(model__in=names.split(',')).values_list('pk', flat=True))
+
+    def iter_rows(self, queryset, limit=None):
+        """
+        Yields .values() rows in the order they were written, fetching chunk_size at a time by id.
+        """
+        remaining = limit
+        last = None
+        while remaining is None or remaining > 0:
+            qs = queryset
+            if last is not None:
+                qs = qs.filter(pk__gt=last['id'])
+            size = self.chunk_size if remaining is None else min(self.chunk_size, remaining)
+            chunk = list(qs.order_by('pk').values(*FEED_FIELDS)[:size])
+            for row in chunk:
+                yield row
+            if len(chunk) < size:
+                return
+            last = chunk[-1]
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    def get_url(self, url):
+        if url and url.startswith('/') and not url.startswith('//'):
+            return self.site_url + url
+        return url or None
+
+    def serialize(self, row):
+        content_type = ContentType.objects.get_for_id(row['content_type_id'])
+        return OrderedDict([
+            ('id', row['id']),
+            ('timestamp', row['timestamp'].isoformat()),
+            ('actor', row['actor_id']),
+            ('actor_name', row['actor_name']),
+            ('verb', row['verb']),
+            ('override_string', row['override_string']),
+            ('target', row['target']),
+            ('url', self.get_url(row['absolute_url'])),
+            ('image_url', row['image_url']),
+            ('content_type', '{}.{}'.format(content_type.app_label, content_type.model)),
+            ('object_id', row['object_id']),
+            ('cursor', make_stream_cursor(row['id'])),
+        ])
+
+    def render_ndjson(self, rows):
+        for row in rows:
+            yield json.dumps(self.serialize(row)) + '\n'
+
+    def render_json(self, rows):
+        """
+        A single {"activities": [...], "next": cursor} object, where next is the
+        cursor to pass as since for the next pull.
+        """
+        yield '{"activities": ['
+        cursor = self.request.GET.get('since') or None
+        for i, row in enumerate(rows):
+            item = self.serialize(row)
+            yield (',\n' if i else '\n') + json.dumps(item)
+            cursor = item['cursor']
+        yield '\n], "next": {}}}\n'.format(json.dumps(cursor))
+
+    def render_atom(self, rows):
+        feed_url = self.request.build_absolute_uri()
+        yield (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<feed xmlns="http://www.w3.org/2005/Atom">'
+            '<title>Activity</title>'
+            '<id>{url}</id>'
+            '<link href={href} rel="self"/>'
+            '<updated>{updated}</updated>\n'
+        ).format(url=escape(feed_url), href=quoteattr(feed_url), updated=rfc3339_date(timezone.now()))
+        for row in rows:
+            link = self.get_url(row['absolute_url']) or feed_url
+            action = row['override_string'] or row['verb'] or ''
+            title = ' '.join(part.strip() for part in (row['actor_name'] or '', action, row['target'] or '') if part)
+            yield (
+                '<entry>'
+                '<title>{title}</title>'
+                '<id>{id}</id>'
+                '<link href={link}/>'
+                '<updated>{updated}</updated>'
+                '<author><name>{author}</name></author>'
+                '</entry>\n'
+            ).format(
+                title=escape(title),
+                id=escape('{}/activity/{}'.format(get_tag_uri(link, row['timestamp']), row['id'])),
+                link=quoteattr(link),
+                updated=rfc3339_date(row['timestamp']),
+                author=escape(row['actor_name'] or ''),
+            )
+        yield '</feed>\n'
+activity_feed = ActivityFeed.as_view()
@@ -0,0 +1,248 @@
+"""
+Pushes new activities to clients as they are written, over Server-Sent Events
+or long polling.
+
+Subscribers don't poll the database themselves. Every process keeps one
+ActivityBuffer of the newest activities. After a write in this process
+commits, activity_changed wakes every waiting subscriber, and the first one to
+look refreshes the buffer with a single primary key range query; the rest read
+the same rows from memory. Writes made by other processes are picked up by the
+same query once the buffer is fallback_interval seconds old, so an idle
+process costs one cheap query every few seconds, however many clients it holds.
+
+New activities are found by id rather than timestamp: an activity's timestamp
+comes from its content, which can be older than activities already written.
+Cursors are the same tokens as the feeds use.
+
+Each subscriber holds a thread while it waits, so serve these views from
+threaded or green-threaded workers.
+"""
+import collections
+import json
+import threading
+import time
+
+from django.db import connections
+from django.dispatch import receiver
+from django.http import HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+
+from . import routing
+from .feeds import FEED_FIELDS, ActivityFeed
+from .models import Activity
+from .pagination import InvalidCursor, decode_stream_cursor, make_stream_cursor
+from .signals import activity_changed
+from .utils import get_actor_id
+
+BUFFER_SIZE = 500
+
+_changed = threading.Condition()
+_changes = 0
+
+
+@receiver(activity_changed)
+def notify(**kwargs):
+    """
+    Wakes every subscriber in this process.
+    """
+    global _changes
+    with _changed:
+        _changes += 1
+        _changed.notify_all()
+
+
+def get_changes():
+    with _changed:
+        return _changes
+
+
+def wait_for_change(seen, timeout):
+    """
+    Waits up to timeout seconds for a change after the seen count of changes,
+    returning the count when it wakes.
+    """
+    with _changed:
+        _changed.wait_for(lambda: _changes != seen, timeout)
+        return _changes
+
+
+class ActivityBuffer(object):
+    """
+    The newest activities, as feed rows in id order, shared by every subscriber in the process.
+    """
+    def __init__(self, size=BUFFER_SIZE):
+        self.rows = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.refreshed_at = None
+        self.refreshed_changes = None
+        self.start_pk = None
+
+    def refresh(self, max_age):
+        """
+        Fetches anything newer than the buffer holds, if there has been a change
+        in this process since the last look, or the last look was more than max_age seconds ago.
+        """
+        with self.lock:
+            changes = get_changes()
+            if (self.refreshed_at is not None and changes == self.refreshed_changes and
+                    time.time() - self.refreshed_at < max_age):
+                return
+            qs = Activity.objects.order_by().values(*FEED_FIELDS)
+            catching_up = self.start_pk is not None
+            if catching_up:
+                last_pk = self.rows[-1]['id'] if self.rows else self.start_pk
+                rows = list(qs.filter(pk__gt=last_pk).order_by('pk')[:self.rows.maxlen])
+            else:
+                rows = list(qs.order_by('-pk')[:self.rows.maxlen])[::-1]
+            if not self.rows:
+                self.start_pk = rows[0]['id'] - 1 if rows else (self.start_pk or 0)
+            self.rows.extend(rows)
+            if len(self.rows) == self.rows.maxlen:
+                self.start_pk = self.rows[0]['id'] - 1
+            if catching_up and len(rows) == self.rows.maxlen:
+                # There may be more still; look again on the next refresh.
+                self.refreshed_at = None
+            else:
+                self.refreshed_at = time.time()
+            self.refreshed_changes = changes
+
+    def after(self, pk):
+        """
+        Returns the buffered rows after pk, or None if the buffer doesn't reach back that far.
+        """
+        with self.lock:
+            if self.start_pk is None or pk < self.start_pk:
+                return None
+            return [row for row in self.rows if row['id'] > pk]
+
+    def latest(self):
+        with self.lock:
+            return self.rows[-1] if self.rows else None
+
+
+buffer = ActivityBuffer()
+
+
+class ActivityStream(ActivityFeed):
+    """
+    Streams new activities as Server-Sent Events, or with format='poll', answers
+    a long poll with a JSON {"activities": [...], "cursor": ...} as soon as there are any.
+
+    Takes actor, include and exclude as the feeds do, and since, a cursor from an earlier
+    event or poll. Without one (or a Last-Event-ID header, when an event source reconnects),
+    only activities written after the request are sent.
+    """
+    buffer = buffer
+    # Seconds between comments that keep an idle event stream open.
+    heartbeat = 15
+    # Seconds before the shared buffer looks for writes from other processes.
+    fallback_interval = 5
+    # Seconds an event stream stays open; event sources reconnect by themselves.
+    max_duration = 300
+    # Seconds a long poll waits for something new.
+    poll_timeout = 25
+
+    def get(self, request, format='events'):
+        try:
+            self.prepare(request)
+        except InvalidCursor:
+            return HttpResponseBadRequest("Invalid since.")
+        if format == 'poll':
+            return self.poll()
+        response = StreamingHttpResponse(self.stream(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def prepare(self, request):
+        """
+        Works out the starting cursor and the filters, so neither needs a query later.
+        """
+        self.site_url = request.build_absolute_uri('/')[:-1]
+        since = request.GET.get('since') or request.META.get('HTTP_LAST_EVENT_ID')
+        if since:
+            self.last_pk = decode_stream_cursor(since)
+            self.cursor = since
+        else:
+            self.buffer.refresh(self.fallback_interval)
+            latest = self.buffer.latest()
+            self.last_pk = latest['id'] if latest else 0
+            self.cursor = self.make_cursor(latest)
+
+        params = request.GET
+        self.actor_id = get_actor_id(params['actor']) if params.get('actor') else None
+        self.actor_unknown = bool(params.get('actor')) and self.actor_id is None
+        self.include_ids = set(self.get_content_type_ids(params['include'])) if params.get('include') else None
+        self.exclude_ids = set(self.get_content_type_ids(params['exclude'])) if params.get('exclude') else set()
+
+    def make_cursor(self, row):
+        return make_stream_cursor(row['id'] if row is not None else 0)
+
+    def matches(self, row):
+        if self.actor_unknown:
+            return False
+        if self.actor_id is not None and row['actor_id'] != self.actor_id:
+            return False
+        if self.include_ids is not None and row['content_type_id'] not in self.include_ids:
+            return False
+        return row['content_type_id'] not in self.exclude_ids
+
+    def get_new_rows(self):
+        """
+        Returns the new activities for this subscriber, moving its cursor past them.
+        Usually served from the shared buffer; a subscriber further behind than
+        the buffer reaches reads a chunk from the database instead.
+        """
+        self.buffer.refresh(self.fallback_interval)
+        rows = self.buffer.after(self.last_pk)
+        if rows is None:
+            rows = list(
+                Activity.objects.filter(pk__gt=self.last_pk).order_by('pk').values(*FEED_FIELDS)[:self.chunk_size]
+            )
+        if rows:
+            self.last_pk = rows[-1]['id']
+            self.cursor = self.make_cursor(rows[-1])
+        return [row for row in rows if self.matches(row)]
+
+    def release_connection(self):
+        # An idle subscriber shouldn't hold on to a database connection.
+        connection = connections[routing.db_for_read(Activity)]
+        if not connection.in_atomic_block:
+            connection.close()
+
+    def poll(self):
+        deadline = time.time() + self.poll_timeout
+        seen = get_changes()
+        while True:
+            rows = self.get_new_rows()
+            remaining = deadline - time.time()
+            if rows or remaining <= 0:
+                break
+            self.release_connection()
+            seen = wait_for_change(seen, min(remaining, self.fallback_interval))
+        return JsonResponse({
+            'activities': [self.serialize(row) for row in rows],
+            'cursor': self.cursor,
+        })
+
+    def stream(self):
+        deadline = time.time() + self.max_duration
+        seen = get_changes()
+        yield 'retry: 3000\n\n'
+        last_sent = time.time()
+        while time.time() < deadline:
+            for row in self.get_new_rows():
+                item = self.serialize(row)
+                yield 'id: {}\nevent: activity\ndata: {}\n\n'.format(item['cursor'], json.dumps(item))
+                last_sent = time.time()
+            self.release_connection()
+            now = time.time()
+            # However often the buffer is checked, the stream only goes quiet for a heartbeat.
+            if now - last_sent >= self.heartbeat:
+                yield ': keepalive\n\n'
+                last_sent = now
+            seen = wait_for_change(seen, max(0, min(
+                self.fallback_interval, last_sent + self.heartbeat - now, deadline - now
+            )))
+
+
+activity_stream = ActivityStream.as_view()
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from activity_monitor import partitions
+
+
+class Command(BaseCommand):
+    help = "Moves activities older than ACTIVITY_MONITOR_HOT_MONTHS to the archive table."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=partitions.DEFAULT_CHUNK_SIZE,
+                            help="Activities to copy and delete at a time.")
+
+    def handle(self, **options):
+        """
+        Moves each month before the horizon to the archive, oldest first. Safe to
+        interrupt and re-run; run it again after registering or restoring old content.
+        """
+        if not partitions.enabled():
+            raise CommandError("Set ACTIVITY_MONITOR_HOT_MONTHS to archive activities.")
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size should be at least 1.")
+        start = time.time()
+        total = 0
+        for month, moved in partitions.archive(chunk_size=options['chunk_size']):
+            if moved:
+                self.stdout.write("{:%Y-%m}: moved {} activities.".format(month, moved))
+            total += moved
+        elapsed = time.time() - start
+        self.stdout.write("Moved {} activities to the archive in {:.2f}s ({:.0f} rows/sec).".format(
+            total, elapsed, total / elapsed if elapsed else 0
+        ))
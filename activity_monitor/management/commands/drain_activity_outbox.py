@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from activity_monitor import outbox
+
+
+class Command(BaseCommand):
+    help = "Builds activities from the outbox written when ACTIVITY_MONITOR_DEFERRED is set."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Outbox rows to process per transaction.")
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help="Stop after this many batches, even if the outbox isn't empty.")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep running, polling the outbox once it has been drained.")
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help="Seconds to wait between polls when looping.")
+
+    def handle(self, **options):
+        while True:
+            start = time.time()
+            consumed = outbox.drain(options['batch_size'], options['max_batches'])
+            if consumed:
+                elapsed = time.time() - start
+                self.stdout.write("Processed {} outbox rows in {:.2f}s ({:.0f} rows/sec).".format(
+                    consumed, elapsed, consumed / elapsed if elapsed else consumed
+                ))
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
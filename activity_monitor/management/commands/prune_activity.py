@@ -0,0 +1,66 @@
+import gzip
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from activity_monitor import registry, retention
+
+
+class Command(BaseCommand):
+    help = "Deletes activities older than their model's retention, optionally archiving them first."
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.model',
+                            help="Only prune these watched models. Defaults to all of them.")
+        parser.add_argument('--archive', default=None,
+                            help="Gzipped NDJSON file to add the pruned activities to before deleting them.")
+        parser.add_argument('--chunk-size', type=int, default=retention.DEFAULT_CHUNK_SIZE,
+                            help="Most activities to delete in one transaction.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only count the activities that would be pruned.")
+
+    def handle(self, **options):
+        """
+        Works through each watched model with a retention, deleting its expired activities
+        in primary key ranges of at most --chunk-size, each in its own transaction.
+        """
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size should be at least 1.")
+        labels = options['models']
+        if labels:
+            configs = [registry.get_config_for_label(label) for label in labels]
+            if None in configs:
+                raise CommandError("Only watched models can be pruned.")
+        else:
+            configs = registry.get_configs()
+
+        cutoffs = [(config, retention.get_cutoff(config)) for config in configs]
+        cutoffs = [(config, cutoff) for config, cutoff in cutoffs if cutoff is not None]
+        if not cutoffs:
+            self.stdout.write("No watched models have a retention.")
+            return
+
+        if options['dry_run']:
+            for config, cutoff in cutoffs:
+                self.stdout.write("{}: {} activities from before {:%Y-%m-%d %H:%M} would be pruned.".format(
+                    config.label, retention.count_expired(config, cutoff), cutoff
+                ))
+            return
+
+        archive = gzip.open(options['archive'], 'at', encoding='utf-8') if options['archive'] else None
+        start = time.time()
+        total = 0
+        try:
+            for config, cutoff in cutoffs:
+                pruned = sum(retention.prune(config, cutoff, options['chunk_size'], archive))
+                self.stdout.write("{}: pruned {} activities from before {:%Y-%m-%d %H:%M}.".format(
+                    config.label, pruned, cutoff
+                ))
+                total += pruned
+        finally:
+            if archive is not None:
+                archive.close()
+        elapsed = time.time() - start
+        self.stdout.write("Pruned {} activities in {:.2f}s ({:.0f} rows/sec).".format(
+            total, elapsed, total / elapsed if elapsed else 0
+        ))
@@ -0,0 +1,26 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+
+from activity_monitor.models import Activity
+
+
+class Command(BaseCommand):
+    help = "Deletes activities whose content object no longer exists."
+
+    def handle(self, **options):
+        """
+        Catches anything remove_orphans missed, such as objects deleted with raw SQL
+        or while the app wasn't watching. Each content type with activities is cleaned
+        up with a single anti-join DELETE.
+        """
+        content_type_ids = Activity.objects.order_by().values_list('content_type', flat=True).distinct()
+        total = 0
+        for content_type_id in content_type_ids:
+            content_type = ContentType.objects.get_for_id(content_type_id)
+            deleted = Activity.objects.purge_orphans(content_type)
+            if deleted:
+                self.stdout.write("{}.{}: removed {} orphaned activities.".format(
+                    content_type.app_label, content_type.model, deleted
+                ))
+            total += deleted
+        self.stdout.write("Removed {} orphaned activities.".format(total))
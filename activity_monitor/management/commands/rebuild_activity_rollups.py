@@ -0,0 +1,27 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from activity_monitor import rollups
+
+
+class Command(BaseCommand):
+    help = "Regenerates the daily and monthly activity counts from the activities."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', default=None,
+                            help="Only rebuild from the month of this YYYY-MM-DD date onwards.")
+
+    def handle(self, **options):
+        """
+        Brings the rollups back in step after changes they can't follow,
+        such as activities moved to another day or deleted with raw SQL.
+        """
+        since = None
+        if options['since']:
+            try:
+                since = datetime.datetime.strptime(options['since'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError("--since should be a YYYY-MM-DD date.")
+        written = rollups.rebuild(since)
+        self.stdout.write("Wrote {} activity rollups.".format(written))
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+
+from activity_monitor import caching
+from activity_monitor.managers import prefetch_generic
+from activity_monitor.models import Activity
+from activity_monitor.utils import MAX_LENGTH, get_absolute_url, get_image_url
+
+REFRESH_FIELDS = ('target', 'actor_name', 'absolute_url', 'image_url')
+
+
+class Command(BaseCommand):
+    help = "Recomputes the target, actor name, URL and image URL stored on existing activities."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Activities to refresh per batch.")
+
+    def handle(self, **options):
+        """
+        Walks all activities in primary key order, fetching each batch's content objects
+        a content type at a time, and writes back only the activities that changed.
+        """
+        qs = Activity.objects.select_related('actor').order_by('pk')
+        last_pk = scanned = refreshed = 0
+        while True:
+            batch = list(qs.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            scanned += len(batch)
+            prefetch_generic(batch)
+
+            changed = []
+            for activity in batch:
+                obj = activity.content_object
+                if obj is None:
+                    # An orphan; purge_orphans will take care of it.
+                    continue
+                values = {
+                    'target': str(obj)[:MAX_LENGTH],
+                    'actor_name': str(activity.actor)[:MAX_LENGTH],
+                    'absolute_url': get_absolute_url(obj),
+                    'image_url': get_image_url(obj),
+                }
+                if any(getattr(activity, field) != value for field, value in values.items()):
+                    for field, value in values.items():
+                        setattr(activity, field, value)
+                    changed.append(activity)
+            if changed:
+                Activity.objects.bulk_update(changed, REFRESH_FIELDS)
+                refreshed += len(changed)
+
+        if refreshed:
+            caching.invalidate()
+        self.stdout.write("Refreshed {} of {} activities.".format(refreshed, scanned))
@@ -1,29 +1,116 @@
-from __future__ import print_function
+import datetime
+import json
+import os
+import time
 
-from django.conf import settings
-from django.contrib.contenttypes.models import ContentType
-from django.core.management.base import CommandError
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from activity_monitor import backfill, registry
 
 
 class Command(BaseCommand):
     help = "Registers existing content for a new installation of the timelines app."
 
-    def handle(self, **kwargs):
-      """
-      Simply re-saves all objects from models listed in settings.TIMELINE_MODELS. Since the timeline
-      app is now following these models, it will register each item as it is re-saved. The purpose of this
-      script is to register content in your database that existed prior to installing the timeline app.
-      """
-      for item in settings.ACTIVITY_MONITOR_MODELS:
-        app_label, model = item['model'].split('.', 1)
-        content_type = ContentType.objects.get(app_label=app_label, model=model)
-        model = content_type.model_class()
-
-        objects = model.objects.all()
-
-        for object in objects:
-          try:
-            object.save()
-          except Exception as e:
-            print("Error saving: {}".format(e))
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.model',
+                            help="Only backfill these watched models. Defaults to all of them.")
+        parser.add_argument('--workers', type=int, default=1,
+                            help="Number of processes to spread primary key ranges over.")
+        parser.add_argument('--since', default=None,
+                            help="Only register content dated on or after this YYYY-MM-DD date.")
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help="Rows to fetch and write at a time.")
+        parser.add_argument('--range-size', type=int, default=50000,
+                            help="Primary keys per unit of work (and per checkpoint).")
+        parser.add_argument('--checkpoint', default=None,
+                            help="File recording finished ranges. If it exists, those ranges are skipped.")
+
+    def handle(self, **options):
+        """
+        Builds activities for content in the models listed in settings.ACTIVITY_MONITOR_MODELS
+        that existed prior to installing the timeline app. Each model is streamed in
+        primary key ranges and written in bulk, without re-saving anything.
+        """
+        since = None
+        if options['since']:
+            try:
+                since = datetime.datetime.strptime(options['since'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError("--since should be a YYYY-MM-DD date.")
+
+        if options['workers'] > 1 and connection.vendor == 'sqlite':
+            raise CommandError("SQLite can't take writes from several processes at once; use --workers 1.")
+
+        labels = options['models']
+        if labels:
+            configs = [registry.get_config_for_label(label) for label in labels]
+            if None in configs:
+                raise CommandError("Only watched models can be registered.")
+        else:
+            configs = registry.get_configs()
+
+        checkpoint_path = options['checkpoint']
+        completed = {}
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            completed = self.load_checkpoint(checkpoint_path, options)
+
+        tasks = []
+        totals = {}
+        for config in configs:
+            ranges = backfill.get_ranges(config, since, options['range_size'])
+            # A range is only skipped if it was finished with the same bounds.
+            done = set(tuple(bounds) for bounds in completed.get(config.label, []))
+            pending = [(low, high) for low, high in ranges if (low, high) not in done]
+            totals[config.label] = [len(ranges) - len(pending), len(ranges)]
+            tasks.extend(
+                (config.label, low, high, since, options['chunk_size'])
+                for low, high in pending
+            )
+
+        start = time.time()
+        scanned_total = written_total = 0
+        for label, low, high, scanned, written in backfill.run(tasks, options['workers']):
+            scanned_total += scanned
+            written_total += written
+            totals[label][0] += 1
+            if checkpoint_path:
+                completed.setdefault(label, []).append([low, high])
+                self.save_checkpoint(checkpoint_path, completed, options)
+
+            elapsed = time.time() - start
+            self.stdout.write("{}: {}/{} ranges, {} scanned, {} registered ({:.0f} rows/sec)".format(
+                label, totals[label][0], totals[label][1], scanned_total, written_total,
+                scanned_total / elapsed if elapsed else scanned_total
+            ))
+
+        self.stdout.write("Registered {} activities from {} objects in {:.1f}s.".format(
+            written_total, scanned_total, time.time() - start
+        ))
+
+    def load_checkpoint(self, path, options):
+        """
+        Returns the ranges finished so far, refusing a checkpoint written with
+        a different --range-size or --since, whose ranges wouldn't line up.
+        """
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if not isinstance(checkpoint, dict) or 'ranges' not in checkpoint:
+            raise CommandError("{} isn't a checkpoint this version can resume from; remove it to start over.".format(path))
+        if checkpoint['range_size'] != options['range_size'] or checkpoint['since'] != options['since']:
+            raise CommandError(
+                "{} was written with --range-size {} and --since {}; run with the same options, "
+                "or remove it to start over.".format(path, checkpoint['range_size'], checkpoint['since'])
+            )
+        return checkpoint['ranges']
+
+    def save_checkpoint(self, path, completed, options):
+        # Write then rename, so an interrupted run never leaves a half-written checkpoint.
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'range_size': options['range_size'],
+                'since': options['since'],
+                'ranges': completed,
+            }, f)
+        os.replace(tmp_path, path)
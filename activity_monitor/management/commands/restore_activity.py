@@ -0,0 +1,36 @@
+import gzip
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from activity_monitor import retention
+
+
+class Command(BaseCommand):
+    help = "Loads activities back from an archive written by prune_activity."
+
+    def add_arguments(self, parser):
+        parser.add_argument('archive', help="Gzipped NDJSON archive to restore.")
+        parser.add_argument('--chunk-size', type=int, default=retention.DEFAULT_CHUNK_SIZE,
+                            help="Activities to insert at a time.")
+
+    def handle(self, **options):
+        """
+        Bulk-inserts the archived activities a chunk at a time. Objects that have an
+        activity again keep it, so an archive can safely be restored more than once.
+        """
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size should be at least 1.")
+        start = time.time()
+        read = restored = 0
+        try:
+            with gzip.open(options['archive'], 'rt', encoding='utf-8') as archive:
+                for chunk_read, chunk_restored in retention.restore(archive, options['chunk_size']):
+                    read += chunk_read
+                    restored += chunk_restored
+        except (IOError, ValueError) as e:
+            raise CommandError("Couldn't read {}: {}".format(options['archive'], e))
+        elapsed = time.time() - start
+        self.stdout.write("Restored {} of {} archived activities in {:.2f}s ({:.0f} rows/sec).".format(
+            restored, read, elapsed, restored / elapsed if elapsed else 0
+        ))
@@ -1,12 +1,188 @@
 import datetime
+import functools
+import threading
 
-from django.db import models
-from django.db.models import signals
+from collections import OrderedDict
+
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import F, signals
+from django.db.models.query import ModelIterable
+from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 
+from activity_monitor import caching, coalescing, routing
 from activity_monitor.signals import create_or_update
 
-class ActivityItemManager(models.Manager):
+# Backends that understand INSERT ... ON CONFLICT against the unique pair,
+# with the comparison an upsert uses to skip unchanged rows.
+UPSERT_VENDORS = {
+    'postgresql': 'IS DISTINCT FROM',
+    'sqlite': 'IS NOT',
+}
+
+# Object ids per DELETE ... WHERE object_id IN (...) when removing orphans.
+ORPHAN_BATCH_SIZE = 500
+
+# Deleted pks waiting for their transaction to commit, per thread and connection.
+_orphans = threading.local()
+
+# Objects read back and written per chunk by register_bulk().
+BULK_CHUNK_SIZE = 2000
+
+# Denormalized fields an upsert may refresh on an existing activity.
+UPSERT_FIELDS = (
+    'actor', 'actor_name', 'timestamp', 'verb', 'override_string', 'target', 'absolute_url', 'image_url'
+)
+
+
+def supports_upsert(connection):
+    """
+    True if the connection's database understands INSERT ... ON CONFLICT,
+    which takes SQLite 3.24 or PostgreSQL 9.5. Older ones use the get/update fallback.
+    """
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 24)
+    if connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+    return False
+
+
+def prefetch_generic(instances, field_name='content_object'):
+    """
+    Fills in the named GenericForeignKey on each of the instances,
+    fetching the related objects with one in_bulk query per content type.
+    The instances don't all need to be of the same model; those without
+    such a field are skipped. Returns the related objects that were found.
+    """
+    wanted = OrderedDict()
+    for instance in instances:
+        field = _get_generic_field(instance.__class__, field_name)
+        if field is None:
+            continue
+        content_type_id = getattr(instance, field.ct_field + '_id', None)
+        object_id = getattr(instance, field.fk_field, None)
+        if content_type_id is None or object_id is None:
+            continue
+        wanted.setdefault(content_type_id, []).append((instance, field, object_id))
+
+    found = []
+    for content_type_id, pending in wanted.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is None:
+            continue
+        to_python = model._meta.pk.to_python
+        objects = model._base_manager.in_bulk(set(to_python(object_id) for instance, field, object_id in pending))
+        found.extend(objects.values())
+        for instance, field, object_id in pending:
+            obj = objects.get(to_python(object_id))
+            if obj is not None:
+                field.set_cached_value(instance, obj)
+    return found
+
+
+def _iter_pk_chunks(objects, chunk_size):
+    """
+    Yields (model, [pk, ...]) chunks for a queryset, walked by primary key
+    without holding it all in memory, or for an iterable of saved instances.
+    """
+    if isinstance(objects, models.QuerySet):
+        qs = objects.order_by('pk').values_list('pk', flat=True)
+        last = None
+        while True:
+            chunk = list((qs if last is None else qs.filter(pk__gt=last))[:chunk_size])
+            if chunk:
+                yield objects.model, chunk
+            if len(chunk) < chunk_size:
+                return
+            last = chunk[-1]
+
+    pending = OrderedDict()
+    for instance in objects:
+        if instance.pk is None:
+            continue
+        model = instance.__class__
+        pks = pending.setdefault(model, [])
+        pks.append(instance.pk)
+        if len(pks) >= chunk_size:
+            yield model, pending.pop(model)
+    for model, pks in pending.items():
+        yield model, pks
+
+
+def _get_generic_field(model, field_name):
+    for field in model._meta.private_fields:
+        if isinstance(field, GenericForeignKey) and field.name == field_name:
+            return field
+    return None
+
+
+class RoutedQuerySet(models.QuerySet):
+    """
+    Picks its database through activity_monitor.routing, so the read and write
+    database settings (and read-your-writes) apply.
+    """
+    @property
+    def db(self):
+        if self._db:
+            return self._db
+        if self._for_write:
+            return routing.db_for_write(self.model, **self._hints)
+        return routing.db_for_read(self.model, **self._hints)
+
+
+class ActivityQuerySet(RoutedQuerySet):
+
+    def __init__(self, *args, **kwargs):
+        super(ActivityQuerySet, self).__init__(*args, **kwargs)
+        self._content_object_depth = 0
+
+    def _clone(self):
+        clone = super(ActivityQuerySet, self)._clone()
+        clone._content_object_depth = self._content_object_depth
+        return clone
+
+    def _fetch_all(self):
+        fetch = self._result_cache is None
+        super(ActivityQuerySet, self)._fetch_all()
+        if fetch and self._content_object_depth and issubclass(self._iterable_class, ModelIterable):
+            objects = prefetch_generic(self._result_cache)
+            if self._content_object_depth > 1:
+                prefetch_generic(objects)
+
+    def delete(self):
+        """
+        Deletes the activities, taking them off the rollups in the same transaction,
+        and invalidates the cached template tags once it commits.
+        """
+        from activity_monitor import rollups
+        from activity_monitor.models import ActivityRollup
+        db = self._db or routing.db_for_write(self.model)
+        with transaction.atomic(using=db):
+            if rollups.enabled():
+                changes = rollups.get_changes(self, sign=-1)
+                deleted = super(ActivityQuerySet, self).delete()
+                ActivityRollup.objects.apply(changes, using=db)
+            else:
+                deleted = super(ActivityQuerySet, self).delete()
+            if deleted[0]:
+                caching.invalidate(db)
+                coalescing.forget_all(db)
+        return deleted
+
+    def with_content_objects(self, follow=False):
+        """
+        Fetches the content objects for all of the activities at once, with a single
+        in_bulk query per content type, instead of a query per activity.
+
+        With follow=True, content objects that have a content_object of their own
+        (comments, for example) have those fetched too, as the image property uses them.
+        """
+        clone = self._chain()
+        clone._content_object_depth = 2 if follow else 1
+        return clone
+
+
+class ActivityItemManager(models.Manager.from_queryset(ActivityQuerySet)):
     
     def __init__(self):
       super(models.Manager, self).__init__()
@@ -14,21 +190,397 @@ class ActivityItemManager(models.Manager):
       self.model = None
       self._inherited = False 
       self.models_by_name = {}
-      self._db = 'default'
       
-    def remove_orphans(self, instance, **kwargs):
+    def remove_orphans(self, instance, using=None, **kwargs):
       """
       When an item is deleted, first delete any Activity object that has been created
       on its behalf.
+
+      Rather than a query per deleted instance, the pks are collected per content type
+      and removed with one DELETE ... WHERE object_id IN (...) per batch once the
+      deleting transaction commits. A queryset delete runs in a single transaction,
+      so deleting thousands of objects costs a handful of queries here.
       """
-      from activity_monitor.models import Activity
-      try:
-        instance_content_type = ContentType.objects.get_for_model(instance)
-        timeline_item = Activity.objects.get(content_type=instance_content_type, object_id=instance.pk)
-        timeline_item.delete()
-      except Activity.DoesNotExist:
+      from django.conf import settings
+      from activity_monitor.models import ActivityOutbox
+      content_type = ContentType.objects.get_for_model(instance)
+      if getattr(settings, 'ACTIVITY_MONITOR_DEFERRED', False):
+        # The outbox row has to be written in the deleting transaction itself.
+        ActivityOutbox.objects.enqueue(content_type, instance.pk, ActivityOutbox.DELETE)
         return
-            
+
+      using = using or routing.db_for_write(instance.__class__)
+      batch = getattr(_orphans, using, None)
+      if batch is None:
+        batch = OrderedDict()
+        setattr(_orphans, using, batch)
+      batch.setdefault(content_type.pk, []).append(instance.pk)
+      # Each delete registers a flush, since any of them may be rolled back on its own,
+      # but they share the batch, and the first flush to run empties it.
+      # Outside of a transaction this runs straight away.
+      transaction.on_commit(functools.partial(self.flush_orphans, using, batch), using=using)
+
+    def flush_orphans(self, using, batch):
+      """
+      Removes the activities for the {content_type_id: [object_id, ...]} remove_orphans collected.
+      A batch can outlive a rolled-back delete, so the activities of objects
+      that still exist are left alone.
+      """
+      if getattr(_orphans, using, None) is batch:
+        delattr(_orphans, using)
+      while batch:
+        content_type_id, object_ids = batch.popitem(last=False)
+        try:
+          model = ContentType.objects.get_for_id(content_type_id).model_class()
+        except ContentType.DoesNotExist:
+          # Its activities went with it.
+          continue
+        if model is not None:
+          existing = set()
+          for start in range(0, len(object_ids), ORPHAN_BATCH_SIZE):
+            existing.update(model._base_manager.using(using).filter(
+              pk__in=object_ids[start:start + ORPHAN_BATCH_SIZE]
+            ).values_list('pk', flat=True))
+          object_ids = [pk for pk in object_ids if pk not in existing]
+        self.delete_for_objects(content_type_id, object_ids)
+
+    def delete_for_objects(self, content_type, object_ids, batch_size=ORPHAN_BATCH_SIZE):
+        """
+        Deletes the activities for the given objects of a content type,
+        with a single DELETE per batch of object ids. Returns the number deleted.
+        """
+        from activity_monitor import partitions
+        object_ids = list(object_ids)
+        deleted = 0
+        for start in range(0, len(object_ids), batch_size):
+            batch = object_ids[start:start + batch_size]
+            deleted += self.filter(content_type=content_type, object_id__in=batch).delete()[0]
+            deleted += partitions.forget(content_type, batch)
+        return deleted
+
+    def purge_orphans(self, content_type):
+        """
+        Deletes activities whose content object no longer exists,
+        using an anti-join against the content type's table. Returns the number deleted.
+        """
+        from activity_monitor import partitions
+        from activity_monitor.models import ArchivedActivity
+        querysets = [self.filter(content_type=content_type)]
+        if partitions.enabled():
+            querysets.append(ArchivedActivity.objects.filter(content_type=content_type))
+        model = content_type.model_class()
+        deleted = 0
+        for qs in querysets:
+            if model is not None:
+                qs = qs.exclude(object_id__in=model._base_manager.values('pk'))
+            deleted += qs.delete()[0]
+        return deleted
+
+    def register_bulk(self, objects, chunk_size=BULK_CHUNK_SIZE):
+        """
+        Creates or refreshes the activities for objects written without signals,
+        such as by bulk_create() or QuerySet.update(). Takes a queryset or an
+        iterable of saved instances.
+
+        Each chunk is read back through its model's configured manager, in one
+        query, and checked in memory exactly as a save would be: objects that fail
+        the check field or the manager lose their activity, and those the config
+        turns down (future or old dates, no user, filtered staff or superusers)
+        are left alone. The rest are written with one bulk upsert per chunk.
+        Unwatched models are skipped. Returns (written, removed).
+        """
+        from activity_monitor import registry
+        now = datetime.datetime.now()
+        written = removed = 0
+        for model, pks in _iter_pk_chunks(objects, chunk_size):
+            config = registry.get_config(model)
+            if config is None:
+                continue
+            instances = config.get_queryset().in_bulk(pks)
+            rows, gone = [], []
+            for pk in pks:
+                instance = instances.get(pk)
+                if instance is None or not config.passes_check(instance):
+                    gone.append(pk)
+                    continue
+                values = config.get_activity_values(instance, now)
+                if values is not None:
+                    rows.append((config.content_type, pk, values))
+            if rows:
+                written += self.bulk_upsert(rows, create_only=config.create_only_fields)
+            if gone:
+                removed += self.delete_for_objects(config.content_type, gone)
+        return written, removed
+
+    def unregister_bulk(self, objects, chunk_size=BULK_CHUNK_SIZE):
+        """
+        Deletes the activities for a queryset or iterable of objects, as if each had been deleted.
+        Returns the number of activities deleted.
+        """
+        removed = 0
+        for model, pks in _iter_pk_chunks(objects, chunk_size):
+            removed += self.delete_for_objects(ContentType.objects.get_for_model(model), pks)
+        return removed
+
+    def upsert(self, content_type, object_id, create_only=(), **values):
+        """
+        Create the Activity for a content object, or refresh its denormalized fields
+        if it already exists, without racing other writers on the unique
+        (content_type, object_id) pair.
+
+        An existing row is only rewritten when one of its values actually changed.
+        Fields named in create_only are written when the activity is created and
+        left alone after that. Returns a (created, updated) tuple.
+        """
+        values = dict(
+            (field, value) for field, value in values.items() if field in UPSERT_FIELDS
+        )
+        db = self._db or routing.db_for_write(self.model)
+        if supports_upsert(connections[db]):
+            result = self._upsert_on_conflict(db, content_type, object_id, values, create_only)
+            if result[0]:
+                # The fallback creates through save(), which does this itself.
+                from activity_monitor import partitions
+                partitions.forget(content_type, [object_id], db)
+        else:
+            result = self._upsert_fallback(db, content_type, object_id, values, create_only)
+        if any(result):
+            caching.invalidate(db)
+        return result
+
+    def bulk_upsert(self, rows, batch_size=None, create_only=()):
+        """
+        Upserts many activities at once, given (content_type, object_id, values) rows.
+        Every values dict should hold the same fields, as returned by
+        ActivityModelConfig.get_activity_values(). Fields named in create_only
+        are left alone on activities that already exist.
+
+        On backends with ON CONFLICT each batch is a single statement.
+        Returns the number of activities created or changed.
+        """
+        # A statement can only touch each activity once, so the last row for an object wins.
+        unique = OrderedDict()
+        for content_type, object_id, values in rows:
+            unique[(getattr(content_type, 'pk', content_type), object_id)] = (content_type, object_id, values)
+        rows = list(unique.values())
+        if not rows:
+            return 0
+        db = self._db or routing.db_for_write(self.model)
+        connection = connections[db]
+        if not supports_upsert(connection):
+            written = 0
+            for content_type, object_id, values in rows:
+                written += any(self.upsert(content_type, object_id, create_only=create_only, **values))
+            return written
+
+        opts = self.model._meta
+        qn = connection.ops.quote_name
+        distinct = UPSERT_VENDORS[connection.vendor]
+        names = ['content_type', 'object_id'] + sorted(
+            field for field in rows[0][2] if field in UPSERT_FIELDS
+        )
+        fields = [opts.get_field(name) for name in names]
+        columns = [qn(field.column) for field in fields]
+        updated = [qn(field.column) for field in fields[2:] if field.name not in create_only]
+        table = qn(opts.db_table)
+        batch_size = batch_size or connection.ops.bulk_batch_size(fields, rows) or len(rows)
+
+        sql = (
+            'INSERT INTO {table} ({columns}) VALUES {{values}} '
+            'ON CONFLICT ({key}) DO UPDATE SET {update} WHERE {changed}'
+        ).format(
+            table=table,
+            columns=', '.join(columns),
+            key=', '.join(columns[:2]),
+            update=', '.join('{0} = excluded.{0}'.format(column) for column in updated),
+            changed=' OR '.join(
+                '{0}.{1} {2} excluded.{1}'.format(table, column, distinct) for column in updated
+            ),
+        )
+        placeholder = '({})'.format(', '.join(['%s'] * len(columns)))
+
+        written = 0
+        with transaction.atomic(using=db), connection.cursor() as cursor:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                self._record_rollups(db, batch, create_only)
+                params = []
+                for content_type, object_id, values in batch:
+                    row = dict(values, content_type=content_type, object_id=object_id)
+                    for name, field in zip(names, fields):
+                        value = row.get(name)
+                        if isinstance(value, models.Model):
+                            value = value.pk
+                        params.append(field.get_db_prep_save(value, connection))
+                cursor.execute(sql.format(values=', '.join([placeholder] * len(batch))), params)
+                written += cursor.rowcount
+                self._forget_archived(db, batch)
+        if written:
+            caching.invalidate(db)
+        return written
+
+    def _upsert_on_conflict(self, db, content_type, object_id, values, create_only=()):
+        """
+        INSERT ... ON CONFLICT DO NOTHING, followed (only on conflict) by an UPDATE
+        guarded so that unchanged rows are left alone. Splitting the upsert this
+        way tells us whether the row was created, which a single
+        ON CONFLICT DO UPDATE can't report on every backend.
+        """
+        connection = connections[db]
+        opts = self.model._meta
+        qn = connection.ops.quote_name
+        distinct = UPSERT_VENDORS[connection.vendor]
+
+        columns, params, updated = [], [], []
+        for name, value in [('content_type', content_type), ('object_id', object_id)] + sorted(values.items()):
+            field = opts.get_field(name)
+            if isinstance(value, models.Model):
+                value = value.pk
+            columns.append(qn(field.column))
+            params.append(field.get_db_prep_save(value, connection))
+            if name in values and name not in create_only:
+                updated.append((qn(field.column), params[-1]))
+
+        table = qn(opts.db_table)
+        key = columns[:2]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) DO NOTHING'.format(
+                    table, ', '.join(columns), ', '.join(['%s'] * len(columns)), ', '.join(key)
+                ),
+                params
+            )
+            if cursor.rowcount:
+                self._record_rollups(db, [(content_type, object_id, values)], existing={})
+                return True, False
+            if not updated:
+                return False, False
+            from activity_monitor import rollups
+            if rollups.enabled():
+                # The rollups need to know which day and verb the activity is moving from.
+                qs = self.using(db).filter(content_type=content_type, object_id=object_id)
+                updates = dict((field, value) for field, value in values.items() if field not in create_only)
+                return False, bool(self._update_existing(db, qs, content_type, updates))
+            update_params = [param for column, param in updated]
+            cursor.execute(
+                'UPDATE {} SET {} WHERE {} = %s AND {} = %s AND ({})'.format(
+                    table,
+                    ', '.join('{} = %s'.format(column) for column, param in updated),
+                    key[0],
+                    key[1],
+                    ' OR '.join('{} {} %s'.format(column, distinct) for column, param in updated),
+                ),
+                update_params + params[:2] + update_params
+            )
+            return False, bool(cursor.rowcount)
+
+    def _record_rollups(self, db, rows, create_only=(), existing=None):
+        """
+        Adds the (content_type, object_id, values) rows that don't have an activity yet
+        to the rollups, and moves those that do from their old day and verb to the new.
+        Call it before writing them, or pass the {(content_type_id, object_id): (verb, timestamp)}
+        of the activities that already existed.
+        """
+        from activity_monitor import rollups
+        from activity_monitor.models import ActivityRollup
+        if not rollups.enabled():
+            return
+        if existing is None:
+            # Locked, where the backend can, until the upsert that follows has run.
+            existing = dict(
+                ((content_type_id, object_id), (verb, timestamp))
+                for content_type_id, object_id, verb, timestamp in self.using(db).order_by().select_for_update().filter(
+                    content_type_id__in=set(getattr(row[0], 'pk', row[0]) for row in rows),
+                    object_id__in=[row[1] for row in rows],
+                ).values_list('content_type_id', 'object_id', 'verb', 'timestamp')
+            )
+        changes = []
+        for content_type, object_id, values in rows:
+            old = existing.get((getattr(content_type, 'pk', content_type), object_id))
+            if old is None:
+                changes.append((content_type, values.get('verb'), values['timestamp'], 1))
+                continue
+            # Unchanged days and verbs cancel out in apply().
+            verb, timestamp = old
+            changes.append((content_type, verb, timestamp, -1))
+            changes.append((
+                content_type,
+                values['verb'] if 'verb' in values and 'verb' not in create_only else verb,
+                values['timestamp'] if 'timestamp' in values and 'timestamp' not in create_only else timestamp,
+                1,
+            ))
+        ActivityRollup.objects.apply(changes, using=db)
+
+    def _update_existing(self, db, qs, content_type, updates):
+        """
+        Refreshes the existing activity in qs with updates, if any of them differ.
+        Returns whether it changed, or None if there is no activity to update.
+
+        With rollups on, the activity is read first, and its counts move with it
+        when its day or verb changes. The update only applies if the day and verb
+        are still the ones that were read; if another writer got in first, the
+        activity is read again.
+        """
+        from activity_monitor import rollups
+        from activity_monitor.models import ActivityRollup
+        if not rollups.enabled():
+            if qs.filter(**updates).exists():
+                return False
+            return True if updates and qs.update(**updates) else None
+
+        opts = self.model._meta
+        attnames = dict((name, opts.get_field(name).attname) for name in set(updates) | {'verb', 'timestamp'})
+        while True:
+            old = qs.values(*attnames.values()).first()
+            if old is None:
+                return None
+            if all(old[attnames[name]] == getattr(value, 'pk', value) for name, value in updates.items()):
+                return False
+            guarded = qs.filter(verb=old['verb'], timestamp=old['timestamp'])
+            verb, timestamp = updates.get('verb', old['verb']), updates.get('timestamp', old['timestamp'])
+            if (verb, rollups.get_date(timestamp)) == (old['verb'], rollups.get_date(old['timestamp'])):
+                # Its counts stay where they are, so the update can go on its own.
+                if guarded.update(**updates):
+                    return True
+                continue
+            with transaction.atomic(using=db):
+                if guarded.update(**updates):
+                    ActivityRollup.objects.apply([
+                        (content_type, old['verb'], old['timestamp'], -1),
+                        (content_type, verb, timestamp, 1),
+                    ], using=db)
+                    return True
+
+    def _forget_archived(self, db, rows):
+        """
+        Deletes any archived activities for the objects of (content_type, object_id, values) rows.
+        """
+        from activity_monitor import partitions
+        if not partitions.enabled():
+            return
+        object_ids = OrderedDict()
+        for content_type, object_id, values in rows:
+            object_ids.setdefault(getattr(content_type, 'pk', content_type), []).append(object_id)
+        for content_type, ids in object_ids.items():
+            partitions.forget(content_type, ids, db)
+
+    def _upsert_fallback(self, db, content_type, object_id, values, create_only=()):
+        """
+        For backends without ON CONFLICT: update, then insert, and if another
+        writer got the insert in first, update their row instead.
+        """
+        qs = self.using(db).filter(content_type=content_type, object_id=object_id)
+        updates = dict((field, value) for field, value in values.items() if field not in create_only)
+        changed = self._update_existing(db, qs, content_type, updates)
+        if changed is not None:
+            return False, changed
+        try:
+            with transaction.atomic(using=db):
+                self.using(db).create(content_type=content_type, object_id=object_id, **values)
+            return True, False
+        except IntegrityError:
+            return False, bool(self._update_existing(db, qs, content_type, updates))
+
     def follow_model(self, model):
         """
         Follow a particular model class, updating associated Activity objects automatically.
@@ -38,6 +590,37 @@ class ActivityItemManager(models.Manager):
           signals.post_save.connect(create_or_update, sender=model)
           signals.post_delete.connect(self.remove_orphans, sender=model)
         
+    def follow_actors(self):
+        """
+        An actor's activities are deleted by a cascade when the actor is, which
+        bypasses the queryset delete. Take them off the rollups and invalidate the
+        cached template tags first, in the deleting transaction.
+        """
+        from django.conf import settings
+        signals.pre_delete.connect(self.remove_for_actor, sender=settings.AUTH_USER_MODEL)
+
+    def remove_for_actor(self, instance, using=None, **kwargs):
+        from activity_monitor import partitions, rollups
+        from activity_monitor.models import ActivityRollup, ArchivedActivity
+        if rollups.enabled():
+            changes = rollups.get_changes(self.using(using).filter(actor=instance), sign=-1)
+            if partitions.enabled():
+                # Archived activities cascade with the actor too.
+                changes += rollups.get_changes(ArchivedActivity.objects.using(using).filter(actor=instance), sign=-1)
+            if not changes:
+                return
+            ActivityRollup.objects.apply(changes, using=using)
+        caching.invalidate(using)
+        coalescing.forget_all(using)
+
+    def for_period(self, start=None, end=None):
+        """
+        Returns the activities with start <= timestamp < end, from the archive if the
+        period has been archived. See activity_monitor.partitions.
+        """
+        from activity_monitor import partitions
+        return partitions.for_period(start, end)
+
     def get_for_model(self, model):
         """
         Return a QuerySet of only items of a certain type.
@@ -56,3 +639,88 @@ class ActivityItemManager(models.Manager):
             return qs.order_by('-timestamp')[0].timestamp
         except IndexError:
             return datetime.datetime.fromtimestamp(0)
+
+    async def aget_for_model(self, model):
+        """
+        Async get_for_model(). Resolving the content type may need a query,
+        so it's done in a worker thread; the QuerySet itself is lazy.
+        """
+        from asgiref.sync import sync_to_async
+        return await sync_to_async(self.get_for_model, thread_sensitive=True)(model)
+
+    async def aget_last_update_of_model(self, model, **kwargs):
+        """
+        Async get_last_update_of_model().
+        """
+        from asgiref.sync import sync_to_async
+        return await sync_to_async(self.get_last_update_of_model, thread_sensitive=True)(model, **kwargs)
+
+
+class ArchiveManager(models.Manager.from_queryset(ActivityQuerySet)):
+    """
+    Archived activities. Deleting them through a queryset takes them off the rollups, as it does for activities.
+    """
+
+
+class OutboxManager(models.Manager.from_queryset(RoutedQuerySet)):
+
+    def enqueue(self, content_type, object_id, op):
+        """
+        Appends a single event for an object to the outbox.
+        """
+        return self.create(content_type=content_type, object_id=object_id, op=op)
+
+
+class RollupManager(models.Manager.from_queryset(RoutedQuerySet)):
+
+    def apply(self, changes, using=None):
+        """
+        Adds (content_type, verb, timestamp, delta) changes to the day and month
+        rollups they fall in. On backends with ON CONFLICT this is one statement per batch.
+        """
+        from activity_monitor.rollups import get_date
+        totals = OrderedDict()
+        for content_type, verb, timestamp, delta in changes:
+            day = get_date(timestamp)
+            for key in ((self.model.DAY, day), (self.model.MONTH, day.replace(day=1))):
+                key += (getattr(content_type, 'pk', content_type), verb or '')
+                totals[key] = totals.get(key, 0) + delta
+        totals = [(key, delta) for key, delta in totals.items() if delta]
+        if not totals:
+            return
+
+        db = using or self._db or routing.db_for_write(self.model)
+        connection = connections[db]
+        if not supports_upsert(connection):
+            for (period, date, content_type_id, verb), delta in totals:
+                key = dict(period=period, date=date, content_type_id=content_type_id, verb=verb)
+                qs = self.using(db).filter(**key)
+                if qs.update(count=F('count') + delta):
+                    continue
+                try:
+                    with transaction.atomic(using=db):
+                        self.using(db).create(count=delta, **key)
+                except IntegrityError:
+                    qs.update(count=F('count') + delta)
+            return
+
+        opts = self.model._meta
+        qn = connection.ops.quote_name
+        fields = [opts.get_field(name) for name in ('period', 'date', 'content_type', 'verb', 'count')]
+        columns = [qn(field.column) for field in fields]
+        table = qn(opts.db_table)
+        sql = (
+            'INSERT INTO {table} ({columns}) VALUES {{values}} '
+            'ON CONFLICT ({key}) DO UPDATE SET {count} = {table}.{count} + excluded.{count}'
+        ).format(table=table, columns=', '.join(columns), key=', '.join(columns[:4]), count=columns[4])
+        placeholder = '({})'.format(', '.join(['%s'] * len(columns)))
+        batch_size = connection.ops.bulk_batch_size(fields, totals) or len(totals)
+
+        with connection.cursor() as cursor:
+            for start in range(0, len(totals), batch_size):
+                batch = totals[start:start + batch_size]
+                params = []
+                for key, delta in batch:
+                    for field, value in zip(fields, key + (delta,)):
+                        params.append(field.get_db_prep_save(value, connection))
+                cursor.execute(sql.format(values=', '.join([placeholder] * len(batch))), params)
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity_monitor', '0003_activity_on_delete'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='absolute_url',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='image_url',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+    ]
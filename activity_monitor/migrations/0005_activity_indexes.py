@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:14
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity_monitor', '0004_activity_urls'),
+    ]
+
+    operations = [
+        # Add the composite indexes before dropping the single-column foreign key indexes they cover.
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['timestamp', 'id'], name='activity_timestamp_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['actor', 'timestamp'], name='activity_actor_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['content_type', 'timestamp'], name='activity_ct_timestamp_idx'),
+        ),
+        migrations.AlterField(
+            model_name='activity',
+            name='actor',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='subject', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='activity',
+            name='content_type',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:21
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+import django.db.models.deletion
+
+
+def fill_rollups(apps, schema_editor):
+    # Count the existing activities, so the rollups start out in step with them.
+    Activity = apps.get_model('activity_monitor', 'Activity')
+    ActivityRollup = apps.get_model('activity_monitor', 'ActivityRollup')
+    db = schema_editor.connection.alias
+    rows = Activity.objects.using(db).order_by().values(
+        'content_type_id', 'verb', day=TruncDate('timestamp')
+    ).annotate(total=Count('pk'))
+    totals = {}
+    for row in rows:
+        for key in (('d', row['day']), ('m', row['day'].replace(day=1))):
+            key += (row['content_type_id'], row['verb'] or '')
+            totals[key] = totals.get(key, 0) + row['total']
+    ActivityRollup.objects.using(db).bulk_create([
+        ActivityRollup(period=period, date=date, content_type_id=content_type_id, verb=verb, count=total)
+        for (period, date, content_type_id, verb), total in totals.items()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('activity_monitor', '0005_activity_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('d', 'day'), ('m', 'month')], max_length=1)),
+                ('date', models.DateField()),
+                ('verb', models.CharField(blank=True, default='', max_length=255)),
+                ('count', models.IntegerField(default=0)),
+                ('content_type', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+            options={
+                'ordering': ['-date'],
+                'unique_together': {('period', 'date', 'content_type', 'verb')},
+            },
+        ),
+        migrations.RunPython(fill_rollups, migrations.RunPython.noop),
+    ]
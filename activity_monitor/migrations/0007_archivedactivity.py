@@ -0,0 +1,68 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:57
+
+import activity_monitor.models
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('activity_monitor', '0006_activityrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMonth',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(unique=True)),
+                ('count', models.IntegerField(default=0)),
+                ('archived', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['-month'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedActivity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField()),
+                ('verb', models.CharField(blank=True, editable=False, max_length=255, null=True)),
+                ('override_string', models.CharField(blank=True, editable=False, max_length=255, null=True)),
+                ('target', models.CharField(blank=True, editable=False, max_length=255, null=True)),
+                ('actor_name', models.CharField(blank=True, editable=False, max_length=255, null=True)),
+                ('absolute_url', models.CharField(blank=True, editable=False, max_length=255, null=True)),
+                ('image_url', models.CharField(blank=True, editable=False, max_length=255, null=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('actor', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('content_type', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contenttypes.ContentType')),
+            ],
+            options={
+                'verbose_name_plural': 'archived actions',
+                'ordering': ['-timestamp'],
+                'get_latest_by': 'timestamp',
+            },
+            bases=(activity_monitor.models.ActivityDisplayMixin, models.Model),
+        ),
+        migrations.AddIndex(
+            model_name='archivedactivity',
+            index=models.Index(fields=['timestamp', 'id'], name='archived_timestamp_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedactivity',
+            index=models.Index(fields=['actor', 'timestamp'], name='archived_actor_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedactivity',
+            index=models.Index(fields=['content_type', 'timestamp'], name='archived_ct_timestamp_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='archivedactivity',
+            unique_together={('content_type', 'object_id')},
+        ),
+    ]
@@ -4,58 +4,25 @@ from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.utils.functional import cached_property
 
-from .managers import ActivityItemManager
+from . import caching, coalescing, routing
+from .managers import ActivityItemManager, ArchiveManager, OutboxManager, RollupManager, RoutedQuerySet
+from .utils import get_absolute_url, get_image, get_image_url
 
 
-class Activity(models.Model):
+class ActivityDisplayMixin(object):
     """
-    Stores an action that occurred that is being tracked
-    according to ACTIVITY_MONITOR settings.
+    How an activity is shown, shared by live and archived activities.
     """
-    actor = models.ForeignKey(
-        settings.AUTH_USER_MODEL,
-        related_name="subject",
-        on_delete="CASCADE"
-    )
-    timestamp = models.DateTimeField()
-
-    verb = models.CharField(blank=True, null=True, max_length=255, editable=False)
-    override_string = models.CharField(blank=True, null=True, max_length=255, editable=False)
-
-    target = models.CharField(blank=True, null=True, max_length=255, editable=False)
-    actor_name = models.CharField(blank=True, null=True, max_length=255, editable=False)
-
-    content_object = GenericForeignKey()
-    content_type = models.ForeignKey(ContentType, on_delete="CASCADE")
-    object_id = models.PositiveIntegerField()
-
-    objects = ActivityItemManager()
-
-    class Meta:
-        ordering = ['-timestamp']
-        unique_together = [('content_type', 'object_id')]
-        get_latest_by = 'timestamp'
-        verbose_name_plural = 'actions'
-
     def __unicode__(self):
         return "{0}: {1}".format(self.content_type.model_class().__name__, self.content_object)
 
-    def save(self, *args, **kwargs):
-        """
-        Store a string representation of content_object as target
-        and actor name for fast retrieval and sorting.
-        """
-        if not self.target:
-            self.target = str(self.content_object)
-        if not self.actor_name:
-            self.actor_name = str(self.actor)
-        super(Activity, self).save()
-
     def get_absolute_url(self):
         """
         Use original content object's
-        get_absolute_url method.
+        get_absolute_url method, as stored when the activity was written.
         """
+        if self.absolute_url:
+            return self.absolute_url
         return self.content_object.get_absolute_url()
 
     @cached_property
@@ -68,10 +35,10 @@ class Activity(models.Model):
         [actor] [verb] or
         "Joe cool posted a comment"
         """
-        output = "{0} ".format(self.actor)
+        output = "{0} ".format(self.actor_name or self.actor)
         if self.override_string:
             output += self.override_string
-        else:
+        elif self.verb:
             output += self.verb
         return output
 
@@ -84,7 +51,7 @@ class Activity(models.Model):
         [actor] [verb] [content object/target] or
         Joe cool posted a new topic: "my new topic"
         """
-        output = "{} {}".format(self.short_action_string, self.content_object)
+        output = "{} {}".format(self.short_action_string, self.target or self.content_object)
         return output
 
     @cached_property
@@ -101,31 +68,230 @@ class Activity(models.Model):
 
         Note that this expects the image only. Anything related (caption, etc) should be stripped.
 
+        For just the URL, use image_url, which is stored on the activity itself.
         """
-        obj = self.content_object
-        # First, try to get from a get_image() helper method
-        try:
-            image = obj.get_image()
-        except AttributeError:
-            try:
-                image = obj.content_object.get_image()
-            except:
-                image = None
-
-        # if we didn't find one, try to get it from foo.image
-        # This allows get_image to take precedence for greater control.
-        if not image:
-            try:
-                image = obj.image
-            except AttributeError:
-                try:
-                    image = obj.content_object.image
-                except:
-                    return None
-
-        # Finally, ensure we're getting an image, not an image object
-        # with caption and byline and other things.
-        try:
-            return image.image
-        except AttributeError:
-            return image
+        return get_image(self.content_object)
+
+
+class Activity(ActivityDisplayMixin, models.Model):
+    """
+    Stores an action that occurred that is being tracked
+    according to ACTIVITY_MONITOR settings.
+    """
+    # The composite indexes in Meta lead with actor and content_type,
+    # so the foreign keys don't need indexes of their own.
+    actor = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name="subject",
+        on_delete=models.CASCADE,
+        db_index=False
+    )
+    timestamp = models.DateTimeField()
+
+    verb = models.CharField(blank=True, null=True, max_length=255, editable=False)
+    override_string = models.CharField(blank=True, null=True, max_length=255, editable=False)
+
+    target = models.CharField(blank=True, null=True, max_length=255, editable=False)
+    actor_name = models.CharField(blank=True, null=True, max_length=255, editable=False)
+    absolute_url = models.CharField(blank=True, null=True, max_length=255, editable=False)
+    image_url = models.CharField(blank=True, null=True, max_length=255, editable=False)
+
+    content_object = GenericForeignKey()
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, db_index=False)
+    object_id = models.PositiveIntegerField()
+
+    objects = ActivityItemManager()
+
+    class Meta:
+        ordering = ['-timestamp']
+        unique_together = [('content_type', 'object_id')]
+        indexes = [
+            models.Index(fields=['timestamp', 'id'], name='activity_timestamp_id_idx'),
+            models.Index(fields=['actor', 'timestamp'], name='activity_actor_timestamp_idx'),
+            models.Index(fields=['content_type', 'timestamp'], name='activity_ct_timestamp_idx'),
+        ]
+        get_latest_by = 'timestamp'
+        verbose_name_plural = 'actions'
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Activity, cls).from_db(db, field_names, values)
+        # Where the rollups count it, so a save that moves it can move its count.
+        if 'verb' in field_names and 'timestamp' in field_names:
+            instance._counted_as = (instance.verb, instance.timestamp)
+        return instance
+
+    def save(self, *args, **kwargs):
+        """
+        Store a string representation of content_object as target,
+        actor name, URL and image URL for fast retrieval and sorting.
+        """
+        if not self.target:
+            self.target = str(self.content_object)[:255]
+        if not self.actor_name:
+            self.actor_name = str(self.actor)[:255]
+        if self.absolute_url is None:
+            self.absolute_url = get_absolute_url(self.content_object)
+        if self.image_url is None:
+            self.image_url = get_image_url(self.content_object)
+        adding = self._state.adding
+        kwargs['using'] = kwargs.get('using') or routing.db_for_write(self.__class__, instance=self)
+        super(Activity, self).save(*args, **kwargs)
+        if adding:
+            self._update_rollups(1)
+            self._counted_as = (self.verb, self.timestamp)
+            # An object with an activity here again no longer needs its archived one.
+            from .partitions import forget
+            forget(self.content_type_id, [self.object_id], self._state.db)
+        else:
+            self._move_rollups(kwargs.get('update_fields'))
+            caching.invalidate(self._state.db)
+            coalescing.forget_all(self._state.db)
+
+    def delete(self, *args, **kwargs):
+        kwargs['using'] = kwargs.get('using') or routing.db_for_write(self.__class__, instance=self)
+        deleted = super(Activity, self).delete(*args, **kwargs)
+        self._update_rollups(-1, kwargs['using'])
+        coalescing.forget_all(kwargs['using'])
+        return deleted
+
+    def _move_rollups(self, update_fields=None):
+        """
+        Moves the activity's count from the day and verb it was loaded with to the ones just saved.
+        """
+        from .rollups import enabled
+        verb, timestamp = getattr(self, '_counted_as', (None, None))
+        saved = lambda name: update_fields is None or name in update_fields
+        new = (self.verb if saved('verb') else verb, self.timestamp if saved('timestamp') else timestamp)
+        if enabled() and timestamp is not None:
+            ActivityRollup.objects.apply([
+                (self.content_type_id, verb, timestamp, -1),
+                (self.content_type_id, new[0], new[1], 1),
+            ], using=self._state.db)
+        self._counted_as = new
+
+    def _update_rollups(self, delta, using=None):
+        from .rollups import enabled
+        if enabled():
+            ActivityRollup.objects.apply(
+                [(self.content_type_id, self.verb, self.timestamp, delta)], using=using or self._state.db
+            )
+        caching.invalidate(using or self._state.db)
+
+
+class ArchivedActivity(ActivityDisplayMixin, models.Model):
+    """
+    An activity from a month the archive_activity command has moved out of the
+    activity table, when ACTIVITY_MONITOR_HOT_MONTHS is set. It keeps its id.
+    """
+    actor = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name="+",
+        on_delete=models.CASCADE,
+        db_index=False
+    )
+    timestamp = models.DateTimeField()
+
+    verb = models.CharField(blank=True, null=True, max_length=255, editable=False)
+    override_string = models.CharField(blank=True, null=True, max_length=255, editable=False)
+
+    target = models.CharField(blank=True, null=True, max_length=255, editable=False)
+    actor_name = models.CharField(blank=True, null=True, max_length=255, editable=False)
+    absolute_url = models.CharField(blank=True, null=True, max_length=255, editable=False)
+    image_url = models.CharField(blank=True, null=True, max_length=255, editable=False)
+
+    content_object = GenericForeignKey()
+    content_type = models.ForeignKey(ContentType, related_name="+", on_delete=models.CASCADE, db_index=False)
+    object_id = models.PositiveIntegerField()
+
+    objects = ArchiveManager()
+
+    class Meta:
+        ordering = ['-timestamp']
+        unique_together = [('content_type', 'object_id')]
+        indexes = [
+            models.Index(fields=['timestamp', 'id'], name='archived_timestamp_id_idx'),
+            models.Index(fields=['actor', 'timestamp'], name='archived_actor_timestamp_idx'),
+            models.Index(fields=['content_type', 'timestamp'], name='archived_ct_timestamp_idx'),
+        ]
+        get_latest_by = 'timestamp'
+        verbose_name_plural = 'archived actions'
+
+
+class ArchivedMonth(models.Model):
+    """
+    A month whose activities have all been moved to the archive. Reads for
+    anything before the end of the latest archived month go to the archive.
+    """
+    # The first of the month.
+    month = models.DateField(unique=True)
+    count = models.IntegerField(default=0)
+    archived = models.DateTimeField(auto_now=True)
+
+    objects = models.Manager.from_queryset(RoutedQuerySet)()
+
+    class Meta:
+        ordering = ['-month']
+
+    def __str__(self):
+        return "{0:%Y-%m}: {1}".format(self.month, self.count)
+
+
+class ActivityOutbox(models.Model):
+    """
+    A note that a watched object was saved or deleted, written in place of the
+    activity itself when ACTIVITY_MONITOR_DEFERRED is set.
+    The drain_activity_outbox command turns these into activities in batches.
+    """
+    SAVE = 's'
+    DELETE = 'd'
+    OP_CHOICES = (
+        (SAVE, 'save'),
+        (DELETE, 'delete'),
+    )
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    op = models.CharField(max_length=1, choices=OP_CHOICES, default=SAVE)
+
+    objects = OutboxManager()
+
+    class Meta:
+        ordering = ['id']
+        verbose_name_plural = 'activity outbox'
+
+    def __str__(self):
+        return "{0} {1}:{2}".format(self.get_op_display(), self.content_type_id, self.object_id)
+
+
+class ActivityRollup(models.Model):
+    """
+    The number of activities of a content type and verb on a day, or in a month.
+    Kept up to date as activities are written and deleted;
+    the rebuild_activity_rollups command regenerates them.
+    """
+    DAY = 'd'
+    MONTH = 'm'
+    PERIOD_CHOICES = (
+        (DAY, 'day'),
+        (MONTH, 'month'),
+    )
+
+    period = models.CharField(max_length=1, choices=PERIOD_CHOICES)
+    # The day itself, or the first of the month.
+    date = models.DateField()
+    # The unique index leads with period and date, which is how rollups are read.
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, db_index=False)
+    verb = models.CharField(blank=True, default='', max_length=255)
+    count = models.IntegerField(default=0)
+
+    objects = RollupManager()
+
+    class Meta:
+        ordering = ['-date']
+        unique_together = [('period', 'date', 'content_type', 'verb')]
+
+    def __str__(self):
+        return "{0} {1} {2}{3}: {4}".format(
+            self.get_period_display(), self.date, self.content_type_id, self.verb, self.count
+        )
@@ -0,0 +1,83 @@
+"""
+Batch processing for the activity outbox.
+
+When ACTIVITY_MONITOR_DEFERRED is set, the signal handlers only record which
+objects were saved or deleted. drain() works through those records in id order,
+coalescing repeated events for the same object, and writes the resulting
+activities with a handful of set-based queries per batch.
+"""
+import datetime
+
+from collections import OrderedDict
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from activity_monitor import registry, routing
+from activity_monitor.models import Activity, ActivityOutbox
+
+
+def drain_batch(batch_size=500):
+    """
+    Processes up to batch_size outbox rows. Returns the number of rows consumed.
+    """
+    now = datetime.datetime.now()
+    with transaction.atomic(using=routing.db_for_write(ActivityOutbox)):
+        events = list(
+            ActivityOutbox.objects.select_for_update(skip_locked=True)
+            .order_by('id')
+            .values_list('id', 'content_type_id', 'object_id', 'op')[:batch_size]
+        )
+        if not events:
+            return 0
+
+        # Only the last event for each object matters.
+        latest = OrderedDict()
+        for event_id, content_type_id, object_id, op in events:
+            latest[(content_type_id, object_id)] = op
+
+        saves, deletes = {}, {}
+        for (content_type_id, object_id), op in latest.items():
+            bucket = saves if op == ActivityOutbox.SAVE else deletes
+            bucket.setdefault(content_type_id, []).append(object_id)
+
+        # Rows are upserted together when they leave the same fields alone on update.
+        rows = OrderedDict()
+        for content_type_id, object_ids in saves.items():
+            config = registry.get_config(ContentType.objects.get_for_id(content_type_id).model_class())
+            if config is None:
+                continue
+            # Using the configured manager does the manager check for the whole batch.
+            instances = config.get_queryset().in_bulk(object_ids)
+            for object_id in object_ids:
+                instance = instances.get(object_id)
+                if instance is None or not config.passes_check(instance):
+                    deletes.setdefault(content_type_id, []).append(object_id)
+                    continue
+                values = config.get_activity_values(instance, now)
+                if values is not None:
+                    rows.setdefault(config.create_only_fields, []).append((content_type_id, object_id, values))
+
+        # Through the manager, so archived activities for the objects go too.
+        for content_type_id, object_ids in deletes.items():
+            Activity.objects.delete_for_objects(ContentType.objects.get_for_id(content_type_id), object_ids)
+        for create_only, batch in rows.items():
+            Activity.objects.bulk_upsert(batch, create_only=create_only)
+
+        ActivityOutbox.objects.filter(id__in=[event[0] for event in events]).delete()
+    return len(events)
+
+
+def drain(batch_size=500, max_batches=None):
+    """
+    Drains the outbox until it is empty, or max_batches have been processed.
+    Returns the number of rows consumed.
+    """
+    total = batches = 0
+    while max_batches is None or batches < max_batches:
+        consumed = drain_batch(batch_size)
+        if not consumed:
+            break
+        total += consumed
+        batches += 1
+    return total
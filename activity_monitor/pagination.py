@@ -0,0 +1,180 @@
+"""
+Keyset (cursor) pagination for activity lists.
+
+Rather than OFFSET and a COUNT(*) of the whole table, each page is fetched
+with a WHERE on the (timestamp, id) of the last row seen, so a page deep in
+the archive costs the same as the first. Pages are addressed with opaque
+cursor tokens instead of numbers.
+"""
+import base64
+import binascii
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+NEXT = 'n'
+PREVIOUS = 'p'
+# Cursors for following the stream of new activities, rather than paging the archive.
+AFTER = 'a'
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(direction, activity):
+    return make_cursor(direction, activity.timestamp, activity.pk)
+
+
+def make_cursor(direction, timestamp, pk):
+    value = '{}|{}|{}'.format(direction, timestamp.isoformat(), pk)
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (direction, timestamp, pk) held in a cursor token.
+    """
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        direction, timestamp, pk = value.split('|')
+        timestamp = parse_datetime(timestamp)
+        pk = int(pk)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise InvalidCursor(cursor)
+    if direction not in (NEXT, PREVIOUS) or timestamp is None:
+        raise InvalidCursor(cursor)
+    return direction, timestamp, pk
+
+
+def make_stream_cursor(pk):
+    """
+    Returns a token for the activities written after the one with the given id.
+    """
+    value = '{}|{}'.format(AFTER, pk)
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def decode_stream_cursor(cursor):
+    """
+    Returns the id held in a stream cursor. Page cursors, which hold a
+    timestamp as well, aren't stream cursors and raise InvalidCursor.
+    """
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        direction, pk = value.split('|')
+        pk = int(pk)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise InvalidCursor(cursor)
+    if direction != AFTER:
+        raise InvalidCursor(cursor)
+    return pk
+
+
+class CursorPage(object):
+    """
+    A page of activities. Quacks enough like django.core.paginator.Page for
+    templates written against ListView, except that the "page numbers"
+    are cursor tokens, to be passed back as ?cursor=.
+    """
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return '<CursorPage: {} activities>'.format(len(self))
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_page_number(self):
+        return self.next_cursor
+
+    def previous_page_number(self):
+        return self.previous_cursor
+
+
+class CursorPaginator(object):
+    """
+    Paginates a queryset of activities newest first, on (timestamp, id).
+    There is deliberately no count or num_pages: that would take the COUNT(*)
+    this is here to avoid.
+
+    older, if given, is a queryset of activities that all come after the queryset's,
+    such as the archived ones. Pages run on into it once the queryset runs out.
+    """
+    def __init__(self, queryset, per_page, older=None):
+        self.queryset = queryset.order_by('-timestamp', '-pk')
+        self.older = older
+        self.per_page = int(per_page)
+
+    def _fetch(self, condition=None, reverse=False):
+        """
+        Returns up to per_page + 1 rows matching condition, newest first or,
+        with reverse, oldest first, from the queryset and then older.
+        """
+        ordering = ('timestamp', 'pk') if reverse else ('-timestamp', '-pk')
+        querysets = [qs for qs in (self.queryset, self.older) if qs is not None]
+        if reverse:
+            querysets.reverse()
+        rows = []
+        for qs in querysets:
+            if condition is not None:
+                qs = qs.filter(condition)
+            rows.extend(qs.order_by(*ordering)[:self.per_page + 1 - len(rows)])
+            if len(rows) > self.per_page:
+                break
+        return rows
+
+    def page(self, cursor=None):
+        """
+        Returns the CursorPage for a cursor token, or the first page if there isn't one.
+        Raises InvalidCursor for tokens that can't be decoded.
+        """
+        if not cursor:
+            rows = self._fetch()
+            more = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            return CursorPage(rows, self, next_cursor=self._cursor(NEXT, rows, more))
+
+        direction, timestamp, pk = decode_cursor(cursor)
+        if direction == NEXT:
+            rows = self._fetch(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, pk__lt=pk))
+            more = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            return CursorPage(
+                rows, self,
+                next_cursor=self._cursor(NEXT, rows, more),
+                previous_cursor=self._cursor(PREVIOUS, rows, True),
+            )
+
+        rows = self._fetch(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, pk__gt=pk), reverse=True)
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page][::-1]
+        return CursorPage(
+            rows, self,
+            next_cursor=self._cursor(NEXT, rows, True),
+            previous_cursor=self._cursor(PREVIOUS, rows, more),
+        )
+
+    def _cursor(self, direction, rows, more):
+        if not rows or not more:
+            return None
+        return encode_cursor(direction, rows[-1] if direction == NEXT else rows[0])
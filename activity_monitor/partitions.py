@@ -0,0 +1,202 @@
+"""
+Optional time-partitioned storage: recent activities in the activity table,
+older months in an archive table.
+
+The month and day views, and the today view, only ever read a narrow slice of
+time, but the activity table can hold years of it. With
+ACTIVITY_MONITOR_HOT_MONTHS set, the archive_activity command moves every
+month before the last that many into ArchivedActivity, a month at a time,
+so the table the write path, feeds and today view use stays small.
+
+Each month is copied to the archive, recorded as an ArchivedMonth, and deleted
+from the activity table in one transaction, so whichever table it is read from
+holds all of it. Everything from before the boundary, the end of the latest archived
+month, is read from the archive and everything after it from the activity
+table. Activity.objects.for_period() picks the table from the boundary, which
+is kept in the cache.
+
+Archived activities keep their ids and their rollup counts. Deleting an object
+or its actor removes an archived activity as it would a live one, and an
+object that gets a new activity loses its archived one.
+"""
+import datetime
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import F, Max, Min
+
+from activity_monitor import caching, coalescing, routing
+from activity_monitor.models import Activity, ArchivedActivity, ArchivedMonth
+from activity_monitor.rollups import get_date, get_midnight
+
+BOUNDARY_KEY = 'activity_monitor:archive_boundary'
+DEFAULT_CHUNK_SIZE = 1000
+
+# The columns copied to the archive, ids included.
+FIELDS = [field.attname for field in Activity._meta.concrete_fields]
+
+
+def get_hot_months():
+    """
+    Returns ACTIVITY_MONITOR_HOT_MONTHS, the months kept in the activity table before
+    the current one, or None if activities are never archived.
+    """
+    months = getattr(settings, 'ACTIVITY_MONITOR_HOT_MONTHS', None)
+    if months is not None and (not isinstance(months, int) or months < 1):
+        raise ImproperlyConfigured("ACTIVITY_MONITOR_HOT_MONTHS should be a number of months, at least 1.")
+    return months
+
+
+def enabled():
+    return get_hot_months() is not None
+
+
+def add_months(month, count):
+    """
+    Returns the first of the month count months after month (or before, if count is negative).
+    """
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def get_horizon(today=None):
+    """
+    Returns the first day of the oldest month that stays in the activity table.
+    """
+    today = today or datetime.date.today()
+    return add_months(today, -get_hot_months())
+
+
+def get_boundary():
+    """
+    Returns the time before which activities are read from the archive,
+    or None if nothing has been archived or archiving is off.
+    """
+    if not enabled():
+        return None
+    cache = caching.get_cache()
+    boundary = cache.get(BOUNDARY_KEY)
+    if boundary is None:
+        month = ArchivedMonth.objects.aggregate(month=Max('month'))['month']
+        # An empty string caches "nothing archived yet".
+        boundary = get_midnight(add_months(month, 1)) if month else ''
+        cache.set(BOUNDARY_KEY, boundary, None)
+    return boundary or None
+
+
+def clear_boundary():
+    caching.get_cache().delete(BOUNDARY_KEY)
+
+
+def _as_datetime(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    return get_midnight(value)
+
+
+def _filter(queryset, start, end):
+    if start is not None:
+        queryset = queryset.filter(timestamp__gte=start)
+    if end is not None:
+        queryset = queryset.filter(timestamp__lt=end)
+    return queryset
+
+
+def for_period(start=None, end=None):
+    """
+    Returns the activities with start <= timestamp < end, where either bound may be
+    a date, a datetime or None, from whichever table holds them. A period on both
+    sides of the boundary is a union of the two, which can only be ordered,
+    sliced, counted and iterated over. Month and day periods never are.
+    """
+    start, end = _as_datetime(start), _as_datetime(end)
+    boundary = get_boundary()
+    if boundary is None or (start is not None and start >= boundary):
+        return _filter(Activity.objects.all(), start, end)
+    if end is not None and end <= boundary:
+        return _filter(ArchivedActivity.objects.all(), start, end)
+    # Neither half of a union can carry its own ordering.
+    return _filter(Activity.objects.order_by(), boundary, end).union(
+        _filter(ArchivedActivity.objects.order_by(), start, boundary), all=True
+    )
+
+
+def forget(content_type, object_ids, using=None):
+    """
+    Deletes any archived activities for objects that have one in the activity table again.
+    Returns the number deleted.
+    """
+    if not enabled():
+        return 0
+    return ArchivedActivity.objects.using(using or routing.db_for_write(ArchivedActivity)).filter(
+        content_type=content_type, object_id__in=list(object_ids)
+    ).delete()[0]
+
+
+def archive(horizon=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Moves the activities from before horizon, by default get_horizon(), to the archive,
+    a month at a time, oldest first. Yields (month, moved) for each month, ending with
+    the month before horizon even if it had nothing to move, so the boundary reaches it.
+    """
+    horizon = horizon or get_horizon()
+    db = routing.db_for_write(Activity)
+    oldest = Activity.objects.using(db).filter(
+        timestamp__lt=get_midnight(horizon)
+    ).aggregate(oldest=Min('timestamp'))['oldest']
+    month = get_date(oldest).replace(day=1) if oldest else add_months(horizon, -1)
+    while month < horizon:
+        yield month, archive_month(month, chunk_size, db)
+        month = add_months(month, 1)
+
+
+def archive_month(month, chunk_size=DEFAULT_CHUNK_SIZE, using=None):
+    """
+    Copies a month's activities to the archive chunk_size at a time, records the month,
+    then deletes what was copied from the activity table, all in one transaction, so an
+    interrupted run leaves the month where it was. Returns the number moved.
+
+    Rows already in the archive aren't copied again. An object with an activity in both
+    tables raises IntegrityError rather than losing either.
+    """
+    db = using or routing.db_for_write(Activity)
+    rows = Activity.objects.using(db).filter(
+        timestamp__gte=get_midnight(month), timestamp__lt=get_midnight(add_months(month, 1))
+    ).order_by('pk')
+
+    with transaction.atomic(using=db):
+        ranges = []
+        moved = 0
+        while True:
+            chunk = list(rows.filter(pk__gt=ranges[-1][1] if ranges else 0).values(*FIELDS)[:chunk_size])
+            if not chunk:
+                break
+            ranges.append((chunk[0]['id'], chunk[-1]['id']))
+            copied = set(ArchivedActivity.objects.using(db).filter(
+                pk__gte=ranges[-1][0], pk__lte=ranges[-1][1]
+            ).values_list('pk', flat=True))
+            ArchivedActivity.objects.using(db).bulk_create(
+                [ArchivedActivity(**row) for row in chunk if row['id'] not in copied]
+            )
+            moved += len(chunk)
+
+        record, created = ArchivedMonth.objects.using(db).get_or_create(month=month, defaults={'count': moved})
+        if not created and moved:
+            ArchivedMonth.objects.using(db).filter(pk=record.pk).update(count=F('count') + moved)
+
+        # Only what made it to the archive is deleted. The rollups already count it where it is now.
+        for low, high in ranges:
+            rows.filter(pk__gte=low, pk__lte=high, pk__in=ArchivedActivity.objects.using(db).filter(
+                pk__gte=low, pk__lte=high
+            ).values('pk'))._raw_delete(db)
+
+        # Other connections may cache the old boundary until the move commits,
+        # so it's cleared again then.
+        clear_boundary()
+        transaction.on_commit(clear_boundary, using=db)
+        # A raw delete skips the queryset's own invalidation.
+        if moved:
+            caching.invalidate(db)
+            coalescing.forget_all(db)
+    return moved
@@ -0,0 +1,250 @@
+"""
+Precompiled configuration for the models listed in settings.ACTIVITY_MONITOR_MODELS.
+
+Each watched model is normalized once, when it is registered, into an
+ActivityModelConfig. The signal handlers then only need a single dict lookup
+on the sender to know how to build an activity, rather than walking the
+settings on every save.
+"""
+import datetime
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.utils.functional import cached_property
+
+from activity_monitor.utils import MAX_LENGTH, get_absolute_url, get_image_url
+
+DEFAULT_DATE_FIELD = 'created'
+DEFAULT_MANAGER = 'objects'
+DEFAULT_USER_FIELD = 'user'
+
+# Saves of anything older than this are assumed to be edits, not new activity.
+MAX_AGE = datetime.timedelta(days=3)
+
+# Models that are themselves the actor, such as auth.user or a custom profile.
+SELF_USER_MODELS = ('user', 'profile')
+
+_registry = {}
+
+
+class ActivityModelConfig(object):
+    """
+    Normalized, validated settings for a single watched model.
+    """
+    def __init__(self, model, setting):
+        self.model = model
+        self.app_label = model._meta.app_label
+        self.model_name = model._meta.model_name
+        self.label = '{}.{}'.format(self.app_label, self.model_name)
+
+        self.verb = setting.get('verb', None)
+        self.override_string = setting.get('override_string', None)
+        self.check = setting.get('check', None)
+        self.manager = setting.get('manager', DEFAULT_MANAGER)
+        self.filter_superuser = 'filter_superuser' in setting
+        self.filter_staff = 'filter_staff' in setting
+        # Days to keep activities for before prune_activity removes them. None keeps them.
+        self.retention = setting.get('retention', None)
+
+        # What field denotes the activity time? "created" is the default,
+        # and failing that we'll use the current time.
+        if 'date_field' in setting:
+            self.date_field = setting['date_field']
+        elif hasattr(model, DEFAULT_DATE_FIELD):
+            self.date_field = DEFAULT_DATE_FIELD
+        else:
+            self.date_field = None
+        # Without a date field an activity is dated by its first save, and later saves keep that time.
+        self.create_only_fields = () if self.date_field else ('timestamp',)
+
+        # A user_field of None means the instance is the actor.
+        if 'user_field' in setting:
+            self.user_field = setting['user_field']
+        elif self.model_name in SELF_USER_MODELS:
+            self.user_field = None
+        else:
+            self.user_field = DEFAULT_USER_FIELD
+
+        self.validate()
+
+    def __repr__(self):
+        return '<ActivityModelConfig: {}>'.format(self.label)
+
+    def validate(self):
+        """
+        Make sure every field and manager named in the setting exists on the model,
+        so misconfiguration shows up at startup rather than on the first save.
+        """
+        for option in ('date_field', 'user_field', 'check', 'manager'):
+            name = getattr(self, option)
+            if name and not hasattr(self.model, name):
+                raise ImproperlyConfigured(
+                    "ACTIVITY_MONITOR_MODELS: {} has no {} '{}'.".format(self.label, option, name)
+                )
+        if self.retention is not None and (not isinstance(self.retention, int) or self.retention < 1):
+            raise ImproperlyConfigured(
+                "ACTIVITY_MONITOR_MODELS: {} retention should be a number of days.".format(self.label)
+            )
+
+    @cached_property
+    def content_type(self):
+        # Looked up on first use, rather than at registration, which has to work without a database.
+        return ContentType.objects.get_for_model(self.model)
+
+    @cached_property
+    def uses_default_manager(self):
+        """
+        True if the configured manager is the model's default manager,
+        which we can trust to contain any instance that was just saved.
+        """
+        return getattr(self.model, self.manager) is self.model._default_manager
+
+    def get_queryset(self):
+        """
+        Returns a queryset from the configured manager, following the user field
+        in the same query when it's a foreign key.
+        """
+        qs = getattr(self.model, self.manager).all()
+        if self.user_field:
+            try:
+                field = self.model._meta.get_field(self.user_field)
+            except FieldDoesNotExist:
+                return qs
+            if field.many_to_one:
+                qs = qs.select_related(self.user_field)
+        return qs
+
+    def get_timestamp(self, instance, now=None):
+        """
+        Returns the activity time for the instance as a datetime,
+        normalizing plain dates out to midnight.
+        """
+        now = now or datetime.datetime.now()
+        if not self.date_field:
+            return now
+        timestamp = getattr(instance, self.date_field)
+        if timestamp is None or isinstance(timestamp, datetime.datetime):
+            return timestamp
+        return datetime.datetime.combine(timestamp, datetime.time())
+
+    def get_user(self, instance):
+        """
+        Returns the actor for the instance.
+        """
+        if self.user_field is None:
+            return instance
+        return getattr(instance, self.user_field)
+
+    @cached_property
+    def user_attname(self):
+        """
+        The attribute holding the user's id, if the user field is a foreign key.
+        """
+        if not self.user_field:
+            return None
+        try:
+            field = self.model._meta.get_field(self.user_field)
+        except FieldDoesNotExist:
+            return None
+        return field.attname if field.many_to_one else None
+
+    def get_user_key(self, instance):
+        """
+        Identifies the instance's actor, without fetching it when the user field is a foreign key.
+        """
+        if self.user_field is None:
+            return instance.pk
+        if self.user_attname:
+            return getattr(instance, self.user_attname)
+        user = self.get_user(instance)
+        return getattr(user, 'pk', user)
+
+    def passes_check(self, instance):
+        """
+        Uses the boolean 'check' field to decide if the instance should have an activity at all.
+        """
+        return not (self.check and getattr(instance, self.check) is False)
+
+    def get_activity_values(self, instance, now=None, max_age=MAX_AGE):
+        """
+        Returns the field values for the instance's activity,
+        or None if this save shouldn't register one.
+        Pass max_age=None to accept old content, as when backfilling.
+
+        Neither the check field nor the manager is considered here;
+        both of those mean deleting an existing activity, so are left to the caller.
+        """
+        now = now or datetime.datetime.now()
+        timestamp = self.get_timestamp(instance, now)
+        user = self.get_user(instance)
+
+        # BAIL-OUT CHECKS
+        # Determine all the reasons we would want to bail out.
+        # Make sure it's not a future item, like a future-published blog entry.
+        if not timestamp or timestamp > now:
+            return None
+        # or some really old content that was just re-saved for some reason
+        if max_age is not None and timestamp < (now - max_age):
+            return None
+        # or there's not a user object
+        if not user:
+            return None
+        # or the user is god or staff, and we're filtering out, don't add to monitor
+        if user.is_superuser and self.filter_superuser:
+            return None
+        if user.is_staff and self.filter_staff:
+            return None
+
+        # build a default string representation
+        # note that each activity can get back to the object via get_absolute_url()
+        # The URL and image are stored too, so feeds can render from the activity alone.
+        return {
+            'actor': user,
+            'actor_name': str(user)[:MAX_LENGTH],
+            'target': str(instance)[:MAX_LENGTH],
+            'timestamp': timestamp,
+            'verb': self.verb,
+            'override_string': self.override_string,
+            'absolute_url': get_absolute_url(instance),
+            'image_url': get_image_url(instance),
+        }
+
+
+def register(model, setting):
+    """
+    Builds and stores the config for a model from its ACTIVITY_MONITOR_MODELS entry.
+    """
+    config = ActivityModelConfig(model, setting)
+    _registry[model] = config
+    return config
+
+
+def get_config(model):
+    """
+    Returns the config for a watched model, or None if it isn't watched.
+    """
+    return _registry.get(model)
+
+
+def get_config_for_label(label):
+    """
+    Returns the config for a watched model given as "app_label.model".
+    """
+    label = label.lower()
+    for config in _registry.values():
+        if config.label == label:
+            return config
+    return None
+
+
+def get_configs():
+    return list(_registry.values())
+
+
+def clear_content_types(**kwargs):
+    """
+    Forgets the content types looked up so far, as their ids can change when
+    the database is migrated or flushed.
+    """
+    for config in _registry.values():
+        config.__dict__.pop('content_type', None)
@@ -0,0 +1,167 @@
+"""
+Prunes activities older than their model's retention, optionally archiving them first.
+
+A watched model's 'retention' in ACTIVITY_MONITOR_MODELS, or
+ACTIVITY_MONITOR_RETENTION for models without one, is a number of days.
+Expired activities are deleted in primary key ranges of at most chunk_size
+rows, each in its own short transaction, so no statement holds its locks for
+long and an interrupted run keeps everything it has done. The deletes go
+through the activity queryset, so the rollups, cached tags and coalescing
+fingerprints stay in step. Archived activities (see activity_monitor.partitions)
+are pruned the same way.
+
+Archives are gzipped NDJSON, one activity per line, with the content type
+written as "app_label.model" so that a file can be restored into another
+database, where its ids may differ.
+"""
+import datetime
+import json
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from activity_monitor import caching, rollups, routing
+from activity_monitor.models import Activity, ActivityRollup, ArchivedActivity
+
+ARCHIVE_FIELDS = (
+    'id', 'actor_id', 'actor_name', 'content_type_id', 'object_id', 'timestamp',
+    'verb', 'override_string', 'target', 'absolute_url', 'image_url',
+)
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def get_retention(config):
+    """
+    Returns the days a model's activities are kept for, or None to keep them forever.
+    """
+    if config.retention is not None:
+        return config.retention
+    return getattr(settings, 'ACTIVITY_MONITOR_RETENTION', None)
+
+
+def get_cutoff(config, now=None):
+    """
+    Returns the time before which a model's activities have expired, or None if they don't.
+    """
+    days = get_retention(config)
+    if days is None:
+        return None
+    return (now or datetime.datetime.now()) - datetime.timedelta(days=days)
+
+
+def get_expired(config, cutoff, model=Activity):
+    return model.objects.filter(content_type=config.content_type, timestamp__lt=cutoff)
+
+
+def count_expired(config, cutoff):
+    return sum(get_expired(config, cutoff, model).count() for model in (Activity, ArchivedActivity))
+
+
+def prune(config, cutoff, chunk_size=DEFAULT_CHUNK_SIZE, archive=None):
+    """
+    Deletes a model's activities from before cutoff, a primary key range of at most
+    chunk_size of them at a time, yielding the number deleted from each range.
+    With an open archive file, each range is written to it before it's deleted.
+    """
+    for model in (Activity, ArchivedActivity):
+        for deleted in _prune(get_expired(config, cutoff, model), chunk_size, archive):
+            yield deleted
+
+
+def _prune(expired, chunk_size, archive):
+    db = routing.db_for_write(expired.model)
+    expired = expired.using(db).order_by('pk')
+    last = 0
+    while True:
+        pks = list(expired.filter(pk__gt=last).values_list('pk', flat=True)[:chunk_size])
+        if not pks:
+            return
+        chunk = expired.filter(pk__gte=pks[0], pk__lte=pks[-1])
+        if archive is None:
+            # The delete, with its rollup changes, is a transaction of its own.
+            deleted = chunk.delete()[0]
+        else:
+            with transaction.atomic(using=db):
+                # Locked, where the backend can, so the archive holds exactly what's deleted.
+                write_archive(archive, chunk.select_for_update().values(*ARCHIVE_FIELDS))
+                deleted = chunk.delete()[0]
+        last = pks[-1]
+        yield deleted
+
+
+def write_archive(archive, rows):
+    """
+    Writes activity rows, as dicts of ARCHIVE_FIELDS, to an open text file as NDJSON.
+    """
+    for row in rows:
+        content_type = ContentType.objects.get_for_id(row.pop('content_type_id'))
+        row['content_type'] = '{}.{}'.format(content_type.app_label, content_type.model)
+        row['timestamp'] = row['timestamp'].isoformat()
+        archive.write(json.dumps(row) + '\n')
+
+
+def restore(lines, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Loads archived activities back from NDJSON lines, chunk_size at a time,
+    yielding (read, restored) for each chunk.
+    """
+    chunk = []
+    for line in lines:
+        if line.strip():
+            chunk.append(json.loads(line))
+        if len(chunk) >= chunk_size:
+            yield len(chunk), restore_chunk(chunk)
+            chunk = []
+    if chunk:
+        yield len(chunk), restore_chunk(chunk)
+
+
+def restore_chunk(rows):
+    """
+    Inserts a chunk of archived activities and adds them to the rollups. Activities for
+    objects that have one again, in either the activity table or the partition archive,
+    or whose actor is gone, are skipped, and any whose id has been taken in the meantime
+    get a new one. Returns the number restored.
+    """
+    db = routing.db_for_write(Activity)
+    activities = {}
+    for row in rows:
+        content_type = ContentType.objects.db_manager(db).get_by_natural_key(*row.pop('content_type').split('.'))
+        row['timestamp'] = parse_datetime(row['timestamp'])
+        activity = Activity(content_type=content_type, **row)
+        # A file added to by several runs can hold an object more than once; the last one wins.
+        activities[(activity.content_type_id, activity.object_id)] = activity
+    User = Activity._meta.get_field('actor').remote_field.model
+
+    with transaction.atomic(using=db):
+        existing = set()
+        for model in (Activity, ArchivedActivity):
+            existing.update(model.objects.using(db).order_by().filter(
+                content_type_id__in=set(key[0] for key in activities),
+                object_id__in=set(key[1] for key in activities),
+            ).values_list('content_type_id', 'object_id'))
+        actors = set(User._default_manager.using(db).filter(
+            pk__in=set(activity.actor_id for activity in activities.values())
+        ).values_list('pk', flat=True))
+        new = [
+            activity for key, activity in activities.items()
+            if key not in existing and activity.actor_id in actors
+        ]
+        taken = set()
+        for model in (Activity, ArchivedActivity):
+            taken.update(model.objects.using(db).filter(
+                pk__in=[activity.pk for activity in new]
+            ).values_list('pk', flat=True))
+        for activity in new:
+            if activity.pk in taken:
+                activity.pk = None
+        Activity.objects.using(db).bulk_create(new)
+        if rollups.enabled():
+            ActivityRollup.objects.apply(
+                ((activity.content_type_id, activity.verb, activity.timestamp, 1) for activity in new), using=db
+            )
+        if new:
+            caching.invalidate(db)
+    return len(new)
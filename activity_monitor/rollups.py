@@ -0,0 +1,171 @@
+"""
+Per-day and per-month activity counts, by content type and verb.
+
+Counting a period straight from the activity table costs a scan of every
+row in it. The ActivityRollup table holds those counts instead: creating an
+activity adds one to its day and month, and deleting activities through a
+queryset takes them off again in the same transaction. Counts then cost a
+row per day (or month) rather than a row per activity.
+
+Upserts and saves that move an existing activity to another day or verb
+move its count with it. Changes that bypass the ORM aren't tracked;
+rebuild() (and the rebuild_activity_rollups command) regenerates the counts
+from the activities themselves.
+"""
+import datetime
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from activity_monitor import caching, routing
+from activity_monitor.models import Activity, ActivityRollup, ArchivedActivity
+
+
+def enabled():
+    """
+    Rollups are only maintained when ACTIVITY_MONITOR_ROLLUPS is set, since they cost
+    every new activity a query, and every change to an activity a read of its old day and verb.
+    """
+    return getattr(settings, 'ACTIVITY_MONITOR_ROLLUPS', False)
+
+
+def get_date(timestamp):
+    """
+    Returns the (local) day a timestamp falls on.
+    """
+    if isinstance(timestamp, datetime.datetime):
+        if timezone.is_aware(timestamp):
+            timestamp = timezone.localtime(timestamp)
+        return timestamp.date()
+    return timestamp
+
+
+def get_midnight(day):
+    """
+    Returns the datetime a day starts at, made aware if USE_TZ is on.
+    """
+    midnight = datetime.datetime.combine(day, datetime.time())
+    if settings.USE_TZ:
+        midnight = timezone.make_aware(midnight)
+    return midnight
+
+
+def get_changes(queryset, sign=1):
+    """
+    Returns the (content_type_id, verb, day, delta) rollup changes for a queryset of
+    activities, counted in the database. Pass sign=-1 for activities about to be deleted.
+    """
+    rows = queryset.order_by().values(
+        'content_type_id', 'verb', day=TruncDate('timestamp')
+    ).annotate(total=Count('pk'))
+    return [
+        (row['content_type_id'], row['verb'], row['day'], sign * row['total'])
+        for row in rows
+    ]
+
+
+def count_since(start):
+    """
+    Counts the activities from start, a date or datetime, onwards.
+
+    Whole days are summed from the day rollups. A start part way through a day
+    leaves only the rest of that first day to be counted from the activities.
+    """
+    if not enabled():
+        return Activity.objects.filter(timestamp__gte=start).count()
+
+    first_day = get_date(start)
+    partial = 0
+    if isinstance(start, datetime.datetime) and start != get_midnight(first_day):
+        first_day += datetime.timedelta(days=1)
+        partial = Activity.objects.filter(
+            timestamp__gte=start, timestamp__lt=get_midnight(first_day)
+        ).count()
+    total = ActivityRollup.objects.filter(
+        period=ActivityRollup.DAY, date__gte=first_day
+    ).aggregate(total=Sum('count'))['total']
+    return partial + (total or 0)
+
+
+def get_day_counts(start, end):
+    """
+    Returns an OrderedDict of {date: count} for the days in [start, end) with any activity.
+    """
+    rows = ActivityRollup.objects.filter(
+        period=ActivityRollup.DAY, date__gte=start, date__lt=end
+    ).values('date').annotate(total=Sum('count')).filter(total__gt=0).order_by('date')
+    return OrderedDict((row['date'], row['total']) for row in rows)
+
+
+def days_with_activity(start, end):
+    """
+    Returns the dates in [start, end) with any activity, oldest first.
+    With rollups turned off, they're read from the activities themselves.
+    """
+    if not enabled():
+        days = Activity.objects.for_period(get_midnight(start), get_midnight(end)).annotate(
+            day=TruncDate('timestamp')
+        ).order_by('day').values_list('day', flat=True).distinct()
+        return list(days)
+    return list(get_day_counts(start, end))
+
+
+def get_adjacent_days(day, today=None):
+    """
+    Returns the closest days before and after day that have any activity,
+    as (previous_day, next_day). Either is None if there isn't one;
+    next_day is never later than today.
+
+    With rollups turned off, these are simply the day before and the day after.
+    """
+    today = today or datetime.date.today()
+    if not enabled():
+        previous_day = day - datetime.timedelta(days=1)
+        next_day = None if day >= today else day + datetime.timedelta(days=1)
+        return previous_day, next_day
+
+    days = ActivityRollup.objects.filter(period=ActivityRollup.DAY, count__gt=0).values_list('date', flat=True)
+    previous_day = days.filter(date__lt=day).order_by('-date').first()
+    next_day = None
+    if day < today:
+        next_day = days.filter(date__gt=day, date__lte=today).order_by('date').first()
+    return previous_day, next_day
+
+
+def rebuild(since=None):
+    """
+    Regenerates the rollups from the activities, either entirely or from the
+    month that since falls in onwards. Returns the number of rollup rows written.
+    """
+    # Counted from the write database, rather than a replica that may be behind.
+    db = routing.db_for_write(ActivityRollup)
+    activities = Activity.objects.using(db)
+    archived = ArchivedActivity.objects.using(db)
+    rollups = ActivityRollup.objects.using(db)
+    if since:
+        since = get_date(since).replace(day=1)
+        activities = activities.filter(timestamp__gte=get_midnight(since))
+        archived = archived.filter(timestamp__gte=get_midnight(since))
+        rollups = rollups.filter(date__gte=since)
+
+    totals = OrderedDict()
+    # Archived activities are still counted.
+    for content_type_id, verb, day, total in get_changes(activities) + get_changes(archived):
+        verb = verb or ''
+        for key in ((ActivityRollup.DAY, day), (ActivityRollup.MONTH, day.replace(day=1))):
+            key += (content_type_id, verb)
+            totals[key] = totals.get(key, 0) + total
+
+    with transaction.atomic(using=db):
+        rollups.delete()
+        ActivityRollup.objects.using(db).bulk_create([
+            ActivityRollup(period=period, date=date, content_type_id=content_type_id, verb=verb, count=total)
+            for (period, date, content_type_id, verb), total in totals.items()
+        ], batch_size=500)
+        caching.invalidate(db)
+    return len(totals)
@@ -0,0 +1,72 @@
+"""
+Which database activities are read from and written to.
+
+By default, that's up to the project's DATABASE_ROUTERS, like any other model.
+ACTIVITY_MONITOR_READ_DATABASE and ACTIVITY_MONITOR_WRITE_DATABASE name
+database aliases to use instead, so feeds, lists and counts can be served from
+a replica while writes go to the primary.
+
+Once a thread has written activities to the write database, its reads stick to
+the write database too, so a request sees the activity it just created rather
+than a replica that hasn't caught up. Stickiness ends with the request; wrap
+anything else that writes and then reads, such as a task or a management
+command's loop, in sticky_reads().
+"""
+import contextlib
+import threading
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db import router
+from django.dispatch import receiver
+
+_local = threading.local()
+
+
+def db_for_read(model, **hints):
+    if getattr(_local, 'pinned', None):
+        return _local.pinned
+    alias = getattr(settings, 'ACTIVITY_MONITOR_READ_DATABASE', None)
+    return alias or router.db_for_read(model, **hints)
+
+
+def db_for_write(model, **hints):
+    return getattr(settings, 'ACTIVITY_MONITOR_WRITE_DATABASE', None) or router.db_for_write(model, **hints)
+
+
+def pin(using):
+    """
+    Sticks this thread's reads to using, which activities have just been written to,
+    if reads would otherwise go somewhere else.
+    """
+    if getattr(settings, 'ACTIVITY_MONITOR_READ_DATABASE', None) not in (None, using):
+        _local.pinned = using
+
+
+def is_pinned():
+    """
+    True if this thread's reads are stuck to the write database.
+    """
+    return bool(getattr(_local, 'pinned', None))
+
+
+@receiver(request_started)
+@receiver(request_finished)
+def unpin(**kwargs):
+    """
+    Lets this thread read from the read database again.
+    """
+    _local.pinned = None
+
+
+@contextlib.contextmanager
+def sticky_reads():
+    """
+    Scopes read-your-writes stickiness to a block, or a function it decorates,
+    the way a request does for views.
+    """
+    unpin()
+    try:
+        yield
+    finally:
+        unpin()
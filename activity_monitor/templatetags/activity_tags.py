@@ -1,8 +1,13 @@
 import datetime
 
 from django import template
-from django.template import loader, Context
+from django.contrib.contenttypes.models import ContentType
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template import loader
+from django.utils.safestring import mark_safe
 
+from activity_monitor import caching, rollups
 from activity_monitor.models import Activity
 from activity_monitor.utils import group_activities
 
@@ -34,6 +39,35 @@ def join_and(value):
     return "%s and %s" % (all_but_last, value[-1])
 
 
+# Snippet templates (or None, where there isn't one) by template name.
+_activity_templates = {}
+
+
+@receiver(setting_changed)
+def clear_activity_templates(setting, **kwargs):
+    if setting in ('TEMPLATES', 'INSTALLED_APPS'):
+        _activity_templates.clear()
+
+
+def get_activity_template(activity):
+    """
+    Returns the snippet template for an activity's content type, or None if it hasn't got one.
+    Both are remembered, so the template directories are only searched once per content type.
+    """
+    content_type = ContentType.objects.get_for_id(activity.content_type_id)
+    template_name = 'activity_monitor/includes/models/{0.app_label}_{0.model}.html'.format(content_type)
+    try:
+        return _activity_templates[template_name]
+    except KeyError:
+        pass
+    try:
+        tmpl = loader.get_template(template_name)
+    except template.TemplateDoesNotExist:
+        tmpl = None
+    _activity_templates[template_name] = tmpl
+    return tmpl
+
+
 @register.simple_tag
 def render_activity(activity, grouped_activity=None, *args, **kwargs):
     """
@@ -43,35 +77,43 @@ def render_activity(activity, grouped_activity=None, *args, **kwargs):
 
     Also takes an optional 'grouped_activity' argument that would match up with
     what is produced by utils.group_activity
+
+    Pass timeout (or set ACTIVITY_MONITOR_FRAGMENT_TIMEOUT) to cache the rendered
+    snippet, until the activity changes.
     """
-    template_name = 'activity_monitor/includes/models/{0.app_label}_{0.model}.html'.format(activity.content_type)
-    try:
-        tmpl = loader.get_template(template_name)
-    except template.TemplateDoesNotExist:
+    tmpl = get_activity_template(activity)
+    if tmpl is None:
         return None
+
     # we know we have a template, so render it
-    content_object = activity.content_object
-    return tmpl.render(Context({
-        'activity': activity,
-        'obj': content_object,
-        'grouped_activity': grouped_activity
-    }))
+    def render():
+        return tmpl.render({
+            'activity': activity,
+            'obj': activity.content_object,
+            'grouped_activity': grouped_activity
+        })
+    return mark_safe(caching.get_or_set_fragment(
+        activity, (tmpl.origin.name, grouped_activity), render, kwargs.get('timeout')
+    ))
 
 
 @register.simple_tag
-def show_activity_count(date=None):
+def show_activity_count(date=None, timeout=None):
     """
     Simple filter to get activity count for a given day.
     Defaults to today.
+
+    Counted from the daily rollups, so only a partial first day touches the activities.
+    The count is cached until activity changes, or for timeout seconds.
     """
-    if not date:
-        today = datetime.datetime.now() - datetime.timedelta(hours = 24)
-        return Activity.objects.filter(timestamp__gte=today).count()
-    return Activity.objects.filter(timestamp__gte=date).count()
+    def count():
+        start = date or datetime.datetime.now() - datetime.timedelta(hours = 24)
+        return rollups.count_since(start)
+    return caching.get_or_set('count', (date,), count, timeout)
 
 
 @register.inclusion_tag('activity_monitor/includes/activity_list.html')
-def show_activity(count=10):
+def show_activity(count=10, timeout=None):
     """
     Simple inclusion tag to drop in recent activities.
     Shows 10 by default
@@ -79,14 +121,17 @@ def show_activity(count=10):
     {% show_recent_activity %}
     Or, to set count:
     {% show_recent_activity 6 %}
-   """
-    activities =  Activity.objects.all().order_by('-timestamp')[:count]
 
+    The activities are cached until activity changes, or for timeout seconds.
+   """
+    activities = caching.get_or_set(
+        'recent', (count,), lambda: list(Activity.objects.all().order_by('-timestamp')[:count]), timeout
+    )
     return {'activities': activities}
 
 
 @register.inclusion_tag('activity_monitor/includes/activity_wrapper.html')
-def show_new_activity(last_seen=None, cap=1000, template='grouped', include=None, exclude=None):
+def show_new_activity(last_seen=None, cap=1000, template='grouped', include=None, exclude=None, timeout=None):
     """
     Inclusion tag to show new activity,
     either since user was last seen or today (if not last_seen).
@@ -120,28 +165,43 @@ def show_new_activity(last_seen=None, cap=1000, template='grouped', include=None
 
     Usage: {% show_new_activity last_seen 50 'plain' exclude="comment,post" %}
 
+    The activities are cached until activity changes, or for timeout seconds.
+
+    Usage: {% show_new_activity last_seen 50 'plain' timeout=60 %}
+
     """
     if not last_seen or last_seen is '':
         last_seen = datetime.date.today()
-    actions = Activity.objects.filter(timestamp__gte=last_seen)
+    include_types = sorted(include.split(',')) if include else None
+    exclude_types = sorted(exclude.split(',')) if exclude else None
+
+    def get_actions():
+        # Only the grouped templates render content objects, through render_activity.
+        # Custom snippets in the detailed template may follow the content object's own content_object.
+        actions = Activity.objects.filter(timestamp__gte=last_seen)
+        if template in ('grouped', 'detailed'):
+            actions = actions.with_content_objects(follow=template == 'detailed')
+
+        if include_types:
+            actions = actions.filter(content_type__model__in=include_types)
 
-    if include:
-        include_types = include.split(',')
-        actions = actions.filter(content_type__model__in=include_types)
+        if exclude_types:
+            actions = actions.exclude(content_type__model__in=exclude_types)
 
-    if exclude:
-        exclude_types = exclude.split(',')
-        actions = actions.exclude(content_type__model__in=exclude_types)
+        # Now apply cap
+        actions = actions[:cap]
 
-    # Now apply cap
-    actions = actions[:cap]
+        if template in ('grouped', 'detailed'):
+            return group_activities(actions)
+        return list(actions)
 
+    actions = caching.get_or_set(
+        'new', (last_seen, cap, template, include_types, exclude_types), get_actions, timeout
+    )
     if template=='detailed':
         template = 'activity_monitor/includes/detailed.html'
-        actions = group_activities(actions)
     elif template=='grouped':
         template = 'activity_monitor/includes/grouped_list.html'
-        actions = group_activities(actions)
     else:
         template = 'activity_monitor/includes/activity_list.html'
 
@@ -149,7 +209,7 @@ def show_new_activity(last_seen=None, cap=1000, template='grouped', include=None
     return {'actions': actions, 'selected_template': template}
 
 @register.inclusion_tag('activity_monitor/includes/paginate_by_day.html')
-def paginate_activity(visible_date=None):
+def paginate_activity(visible_date=None, skip_empty=False, timeout=None):
     """
     Creates "get previous day" / "get next day" pagination for activities.
 
@@ -159,12 +219,22 @@ def paginate_activity(visible_date=None):
     If not provided, it will default to today.
 
     #Expects date as default "Aug. 25, 2014" format.
+
+    With skip_empty=True, the links go to the nearest days that have any activity
+    instead, looked up in the rollups and cached until activity changes, or for timeout seconds.
     """
     #if visible_date:
     #    visible_date = datetime.datetime.strptime(visible_date, "%b %d ")
 
     if not visible_date:
         visible_date = datetime.date.today()
+    if skip_empty:
+        # Today is part of the key, since the next day can't be later than it.
+        today = datetime.date.today()
+        previous_day, next_day = caching.get_or_set(
+            'adjacent_days', (visible_date, today), lambda: rollups.get_adjacent_days(visible_date, today), timeout
+        )
+        return {'previous_day': previous_day, 'next_day': next_day}
     previous_day = visible_date - datetime.timedelta(days=1)
     if visible_date == datetime.date.today():
         next_day = None
@@ -172,3 +242,14 @@ def paginate_activity(visible_date=None):
         next_day = visible_date + datetime.timedelta(days=1)
     return {'previous_day': previous_day, 'next_day': next_day}
 
+
+@register.simple_tag
+def days_with_activity(start, end, timeout=None):
+    """
+    Returns the dates from start up to (not including) end that have any activity, oldest first.
+    Usage:
+    {% days_with_activity start end as busy_days %}
+
+    Read from the daily rollups, and cached until activity changes, or for timeout seconds.
+    """
+    return caching.get_or_set('days', (start, end), lambda: rollups.days_with_activity(start, end), timeout)
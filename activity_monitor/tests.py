@@ -1,8 +1,65 @@
+import datetime
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 
+from collections import OrderedDict
+from unittest import mock
+
+from io import StringIO
+from xml.etree import ElementTree
+
 from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from django.test import TestCase
+
+from activity_monitor import (
+    async_views, caching, coalescing, feeds, live, outbox, pagination, partitions, registry, retention,
+    rollups, routing, utils
+)
+from activity_monitor.apps import register_app_activity
+from activity_monitor.models import Activity, ActivityOutbox, ActivityRollup, ArchivedActivity, ArchivedMonth
+from activity_monitor.templatetags import activity_tags
+from activity_monitor import views
+from activity_monitor.views import action_list
+
+
+def override_config(testcase, model, setting):
+    """
+    Registers a config for model for the rest of a test, putting the app's own back afterwards.
+    """
+    patcher = mock.patch.dict(registry._registry)
+    patcher.start()
+    testcase.addCleanup(patcher.stop)
+    return registry.register(model, setting)
+
+
+def use_shared_cache(testcase):
+    """
+    Points ACTIVITY_MONITOR_CACHE at a file-based cache, as processes would share, for the rest of a test.
+    """
+    location = tempfile.mkdtemp()
+    testcase.addCleanup(shutil.rmtree, location)
+    override = override_settings(
+        CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'shared': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location},
+        },
+        ACTIVITY_MONITOR_CACHE='shared',
+    )
+    override.enable()
+    testcase.addCleanup(override.disable)
 
 
 class TestActivityViews(TestCase):
@@ -59,3 +116,1690 @@ class TestActivityViews(TestCase):
         resp = self.client.get(reverse('actions_for_year', args=[2014]))
         self.assertEqual(resp.status_code, 200)
         self.assertTrue('object_list' in resp.context)
+
+
+class TestActivityRegistry(TestCase):
+    # Registration happens when the app is ready, not in the tests.
+
+    def test_registered_when_ready(self):
+        """
+        Test loading the apps registers and follows the watched models without touching the database
+        """
+        code = (
+            "import django; django.setup()\n"
+            "from django.contrib.auth import get_user_model\n"
+            "from django.db import connections\n"
+            "from django.db.models.signals import post_delete, post_save\n"
+            "from activity_monitor import registry\n"
+            "config = registry.get_config(get_user_model())\n"
+            "assert config is not None and config.label == 'auth.user'\n"
+            "assert post_save.has_listeners(get_user_model()) and post_delete.has_listeners(get_user_model())\n"
+            "assert all(connections[alias].connection is None for alias in connections)\n"
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='test_settings', PYTHONPATH=root)
+        result = subprocess.run([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.assertEqual(result.returncode, 0, result.stdout.decode('utf-8'))
+        # And in this process, where the test runner loaded the apps.
+        self.assertIsNotNone(registry.get_config(get_user_model()))
+
+    def test_registry_config(self):
+        """
+        Test settings are normalized into the registry
+        """
+        config = registry.get_config(get_user_model())
+        self.assertEqual(config.verb, " joined ")
+        self.assertEqual(config.manager, 'objects')
+        self.assertIsNone(config.date_field)
+        self.assertIsNone(config.user_field)
+
+    def test_registry_rejects_missing_fields(self):
+        """
+        Test misconfigured fields are caught at registration
+        """
+        with self.assertRaises(ImproperlyConfigured):
+            registry.ActivityModelConfig(get_user_model(), {'model': 'auth.user', 'check': 'is_approved'})
+
+    def test_registry_rejects_bad_settings(self):
+        """
+        Test entries without an installed model, or with a bad retention, are caught at registration
+        """
+        for setting in (
+            {'verb': 'joined'}, {'model': 'auth'}, {'model': 'nope.missing'},
+            {'model': 'auth.user', 'retention': 0},
+        ):
+            with override_settings(ACTIVITY_MONITOR_MODELS=(setting,)):
+                with self.assertRaises(ImproperlyConfigured):
+                    register_app_activity()
+
+    def test_registration_runs_no_queries(self):
+        """
+        Test registering needs no database, and content types are looked up on first use
+        """
+        registry.clear_content_types()
+        ContentType.objects.clear_cache()
+        with self.assertNumQueries(0):
+            register_app_activity()
+        config = registry.get_config(get_user_model())
+        with self.assertNumQueries(1):
+            self.assertEqual(config.content_type.model_class(), get_user_model())
+        with self.assertNumQueries(0):
+            config.content_type
+
+    def test_save_skips_content_type_lookups(self):
+        """
+        Test saving a watched object does not query content types
+        """
+        ContentType.objects.get_for_model(get_user_model())
+        with CaptureQueriesContext(connection) as queries:
+            user = get_user_model().objects.create(username='registry')
+        self.assertFalse([q for q in queries.captured_queries if 'django_content_type' in q['sql']])
+        self.assertTrue(Activity.objects.filter(object_id=user.pk).exists())
+
+    def test_save_query_budget(self):
+        """
+        Test a new watched object lands its activity in one query, and a re-save in two,
+        changed or not, beyond the object's own save.
+        """
+        ContentType.objects.get_for_model(get_user_model())
+        self.assertTrue(registry.get_config(get_user_model()).uses_default_manager)
+        user = get_user_model()(username='budget')
+        with self.assertNumQueries(2):
+            user.save()
+        activity = Activity.objects.get(object_id=user.pk)
+        self.assertEqual(activity.target, 'budget')
+        self.assertEqual(activity.actor_name, 'budget')
+        with self.assertNumQueries(3):
+            user.save()
+        user.username = 'renamed'
+        with self.assertNumQueries(3):
+            user.save()
+        self.assertEqual(Activity.objects.get(object_id=user.pk).target, 'renamed')
+
+    @override_settings(ACTIVITY_MONITOR_ROLLUPS=True)
+    def test_save_query_budget_with_rollups(self):
+        """
+        Test rollups add a query to a new object, and a read of the old day and verb to a changed re-save
+        """
+        ContentType.objects.get_for_model(get_user_model())
+        user = get_user_model()(username='budget')
+        with self.assertNumQueries(3):
+            user.save()
+        with self.assertNumQueries(3):
+            user.save()
+        user.username = 'renamed'
+        with self.assertNumQueries(4):
+            user.save()
+
+
+class TestActivityUpsert(TestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        self.user = get_user_model().objects.all()[0]
+        self.content_type = ContentType.objects.get_for_model(self.user)
+        self.values = {
+            'actor': self.user,
+            'actor_name': 'testclient',
+            'target': 'first',
+            'timestamp': datetime.datetime(2014, 12, 25, 12, 0),
+            'verb': 'posted',
+        }
+
+    def assert_upsert(self, upsert):
+        self.assertEqual(upsert(self.content_type, 42, **self.values), (True, False))
+        self.assertEqual(upsert(self.content_type, 42, **self.values), (False, False))
+        self.values['target'] = 'second'
+        self.assertEqual(upsert(self.content_type, 42, **self.values), (False, True))
+        activity = Activity.objects.get(content_type=self.content_type, object_id=42)
+        self.assertEqual(activity.target, 'second')
+        self.assertEqual(activity.timestamp, self.values['timestamp'])
+
+    def test_upsert(self):
+        """
+        Test upsert creates, skips unchanged rows and refreshes changed ones
+        """
+        self.assert_upsert(Activity.objects.upsert)
+
+    def test_upsert_fallback(self):
+        """
+        Test the upsert used on backends without ON CONFLICT
+        """
+        self.assert_upsert(lambda *args, **kwargs: Activity.objects._upsert_fallback('default', *args, values=kwargs))
+
+    def test_upsert_before_on_conflict(self):
+        """
+        Test SQLite older than 3.24 gets the fallback rather than ON CONFLICT
+        """
+        with mock.patch.object(connection.Database, 'sqlite_version_info', (3, 23, 1)), \
+                CaptureQueriesContext(connection) as queries:
+            self.assert_upsert(Activity.objects.upsert)
+            self.assertEqual(Activity.objects.bulk_upsert([(self.content_type, 43, self.values)]), 1)
+        self.assertFalse([query for query in queries.captured_queries if 'ON CONFLICT' in query['sql']])
+        self.assertEqual(Activity.objects.filter(content_type=self.content_type).count(), 2)
+
+    def test_upsert_create_only(self):
+        """
+        Test create_only fields are written when an activity is created and kept after that
+        """
+        created = self.values['timestamp']
+        Activity.objects.upsert(self.content_type, 42, create_only=('timestamp',), **self.values)
+        self.values.update(target='second', timestamp=created + datetime.timedelta(days=1))
+        self.assertEqual(
+            Activity.objects.upsert(self.content_type, 42, create_only=('timestamp',), **self.values), (False, True)
+        )
+        Activity.objects._upsert_fallback('default', self.content_type, 42, dict(self.values, target='third'), ('timestamp',))
+        self.assertEqual(Activity.objects.bulk_upsert([
+            (self.content_type, 42, dict(self.values, target='fourth')),
+        ], create_only=('timestamp',)), 1)
+        activity = Activity.objects.get(content_type=self.content_type, object_id=42)
+        self.assertEqual(activity.target, 'fourth')
+        self.assertEqual(activity.timestamp, created)
+
+    def test_resave_keeps_time_without_date_field(self):
+        """
+        Test re-saving an object whose model has no date field keeps its activity's time
+        """
+        self.assertIsNone(registry.get_config(get_user_model()).date_field)
+        user = get_user_model().objects.create(username='dateless')
+        timestamp = Activity.objects.get(object_id=user.pk).timestamp
+        user.username = 'renamed'
+        user.save()
+        activity = Activity.objects.get(object_id=user.pk)
+        self.assertEqual(activity.target, 'renamed')
+        self.assertEqual(activity.timestamp, timestamp)
+
+
+@override_settings(ACTIVITY_MONITOR_DEFERRED=True)
+class TestActivityOutbox(TestCase):
+
+    def test_deferred_save(self):
+        """
+        Test deferred saves only touch the outbox until it is drained
+        """
+        user = get_user_model().objects.create(username='deferred')
+        user.first_name = 'Deferred'
+        user.save()
+        self.assertEqual(ActivityOutbox.objects.count(), 2)
+        self.assertFalse(Activity.objects.exists())
+
+        self.assertEqual(outbox.drain(), 2)
+        self.assertFalse(ActivityOutbox.objects.exists())
+        self.assertEqual(Activity.objects.get(object_id=user.pk).target, 'deferred')
+
+    def test_deferred_delete(self):
+        """
+        Test a save followed by a delete coalesces to no activity
+        """
+        user = get_user_model().objects.create(username='deferred')
+        with override_settings(ACTIVITY_MONITOR_DEFERRED=False):
+            user.save()
+        self.assertTrue(Activity.objects.exists())
+        ActivityOutbox.objects.enqueue(ContentType.objects.get_for_model(user), user.pk, ActivityOutbox.DELETE)
+        self.assertEqual(outbox.drain(), 2)
+        self.assertFalse(Activity.objects.exists())
+
+
+class TestRegisterTimelineContent(TestCase):
+    fixtures = ['auth_users.json']
+
+    @override_settings(ACTIVITY_MONITOR_ROLLUPS=True)
+    def test_backfill(self):
+        """
+        Test existing content is registered without being re-saved
+        """
+        users = get_user_model().objects.all()
+        # Bounds, the users, then the existing activities, the insert and the rollups in a savepoint.
+        with self.assertNumQueries(7):
+            call_command('register_timeline_content', stdout=StringIO())
+        self.assertEqual(Activity.objects.count(), users.count())
+        # Re-running leaves existing activities alone.
+        call_command('register_timeline_content', range_size=1, stdout=StringIO())
+        self.assertEqual(Activity.objects.count(), users.count())
+
+    def test_backfill_resume(self):
+        """
+        Test ranges recorded in the checkpoint are skipped
+        """
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'backfill.json')
+        call_command('register_timeline_content', range_size=1, checkpoint=checkpoint, stdout=StringIO())
+        Activity.objects.all().delete()
+        call_command('register_timeline_content', range_size=1, checkpoint=checkpoint, stdout=StringIO())
+        self.assertFalse(Activity.objects.exists())
+        # Ranges of another size don't line up with the recorded ones.
+        with self.assertRaises(CommandError):
+            call_command('register_timeline_content', range_size=2, checkpoint=checkpoint, stdout=StringIO())
+        os.remove(checkpoint)
+
+    def test_backfill_models(self):
+        """
+        Test only the models given are registered, and unwatched ones are refused
+        """
+        call_command('register_timeline_content', 'auth.user', stdout=StringIO())
+        self.assertEqual(Activity.objects.count(), get_user_model().objects.count())
+        with self.assertRaises(CommandError):
+            call_command('register_timeline_content', 'auth.group', stdout=StringIO())
+
+
+class TestOrphanRemoval(TransactionTestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        self.actor = get_user_model().objects.get(username='testclient')
+        self.content_type = ContentType.objects.get_for_model(self.actor)
+        get_user_model().objects.bulk_create([
+            get_user_model()(username='spam{}'.format(i)) for i in range(30)
+        ])
+        self.spam = get_user_model().objects.filter(username__startswith='spam')
+        Activity.objects.bulk_create([
+            Activity(actor=self.actor, content_type=self.content_type, object_id=pk, timestamp=datetime.datetime.now())
+            for pk in self.spam.values_list('pk', flat=True)
+        ])
+
+    def test_bulk_delete(self):
+        """
+        Test a queryset delete removes its activities with a single DELETE
+        """
+        Activity.objects.create(
+            actor=self.actor, content_type=self.content_type, object_id=self.actor.pk, timestamp=datetime.datetime.now()
+        )
+        with CaptureQueriesContext(connection) as queries:
+            self.spam.delete()
+        activity_deletes = [
+            q for q in queries.captured_queries if q['sql'].startswith('DELETE FROM "activity_monitor_activity"')
+        ]
+        self.assertEqual(len(activity_deletes), 2)  # the actor cascade and the orphans
+        self.assertEqual(Activity.objects.count(), 1)
+
+    def test_rollback_keeps_activities(self):
+        """
+        Test activities survive a delete that is rolled back
+        """
+        try:
+            with transaction.atomic():
+                self.spam.delete()
+                raise IntegrityError
+        except IntegrityError:
+            pass
+        self.spam.get(username='spam0').delete()
+        self.assertEqual(Activity.objects.count(), 29)
+
+    def test_savepoint_rollback_keeps_activities(self):
+        """
+        Test activities survive a delete in a savepoint that is rolled back
+        """
+        with transaction.atomic():
+            self.spam.get(username='spam0').delete()
+            try:
+                with transaction.atomic():
+                    self.spam.get(username='spam1').delete()
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+            self.spam.get(username='spam2').delete()
+        self.assertTrue(self.spam.filter(username='spam1').exists())
+        self.assertEqual(Activity.objects.count(), 28)
+        self.assertTrue(Activity.objects.filter(object_id=self.spam.get(username='spam1').pk).exists())
+
+    def test_purge_orphans(self):
+        """
+        Test purge_orphans removes activities whose object is gone
+        """
+        self.spam.filter(username__in=['spam1', 'spam2'])._raw_delete('default')
+        call_command('purge_orphans', stdout=StringIO())
+        self.assertEqual(Activity.objects.count(), 28)
+
+
+class TestContentObjectPrefetch(TestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        self.users = list(get_user_model().objects.all())
+        self.user_type = ContentType.objects.get_for_model(get_user_model())
+        self.activity_type = ContentType.objects.get_for_model(Activity)
+        now = datetime.datetime.now()
+        for user in self.users:
+            activity = Activity.objects.create(
+                actor=user, content_type=self.user_type, object_id=user.pk, timestamp=now, target=user.username
+            )
+            # An activity about an activity stands in for a comment on some object.
+            Activity.objects.create(
+                actor=user, content_type=self.activity_type, object_id=activity.pk, timestamp=now, target='comment'
+            )
+
+    def test_with_content_objects(self):
+        """
+        Test content objects are fetched with one query per content type
+        """
+        with self.assertNumQueries(3):
+            activities = list(Activity.objects.with_content_objects())
+            for activity in activities:
+                self.assertIsNotNone(activity.content_object)
+        self.assertEqual(len(activities), len(self.users) * 2)
+
+    def test_with_content_objects_follow(self):
+        """
+        Test nested content objects are fetched in bulk when followed
+        """
+        with self.assertNumQueries(3):
+            activities = list(Activity.objects.filter(content_type=self.activity_type).with_content_objects(follow=True))
+            for activity in activities:
+                self.assertIn(activity.content_object.content_object, self.users)
+
+
+class TestDenormalizedActivity(TestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        self.user = get_user_model().objects.get(username='testclient')
+        self.activity = Activity.objects.create(
+            actor=self.user,
+            content_type=ContentType.objects.get_for_model(self.user),
+            object_id=self.user.pk,
+            timestamp=datetime.datetime.now(),
+            target='stale',
+            verb='joined',
+            absolute_url='/people/testclient/',
+        )
+
+    def test_values_include_urls(self):
+        """
+        Test the write path stores the URL and image URL
+        """
+        class Post(object):
+            image = '/media/post.png'
+
+            def get_absolute_url(self):
+                return '/posts/1/'
+
+        self.assertEqual(utils.get_absolute_url(Post()), '/posts/1/')
+        self.assertEqual(utils.get_image_url(Post()), '/media/post.png')
+        self.assertIsNone(utils.get_absolute_url(self.user))
+
+    def test_archive_renders_from_rows(self):
+        """
+        Test the archive renders without joins or content object lookups
+        """
+        with self.assertNumQueries(1):
+            resp = self.client.get(reverse('action_archive'))
+        self.assertEqual(resp.context['object_list'][0].short_action_string, 'testclient joined')
+        self.assertContains(resp, '/people/testclient/')
+        self.assertContains(resp, 'stale')
+
+    def test_refresh_activity(self):
+        """
+        Test refresh_activity rewrites stale denormalized values
+        """
+        call_command('refresh_activity', stdout=StringIO())
+        self.activity.refresh_from_db()
+        self.assertEqual(self.activity.target, 'testclient')
+        self.assertEqual(self.activity.actor_name, 'testclient')
+
+
+class TestCursorPagination(TestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        user = get_user_model().objects.get(username='testclient')
+        content_type = ContentType.objects.get_for_model(user)
+        start = datetime.datetime(2014, 12, 25)
+        # Pairs of activities share a timestamp, to exercise the id tie-break.
+        Activity.objects.bulk_create([
+            Activity(
+                actor=user, actor_name=user.username, content_type=content_type, object_id=i,
+                timestamp=start + datetime.timedelta(minutes=i // 2), target=str(i), verb='joined',
+                absolute_url='/{}/'.format(i)
+            )
+            for i in range(250)
+        ])
+        self.expected = list(Activity.objects.order_by('-timestamp', '-pk').values_list('pk', flat=True))
+
+    def get_page(self, cursor=None):
+        # Just the page: the test cache is per-process, so there's no ETag to work out.
+        with self.assertNumQueries(1):
+            resp = self.client.get(reverse('action_archive'), {'cursor': cursor} if cursor else {})
+        self.assertEqual(resp.status_code, 200)
+        return resp.context['page_obj']
+
+    def test_walk_pages(self):
+        """
+        Test cursors walk the archive forwards and back without a count
+        """
+        pages = [self.get_page()]
+        self.assertFalse(pages[0].has_previous())
+        while pages[-1].has_next():
+            pages.append(self.get_page(pages[-1].next_cursor))
+        self.assertEqual([a.pk for page in pages for a in page], self.expected)
+        self.assertEqual([len(page) for page in pages], [100, 100, 50])
+
+        previous = self.get_page(pages[-1].previous_cursor)
+        self.assertEqual([a.pk for a in previous], [a.pk for a in pages[1]])
+        first = self.get_page(previous.previous_cursor)
+        self.assertEqual([a.pk for a in first], [a.pk for a in pages[0]])
+        self.assertFalse(first.has_previous())
+
+    def test_invalid_cursor(self):
+        """
+        Test garbage cursors are a 404
+        """
+        resp = self.client.get(reverse('action_archive'), {'cursor': 'nonsense'})
+        self.assertEqual(resp.status_code, 404)
+
+
+class TestActivityIndexes(TestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        self.user = get_user_model().objects.get(username='testclient')
+        self.content_type = ContentType.objects.get_for_model(self.user)
+
+    def assertUsesIndex(self, qs, index):
+        plan = qs.explain()
+        self.assertIn(index, plan)
+
+    def test_user_archive_uses_actor_index(self):
+        """
+        Test the user archive resolves the username and filters on the actor index
+        """
+        resp = self.client.get(reverse('action_archive_for_user', args=[self.user.username]))
+        self.assertEqual(resp.context['timeline_for'], self.user.username)
+        # The username lookup and the page.
+        with self.assertNumQueries(2):
+            resp = self.client.get(reverse('action_archive_for_user', args=[self.user.username]))
+        self.assertUsesIndex(
+            Activity.objects.filter(actor_id=utils.get_actor_id(self.user.username)).order_by('-timestamp', '-pk'),
+            'activity_actor_timestamp_idx'
+        )
+
+    def test_actor_follows_renames(self):
+        """
+        Test a renamed user's new username finds them straight away, and the old one nobody
+        """
+        username = self.user.username
+        self.assertEqual(utils.get_actor_id(username), self.user.pk)
+        self.user.username = 'renamed'
+        self.user.save()
+        self.assertIsNone(utils.get_actor_id(username))
+        self.assertEqual(utils.get_actor_id('renamed'), self.user.pk)
+
+    def test_period_uses_timestamp_index(self):
+        """
+        Test period views filter on timestamp ranges the index can serve
+        """
+        resp = self.client.get(reverse('actions_for_day', args=[2014, 12, 25]))
+        self.assertUsesIndex(resp.context['view'].get_queryset(), 'activity_timestamp_id_idx')
+
+    def test_content_type_uses_index(self):
+        """
+        Test per-content-type lookups use the content type index
+        """
+        self.assertUsesIndex(
+            Activity.objects.get_for_model(get_user_model()).filter(timestamp__gte=datetime.date(2014, 12, 25)),
+            'activity_ct_timestamp_idx'
+        )
+
+
+class TestGroupActivities(TestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        users = list(get_user_model().objects.order_by('pk'))
+        user_type = ContentType.objects.get_for_model(get_user_model())
+        activity_type = ContentType.objects.get_for_model(Activity)
+        now = datetime.datetime.now()
+        # Everyone comments on Woodstock, a few times each, and one user shares its name.
+        activities = []
+        for i in range(30):
+            user = users[i % len(users)]
+            activities.append(Activity(
+                actor=user, actor_name=user.username, content_type=activity_type, object_id=i,
+                timestamp=now - datetime.timedelta(minutes=i), target='Woodstock', verb='commented on'
+            ))
+        activities.append(Activity(
+            actor=users[0], actor_name=users[0].username, content_type=user_type, object_id=1,
+            timestamp=now - datetime.timedelta(days=2), target='Woodstock', verb='joined'
+        ))
+        Activity.objects.bulk_create(activities)
+        self.users = users
+
+    def test_group_in_db(self):
+        """
+        Test grouping takes three queries and keeps content types apart
+        """
+        with self.assertNumQueries(3):
+            groups = utils.group_activities_in_db(Activity.objects.all())
+        self.assertEqual(len(groups), 2)
+        comments, joined = groups
+        self.assertEqual(comments.actor_total, len(self.users))
+        self.assertEqual(comments.actors[0], self.users[0].username)
+        self.assertEqual(len(comments.actors), min(len(self.users), utils.MAX_GROUP_ACTORS))
+        self.assertEqual(comments.item.object_id, 0)
+        self.assertEqual(comments.verb, 'commented on')
+        self.assertTrue(comments.current_item)
+        self.assertEqual(joined.actor_total, 1)
+        self.assertFalse(joined.current_item)
+
+    def test_group_activities_compat(self):
+        """
+        Test the dict shape is kept, including for sliced querysets
+        """
+        actions = utils.group_activities(Activity.objects.all()[:5])
+        self.assertEqual(list(actions), ['Woodstock'])
+        self.assertEqual(actions['Woodstock']['actor_count'], min(len(self.users), 5) - 1)
+        self.assertEqual(actions['Woodstock']['item'].object_id, 0)
+
+        actions = utils.group_activities(Activity.objects.all())
+        self.assertEqual(list(actions), ['Woodstock', 'Woodstock (user)'])
+
+
+@override_settings(ACTIVITY_MONITOR_ROLLUPS=True)
+class TestGroupedPeriodViews(TestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        users = list(get_user_model().objects.order_by('pk'))
+        content_type = ContentType.objects.get_for_model(Activity)
+        start = datetime.datetime(2014, 12, 1)
+        # 260 activities on 130 targets over the month.
+        Activity.objects.bulk_create([
+            Activity(
+                actor=users[i % 2], actor_name=users[i % 2].username, content_type=content_type, object_id=i,
+                timestamp=start + datetime.timedelta(hours=i), target='topic {}'.format(i // 2), verb='posted in',
+                absolute_url='/topics/{}/'.format(i // 2)
+            )
+            for i in range(260)
+        ])
+        rollups.rebuild()
+
+    def test_month_groups_one_page(self):
+        """
+        Test the month view groups a page of groups in a fixed number of queries
+        """
+        with self.assertNumQueries(5):
+            resp = self.client.get(reverse('actions_for_month', args=[2014, 12]))
+        actions = resp.context['actions']
+        self.assertEqual(len(actions), 100)
+        self.assertEqual(list(actions)[0], 'topic 129')
+        self.assertEqual(actions['topic 129']['actor_count'], 1)
+        self.assertEqual(len(resp.context['object_list']), 100)
+        self.assertEqual(resp.context['paginator'].count, 130)
+        self.assertEqual(resp.context['activity_count'], 260)
+        self.assertEqual(len(resp.context['day_counts']), 11)
+
+        resp = self.client.get(reverse('actions_for_month', args=[2014, 12]), {'page': 2})
+        self.assertEqual(len(resp.context['actions']), 30)
+
+    def test_day_view(self):
+        """
+        Test the day view only groups that day
+        """
+        resp = self.client.get(reverse('actions_for_day', args=[2014, 12, '02']))
+        self.assertEqual(len(resp.context['actions']), 12)
+        self.assertEqual(resp.context['current_date_string'], 'December 02 2014')
+
+
+@override_settings(ACTIVITY_MONITOR_ROLLUPS=True)
+class TestActivityRollups(TestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        self.user = get_user_model().objects.get(username='testclient')
+        self.content_type = ContentType.objects.get_for_model(Activity)
+
+    def create_activities(self, days):
+        for i, day in enumerate(days):
+            Activity.objects.create(
+                actor=self.user, content_type=self.content_type, object_id=i, verb='posted',
+                timestamp=datetime.datetime.combine(day, datetime.time(12)), target='post {}'.format(i),
+                absolute_url='/posts/{}/'.format(i)
+            )
+
+    def get_counts(self, period=ActivityRollup.DAY):
+        return dict(
+            ActivityRollup.objects.filter(period=period, content_type=self.content_type)
+            .values_list('date', 'count')
+        )
+
+    def test_writes_and_deletes(self):
+        """
+        Test the rollups follow activities as they are written and deleted
+        """
+        self.create_activities([datetime.date(2014, 12, 1), datetime.date(2014, 12, 1), datetime.date(2014, 12, 3)])
+        self.assertEqual(self.get_counts(), {datetime.date(2014, 12, 1): 2, datetime.date(2014, 12, 3): 1})
+        self.assertEqual(self.get_counts(ActivityRollup.MONTH), {datetime.date(2014, 12, 1): 3})
+
+        Activity.objects.filter(object_id__in=[0, 2]).delete()
+        Activity.objects.get(object_id=1).delete()
+        self.assertEqual(self.get_counts(ActivityRollup.MONTH), {datetime.date(2014, 12, 1): 0})
+
+        # Only new activities count.
+        user_type = ContentType.objects.get_for_model(get_user_model())
+        timestamp = datetime.datetime(2014, 12, 5)
+        rows = [(user_type, pk, {'actor': pk, 'timestamp': timestamp, 'verb': 'joined'}) for pk in (1, 2)]
+        Activity.objects.bulk_upsert(rows)
+        Activity.objects.bulk_upsert(rows + [(user_type, 3, {'actor': 3, 'timestamp': timestamp, 'verb': 'joined'})])
+        Activity.objects.upsert(user_type, 1, actor=1, timestamp=timestamp, verb='joined')
+        self.assertEqual(
+            ActivityRollup.objects.get(period=ActivityRollup.DAY, content_type=user_type, verb='joined').count, 3
+        )
+
+    def test_moves(self):
+        """
+        Test an activity moved to another day or verb takes its counts with it
+        """
+        user_type = ContentType.objects.get_for_model(get_user_model())
+        noon = lambda day: datetime.datetime(2014, 12, day, 12)
+        values = {'actor': self.user, 'timestamp': noon(1), 'verb': 'joined'}
+
+        def get_counts():
+            return dict(
+                ((date, verb), count) for date, verb, count in ActivityRollup.objects.filter(
+                    period=ActivityRollup.DAY, content_type=user_type, count__gt=0
+                ).values_list('date', 'verb', 'count')
+            )
+
+        Activity.objects.upsert(user_type, 1, **values)
+        Activity.objects.upsert(user_type, 1, **dict(values, timestamp=noon(2)))
+        self.assertEqual(get_counts(), {(datetime.date(2014, 12, 2), 'joined'): 1})
+        Activity.objects._upsert_fallback('default', user_type, 1, dict(values, timestamp=noon(3)))
+        self.assertEqual(get_counts(), {(datetime.date(2014, 12, 3), 'joined'): 1})
+        Activity.objects.bulk_upsert([(user_type, 1, dict(values, verb='left'))])
+        self.assertEqual(get_counts(), {(datetime.date(2014, 12, 1), 'left'): 1})
+        activity = Activity.objects.get(content_type=user_type, object_id=1)
+        activity.timestamp = noon(4)
+        activity.save()
+        # Moving within a day leaves the counts alone.
+        Activity.objects.upsert(user_type, 1, **dict(values, timestamp=noon(4) + datetime.timedelta(hours=1), verb='left'))
+        self.assertEqual(get_counts(), {(datetime.date(2014, 12, 4), 'left'): 1})
+        rollups.rebuild()
+        self.assertEqual(get_counts(), {(datetime.date(2014, 12, 4), 'left'): 1})
+
+    def test_rebuild(self):
+        """
+        Test the rebuild command regenerates the rollups from the activities
+        """
+        self.create_activities([datetime.date(2014, 11, 30), datetime.date(2014, 12, 1)])
+        expected = self.get_counts()
+        Activity.objects.filter(object_id=1).update(timestamp=datetime.datetime(2014, 12, 2))
+        ActivityRollup.objects.update(count=99)
+        call_command('rebuild_activity_rollups', since='2014-12-15', stdout=StringIO())
+        self.assertEqual(self.get_counts()[datetime.date(2014, 11, 30)], 99)
+        self.assertEqual(self.get_counts()[datetime.date(2014, 12, 2)], 1)
+        self.assertNotIn(datetime.date(2014, 12, 1), self.get_counts())
+
+        call_command('rebuild_activity_rollups', stdout=StringIO())
+        self.assertEqual(self.get_counts(), {datetime.date(2014, 11, 30): 1, datetime.date(2014, 12, 2): 1})
+        self.assertNotEqual(self.get_counts(), expected)
+
+    def test_count_since(self):
+        """
+        Test counts come from the rollups, plus a partial first day
+        """
+        self.create_activities([datetime.date(2014, 12, 1), datetime.date(2014, 12, 2), datetime.date(2014, 12, 2)])
+        with self.assertNumQueries(1):
+            self.assertEqual(rollups.count_since(datetime.date(2014, 12, 2)), 2)
+        with self.assertNumQueries(2):
+            self.assertEqual(rollups.count_since(datetime.datetime(2014, 12, 1, 6)), 3)
+        self.assertEqual(rollups.count_since(datetime.datetime(2014, 12, 1, 18)), 2)
+        with override_settings(ACTIVITY_MONITOR_ROLLUPS=False):
+            self.assertEqual(rollups.count_since(datetime.datetime(2014, 12, 1, 18)), 2)
+
+    def test_days_with_activity(self):
+        """
+        Test day pagination skips days without activity
+        """
+        self.create_activities([datetime.date(2014, 12, 1), datetime.date(2014, 12, 5), datetime.date(2014, 12, 9)])
+        self.assertEqual(
+            rollups.days_with_activity(datetime.date(2014, 12, 2), datetime.date(2014, 12, 10)),
+            [datetime.date(2014, 12, 5), datetime.date(2014, 12, 9)]
+        )
+        self.assertEqual(
+            rollups.get_adjacent_days(datetime.date(2014, 12, 5)),
+            (datetime.date(2014, 12, 1), datetime.date(2014, 12, 9))
+        )
+        self.assertEqual(rollups.get_adjacent_days(datetime.date(2014, 12, 1)), (None, datetime.date(2014, 12, 5)))
+        resp = self.client.get(reverse('actions_for_day', args=[2014, 12, '05']))
+        self.assertEqual(resp.context['previous_day'], datetime.date(2014, 12, 1))
+        self.assertEqual(resp.context['next_day'], datetime.date(2014, 12, 9))
+        busy = [datetime.date(2014, 12, 5), datetime.date(2014, 12, 9)]
+        self.assertEqual(activity_tags.days_with_activity(datetime.date(2014, 12, 2), datetime.date(2014, 12, 10)), busy)
+        with override_settings(ACTIVITY_MONITOR_ROLLUPS=False):
+            self.assertEqual(rollups.days_with_activity(datetime.date(2014, 12, 2), datetime.date(2014, 12, 10)), busy)
+
+
+class TestTemplateTagCache(TransactionTestCase):
+    # Generations are bumped on commit, so this needs real transactions.
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        caching.get_cache().clear()
+        caching.reset_stats()
+        get_user_model().objects.create(username='first')
+
+    def test_cached_until_activity_changes(self):
+        """
+        Test tag results are reused until an activity is written or deleted
+        """
+        self.assertEqual(activity_tags.show_activity_count(), 1)
+        self.assertEqual(len(activity_tags.show_new_activity(template='plain')['actions']), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(activity_tags.show_activity_count(), 1)
+            self.assertEqual(len(activity_tags.show_new_activity(template='plain')['actions']), 1)
+        self.assertEqual(caching.get_stats(), {'hits': 2, 'misses': 2})
+
+        user = get_user_model().objects.create(username='second')
+        self.assertEqual(activity_tags.show_activity_count(), 2)
+        self.assertEqual(len(activity_tags.show_activity()['activities']), 2)
+        user.delete()
+        self.assertEqual(activity_tags.show_activity_count(), 1)
+        self.assertEqual(len(activity_tags.show_activity()['activities']), 1)
+
+    def test_invalidate_once_per_transaction(self):
+        """
+        Test a transaction bumps the generation once, unless the write that registered it is rolled back
+        """
+        with mock.patch.object(caching, 'bump_generation') as bump:
+            with transaction.atomic():
+                caching.invalidate('default')
+                caching.invalidate('default')
+            self.assertEqual(bump.call_count, 1)
+
+            with transaction.atomic():
+                try:
+                    with transaction.atomic():
+                        caching.invalidate('default')
+                        raise IntegrityError
+                except IntegrityError:
+                    pass
+                caching.invalidate('default')
+            self.assertEqual(bump.call_count, 2)
+
+            try:
+                with transaction.atomic():
+                    caching.invalidate('default')
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+            self.assertEqual(bump.call_count, 2)
+            with transaction.atomic():
+                caching.invalidate('default')
+            self.assertEqual(bump.call_count, 3)
+
+    @override_settings(ACTIVITY_MONITOR_ROLLUPS=True)
+    def test_paginate_activity(self):
+        """
+        Test day links go to the adjacent days, or with skip_empty, the nearest busy ones, looked up once per generation
+        """
+        # setUp's activity was written before the rollups were turned on.
+        rollups.rebuild()
+        today = datetime.date.today()
+        two_days_ago = today - datetime.timedelta(days=2)
+        with self.assertNumQueries(0):
+            self.assertEqual(activity_tags.paginate_activity(two_days_ago), {
+                'previous_day': two_days_ago - datetime.timedelta(days=1),
+                'next_day': two_days_ago + datetime.timedelta(days=1),
+            })
+        with self.assertNumQueries(2):
+            self.assertEqual(activity_tags.paginate_activity(two_days_ago, skip_empty=True)['next_day'], today)
+        with self.assertNumQueries(0):
+            activity_tags.paginate_activity(two_days_ago, skip_empty=True)
+        Activity.objects.all().delete()
+        self.assertIsNone(activity_tags.paginate_activity(two_days_ago, skip_empty=True)['next_day'])
+
+    def test_keys(self):
+        """
+        Test include, exclude, cap and template each get their own cached result
+        """
+        grouped = activity_tags.show_new_activity(include='user,post')['actions']
+        self.assertEqual(list(grouped), ['first'])
+        with self.assertNumQueries(0):
+            activity_tags.show_new_activity(include='post,user')
+        self.assertEqual(activity_tags.show_new_activity(exclude='user', template='plain')['actions'], [])
+        self.assertEqual(len(activity_tags.show_new_activity(cap=0, template='plain')['actions']), 0)
+        self.assertEqual(len(activity_tags.show_new_activity(template='plain')['actions']), 1)
+        self.assertEqual(caching.get_stats(), {'hits': 1, 'misses': 4})
+
+        # A timeout of 0 skips the cache altogether.
+        with self.assertNumQueries(1):
+            activity_tags.show_activity(timeout=0)
+        self.assertEqual(caching.get_stats(), {'hits': 1, 'misses': 4})
+
+
+SNIPPET_TEMPLATES = [{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'OPTIONS': {
+        'loaders': [
+            ('django.template.loaders.locmem.Loader', {
+                'activity_monitor/includes/models/auth_user.html': '<b>{{ obj.username }}</b> {{ activity.target }}',
+            }),
+            'django.template.loaders.app_directories.Loader',
+        ],
+    },
+}]
+
+
+class TestRenderActivity(TestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        caching.get_cache().clear()
+        users = list(get_user_model().objects.order_by('pk'))
+        user_type = ContentType.objects.get_for_model(get_user_model())
+        activity_type = ContentType.objects.get_for_model(Activity)
+        self.activities = [
+            Activity.objects.create(
+                actor=user, content_type=user_type, object_id=user.pk, timestamp=datetime.datetime.now(),
+                target=user.username, absolute_url='/people/{}/'.format(user.username)
+            )
+            for user in users
+        ] + [
+            Activity.objects.create(
+                actor=users[0], content_type=activity_type, object_id=i, timestamp=datetime.datetime.now(),
+                target='thing {}'.format(i), absolute_url='/things/{}/'.format(i)
+            )
+            for i in range(5)
+        ]
+
+    @override_settings(TEMPLATES=SNIPPET_TEMPLATES)
+    def test_templates_resolved_once(self):
+        """
+        Test snippets, and their absence, are looked up once per content type
+        """
+        with mock.patch.object(activity_tags.loader, 'get_template', wraps=activity_tags.loader.get_template) as get:
+            rendered = [activity_tags.render_activity(activity) for activity in self.activities]
+            rendered += [activity_tags.render_activity(activity) for activity in self.activities]
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(rendered[0], '<b>testclient</b> testclient')
+        self.assertIsNone(rendered[-1])
+
+    @override_settings(TEMPLATES=SNIPPET_TEMPLATES, ACTIVITY_MONITOR_FRAGMENT_TIMEOUT=60)
+    def test_fragment_cache(self):
+        """
+        Test rendered snippets are cached until the activity changes
+        """
+        activity = self.activities[0]
+        self.assertEqual(activity_tags.render_activity(activity), '<b>testclient</b> testclient')
+        activity = Activity.objects.get(pk=activity.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(activity_tags.render_activity(activity), '<b>testclient</b> testclient')
+
+        activity.target = 'renamed'
+        activity.save()
+        self.assertEqual(activity_tags.render_activity(activity), '<b>testclient</b> renamed')
+
+
+class TestConditionalViews(TestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        self.user = get_user_model().objects.get(username='testclient')
+        content_type = ContentType.objects.get_for_model(Activity)
+        Activity.objects.bulk_create([
+            Activity(
+                actor=self.user, actor_name='testclient', content_type=content_type, object_id=i,
+                timestamp=datetime.datetime(2014, 12, 1 + i), target='post {}'.format(i), absolute_url='/{}/'.format(i)
+            )
+            for i in range(3)
+        ])
+
+    def test_not_modified(self):
+        """
+        Test a matching ETag gets a 304 without the list being evaluated
+        """
+        use_shared_cache(self)
+        url = reverse('action_archive')
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(resp.has_header('Last-Modified'))
+        self.assertEqual(resp['Vary'], 'Cookie')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=resp['ETag']).status_code, 304)
+
+        Activity.objects.create(
+            actor=self.user, content_type=ContentType.objects.get_for_model(Activity), object_id=9,
+            timestamp=datetime.datetime(2014, 12, 5), target='new', absolute_url='/9/'
+        )
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=resp['ETag']).status_code, 200)
+
+    def test_past_periods_cached(self):
+        """
+        Test finished days and months get a long max-age, and the current one doesn't
+        """
+        use_shared_cache(self)
+        resp = self.client.get(reverse('actions_for_month', args=[2014, 12]))
+        self.assertIn('max-age=2592000', resp['Cache-Control'])
+        resp = self.client.get(reverse('actions_for_day', args=[2014, 12, '02']))
+        self.assertIn('private', resp['Cache-Control'])
+        self.assertEqual(self.client.get(
+            reverse('actions_for_day', args=[2014, 12, '02']), HTTP_IF_NONE_MATCH=resp['ETag']
+        ).status_code, 304)
+        self.assertFalse(self.client.get(reverse('actions_for_today')).has_header('Cache-Control'))
+        with override_settings(ACTIVITY_MONITOR_ARCHIVE_PUBLIC=True):
+            resp = self.client.get(reverse('actions_for_day', args=[2014, 12, '02']))
+        self.assertIn('public', resp['Cache-Control'])
+        self.assertNotIn('private', resp['Cache-Control'])
+
+    def test_no_etag_without_shared_cache(self):
+        """
+        Test a per-process cache turns ETags off, with a warning, as other processes couldn't invalidate them
+        """
+        views.warn_unshared_cache.cache_clear()
+        url = reverse('action_archive')
+        with self.assertLogs('activity_monitor.views', 'WARNING'):
+            resp = self.client.get(url)
+        self.assertFalse(resp.has_header('ETag'))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"anything"').status_code, 200)
+        self.assertEqual(resp['Vary'], 'Cookie')
+
+
+class TestActivityFeeds(TestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        users = list(get_user_model().objects.order_by('pk'))
+        activity_type = ContentType.objects.get_for_model(Activity)
+        user_type = ContentType.objects.get_for_model(get_user_model())
+        start = datetime.datetime(2014, 12, 1)
+        Activity.objects.bulk_create([
+            Activity(
+                actor=users[i % 2], actor_name=users[i % 2].username, object_id=i, verb='posted',
+                content_type=user_type if i % 5 == 0 else activity_type,
+                timestamp=start + datetime.timedelta(minutes=i // 2), target='post <{}>'.format(i),
+                absolute_url='/posts/{}/'.format(i)
+            )
+            for i in range(25)
+        ])
+
+    def get_rows(self, **params):
+        resp = self.client.get(reverse('activity_feed', args=['ndjson']), params)
+        self.assertEqual(resp['Content-Type'], 'application/x-ndjson')
+        return [json.loads(line) for line in b''.join(resp.streaming_content).decode('utf-8').splitlines()]
+
+    def test_ndjson_in_chunks(self):
+        """
+        Test the feed streams every activity in the order written, a chunk at a time
+        """
+        request = RequestFactory().get('/feed.ndjson')
+        view = feeds.ActivityFeed.as_view(chunk_size=10)
+        with self.assertNumQueries(3):
+            lines = list(view(request, format='ndjson').streaming_content)
+        rows = [json.loads(line.decode('utf-8')) for line in lines]
+        expected = list(Activity.objects.order_by('pk').values_list('pk', flat=True))
+        self.assertEqual([row['id'] for row in rows], expected)
+        self.assertEqual(rows[0]['url'], 'http://testserver/posts/0/')
+        self.assertEqual(rows[0]['content_type'], 'auth.user')
+
+    def test_filters(self):
+        """
+        Test since, actor, include, exclude and limit
+        """
+        rows = self.get_rows()
+        since = self.get_rows(since=rows[9]['cursor'])
+        self.assertEqual([row['id'] for row in since], [row['id'] for row in rows[10:]])
+        self.assertEqual(len(self.get_rows(actor='testclient')), 13)
+        self.assertEqual(self.get_rows(actor='nobody'), [])
+        self.assertEqual(len(self.get_rows(include='user')), 5)
+        self.assertEqual(len(self.get_rows(exclude='user')), 20)
+        self.assertEqual(len(self.get_rows(limit=7)), 7)
+        resp = self.client.get(reverse('activity_feed', args=['ndjson']), {'since': 'garbage'})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_backdated_after_cursor(self):
+        """
+        Test an activity written after a cursor is returned from it, however old its timestamp
+        """
+        cursor = self.get_rows()[-1]['cursor']
+        user = get_user_model().objects.order_by('pk').first()
+        backdated = Activity.objects.create(
+            actor=user, actor_name=user.username, object_id=99, verb='posted',
+            content_type=ContentType.objects.get_for_model(Activity), timestamp=datetime.datetime(2014, 11, 1)
+        )
+        self.assertEqual([row['id'] for row in self.get_rows(since=cursor)], [backdated.pk])
+        # The live views take the same cursors.
+        view = live.ActivityStream.as_view(buffer=live.ActivityBuffer(size=10), poll_timeout=0)
+        resp = view(RequestFactory().get(reverse('activity_poll'), {'since': cursor}), format='poll')
+        self.assertEqual([item['id'] for item in json.loads(resp.content.decode('utf-8'))['activities']], [backdated.pk])
+        # A list page's (timestamp, id) cursor isn't taken for an id.
+        page_cursor = pagination.make_cursor(pagination.NEXT, backdated.timestamp, backdated.pk)
+        resp = self.client.get(reverse('activity_feed', args=['ndjson']), {'since': page_cursor})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_json_and_atom(self):
+        """
+        Test the JSON and Atom formats
+        """
+        resp = self.client.get(reverse('activity_feed', args=['json']), {'limit': 3})
+        data = json.loads(b''.join(resp.streaming_content).decode('utf-8'))
+        self.assertEqual(len(data['activities']), 3)
+        self.assertEqual(data['next'], data['activities'][-1]['cursor'])
+        empty = self.client.get(reverse('activity_feed', args=['json']), {'since': data['next'], 'actor': 'nobody'})
+        self.assertEqual(json.loads(b''.join(empty.streaming_content).decode('utf-8')), {
+            'activities': [], 'next': data['next']
+        })
+
+        resp = self.client.get(reverse('activity_feed', args=['atom']), {'limit': 2})
+        feed = ElementTree.fromstring(b''.join(resp.streaming_content))
+        entries = feed.findall('{http://www.w3.org/2005/Atom}entry')
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0].find('{http://www.w3.org/2005/Atom}title').text, 'testclient posted post <0>')
+
+
+class TestActivityStream(TestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        self.users = list(get_user_model().objects.order_by('pk'))
+        self.activity_type = ContentType.objects.get_for_model(Activity)
+        self.user_type = ContentType.objects.get_for_model(get_user_model())
+        for i in range(5):
+            self.add_activity(i)
+        self.buffer = live.ActivityBuffer(size=10)
+
+    def add_activity(self, i, user_type=False, minutes=None):
+        user = self.users[i % 2]
+        return Activity.objects.create(
+            actor=user, actor_name=user.username, object_id=i, verb='posted',
+            content_type=self.user_type if user_type else self.activity_type,
+            timestamp=datetime.datetime(2014, 12, 1) + datetime.timedelta(minutes=i if minutes is None else minutes),
+        )
+
+    def get_view(self, params=None, **kwargs):
+        kwargs.setdefault('buffer', self.buffer)
+        view = live.ActivityStream(**kwargs)
+        view.request = RequestFactory().get('/live/', params or {})
+        view.prepare(view.request)
+        return view
+
+    def test_only_new_activity(self):
+        """
+        Test subscribers start from the latest activity and are only sent what's written after
+        """
+        view = self.get_view(fallback_interval=60)
+        self.assertEqual(view.get_new_rows(), [])
+        # An older timestamp doesn't stop a new activity being sent.
+        new = self.add_activity(5, minutes=0)
+        live.notify()
+        self.assertEqual([row['id'] for row in view.get_new_rows()], [new.pk])
+        self.assertEqual(view.get_new_rows(), [])
+
+    def test_one_query_for_every_subscriber(self):
+        """
+        Test a change is fetched once for the process, however many are waiting
+        """
+        views = [self.get_view(fallback_interval=60) for i in range(3)]
+        new = self.add_activity(5)
+        live.notify()
+        with self.assertNumQueries(1):
+            for view in views:
+                self.assertEqual([row['id'] for row in view.get_new_rows()], [new.pk])
+        # Nothing new, and the buffer is fresh, so nothing is asked of the database.
+        with self.assertNumQueries(0):
+            self.assertEqual(views[0].get_new_rows(), [])
+
+    def test_cursor_and_filters(self):
+        """
+        Test since picks up after a cursor, from the database if the buffer doesn't reach back that far
+        """
+        first = Activity.objects.order_by('pk').first()
+        cursor = pagination.make_stream_cursor(first.pk)
+        for i in range(5, 15):
+            self.add_activity(i, user_type=i % 3 == 0)
+        view = self.get_view({'since': cursor})
+        rows = view.get_new_rows()
+        self.assertEqual(len(rows), 14)
+        self.assertEqual(view.get_new_rows(), [])
+
+        self.assertEqual(len(self.get_view({'since': cursor, 'include': 'user'}).get_new_rows()), 3)
+        self.assertEqual(len(self.get_view({'since': cursor, 'exclude': 'user'}).get_new_rows()), 11)
+        self.assertEqual(len(self.get_view({'since': cursor, 'actor': 'testclient'}).get_new_rows()), 7)
+        self.assertEqual(self.get_view({'since': cursor, 'actor': 'nobody'}).get_new_rows(), [])
+
+    def test_long_poll(self):
+        """
+        Test a long poll answers with what's new and a cursor to poll from next
+        """
+        url = reverse('activity_poll')
+        resp = self.client.get(url, {'since': 'garbage'})
+        self.assertEqual(resp.status_code, 400)
+
+        first = Activity.objects.order_by('pk').first()
+        # A (timestamp, id) cursor isn't taken for an id.
+        resp = self.client.get(url, {'since': pagination.make_cursor(pagination.NEXT, first.timestamp, first.pk)})
+        self.assertEqual(resp.status_code, 400)
+        cursor = pagination.make_stream_cursor(first.pk)
+        view = live.ActivityStream.as_view(buffer=self.buffer, poll_timeout=0)
+        data = json.loads(view(RequestFactory().get(url, {'since': cursor}), format='poll').content.decode('utf-8'))
+        self.assertEqual(len(data['activities']), 4)
+        self.assertEqual(data['cursor'], data['activities'][-1]['cursor'])
+        data = json.loads(view(RequestFactory().get(url, {'since': data['cursor']}), format='poll').content.decode('utf-8'))
+        self.assertEqual(data['activities'], [])
+
+    def test_event_stream(self):
+        """
+        Test the event stream sends new activities, then heartbeats, until it closes
+        """
+        view = live.ActivityStream.as_view(buffer=self.buffer, heartbeat=0.01, max_duration=0.05)
+        request = RequestFactory().get(reverse('activity_stream'))
+        resp = view(request)
+        self.assertEqual(resp['Content-Type'], 'text/event-stream')
+        new = self.add_activity(5)
+        live.notify()
+        body = b''.join(resp.streaming_content).decode('utf-8')
+        events = [event for event in body.split('\n\n') if event.startswith('id:')]
+        self.assertEqual(len(events), 1)
+        lines = events[0].splitlines()
+        self.assertEqual(lines[1], 'event: activity')
+        data = json.loads(lines[2][len('data: '):])
+        self.assertEqual(data['id'], new.pk)
+        self.assertEqual(lines[0], 'id: {}'.format(data['cursor']))
+        self.assertIn(': keepalive', body)
+
+    def test_keepalive_outlasts_fallback_interval(self):
+        """
+        Test heartbeats are sent when the buffer is checked more often than they're due
+        """
+        view = live.ActivityStream.as_view(
+            buffer=self.buffer, heartbeat=0.03, fallback_interval=0.01, max_duration=0.2
+        )
+        resp = view(RequestFactory().get(reverse('activity_stream')))
+        body = b''.join(resp.streaming_content).decode('utf-8')
+        self.assertGreaterEqual(body.count(': keepalive'), 3)
+
+
+@unittest.skipUnless(importlib.util.find_spec('asgiref'), "The async views need asgiref.")
+class TestAsyncViews(TransactionTestCase):
+    # Requests are served from other threads, which only see committed rows.
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        user = get_user_model().objects.get(username='testclient')
+        Activity.objects.create(
+            actor=user, actor_name=user.username, content_type=ContentType.objects.get_for_model(user),
+            object_id=user.pk, timestamp=datetime.datetime.now(), verb='joined', absolute_url='/testclient/'
+        )
+
+    def test_manager_helpers(self):
+        """
+        Test the async manager helpers match the sync ones
+        """
+        from asgiref.sync import async_to_sync
+        model = get_user_model()
+        qs = async_to_sync(Activity.objects.aget_for_model)(model)
+        self.assertEqual(list(qs), list(Activity.objects.get_for_model(model)))
+        self.assertEqual(
+            async_to_sync(Activity.objects.aget_last_update_of_model)(model),
+            Activity.objects.get_last_update_of_model(model)
+        )
+        self.assertEqual(
+            async_to_sync(Activity.objects.aget_last_update_of_model)(model, actor_id=0),
+            datetime.datetime.fromtimestamp(0)
+        )
+
+    def test_views(self):
+        """
+        Test the async views render what the sync ones do, and answer conditional requests
+        """
+        from asgiref.sync import async_to_sync
+        use_shared_cache(self)
+        factory = RequestFactory()
+        request = factory.get('/archive/')
+        response = async_to_sync(async_views.action_list)(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, action_list(factory.get('/archive/')).render().content)
+        self.assertEqual(len(response.context_data['object_list']), 1)
+
+        conditional = factory.get('/archive/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(async_to_sync(async_views.action_list)(conditional).status_code, 304)
+
+        self.assertEqual(async_to_sync(async_views.actions_for_today)(factory.get('/')).status_code, 200)
+        today = datetime.date.today()
+        response = async_to_sync(async_views.actions_for_period)(
+            factory.get('/'), year=str(today.year), month='%02d' % today.month
+        )
+        self.assertEqual(response.status_code, 200)
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        return 'replica'
+
+
+class TestReadReplica(TestCase):
+    # The two databases aren't replicated, so which one was used shows in what's found.
+    databases = {'default', 'replica'}
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        self.user = get_user_model().objects.get(username='testclient')
+        self.content_type = ContentType.objects.get_for_model(self.user)
+
+    def tearDown(self):
+        routing.unpin()
+
+    def create_activity(self, object_id):
+        return Activity.objects.create(
+            actor=self.user, content_type=self.content_type, object_id=object_id, timestamp=datetime.datetime.now()
+        )
+
+    def test_routers_respected(self):
+        """
+        Test the manager leaves the choice of database to the routers
+        """
+        self.create_activity(1)
+        with override_settings(DATABASE_ROUTERS=['activity_monitor.tests.ReplicaRouter']):
+            self.assertEqual(Activity.objects.db, 'replica')
+            self.assertEqual(Activity.objects.count(), 0)
+        self.assertEqual(Activity.objects.count(), 1)
+
+    @override_settings(ACTIVITY_MONITOR_READ_DATABASE='replica', ACTIVITY_MONITOR_WRITE_DATABASE='default')
+    @override_settings(ACTIVITY_MONITOR_ROLLUPS=True)
+    def test_read_and_write_databases(self):
+        """
+        Test reads go to the read database and writes, from the signal handlers too, to the write database
+        """
+        self.create_activity(1)
+        get_user_model().objects.create(username='replicated')
+        routing.unpin()
+        self.assertFalse(routing.is_pinned())
+        self.assertEqual(Activity.objects.count(), 0)
+        self.assertEqual(len(self.client.get(reverse('action_archive')).context['object_list']), 0)
+        self.assertEqual(Activity.objects.using('default').count(), 2)
+        self.assertEqual(sum(
+            ActivityRollup.objects.using('default').filter(period=ActivityRollup.DAY).values_list('count', flat=True)
+        ), 2)
+
+    @override_settings(ACTIVITY_MONITOR_READ_DATABASE='replica', ACTIVITY_MONITOR_WRITE_DATABASE='default')
+    def test_read_your_writes(self):
+        """
+        Test reads stick to the write database after a write, until the request ends
+        """
+        activity = self.create_activity(1)
+        self.assertTrue(routing.is_pinned())
+        self.assertEqual(list(Activity.objects.all()), [activity])
+        # An activity read back from the replica is still written to the primary.
+        routing.unpin()
+        activity.save(update_fields=['timestamp'])
+        self.assertEqual(Activity.objects.get(), activity)
+        # Stickiness ends with the request.
+        self.client.get(reverse('action_archive'))
+        self.assertFalse(routing.is_pinned())
+        self.assertEqual(Activity.objects.count(), 0)
+
+    @override_settings(ACTIVITY_MONITOR_READ_DATABASE='replica', ACTIVITY_MONITOR_WRITE_DATABASE='default')
+    def test_only_writes_pin(self):
+        """
+        Test choosing the write database, or an upsert that changes nothing, leaves reads alone
+        """
+        values = {'actor': self.user, 'timestamp': datetime.datetime(2014, 12, 1), 'verb': 'joined'}
+        Activity.objects.upsert(self.content_type, 1, **values)
+        routing.unpin()
+        self.assertEqual(routing.db_for_write(Activity), 'default')
+        self.assertEqual(Activity.objects.upsert(self.content_type, 1, **values), (False, False))
+        self.assertFalse(routing.is_pinned())
+
+    @override_settings(ACTIVITY_MONITOR_READ_DATABASE='replica', ACTIVITY_MONITOR_WRITE_DATABASE='default')
+    def test_sticky_reads(self):
+        """
+        Test sticky_reads() ends stickiness outside of a request
+        """
+        with routing.sticky_reads():
+            self.create_activity(1)
+            self.assertEqual(Activity.objects.count(), 1)
+        self.assertFalse(routing.is_pinned())
+        self.assertEqual(Activity.objects.count(), 0)
+
+
+@override_settings(ACTIVITY_MONITOR_ROLLUPS=True)
+class TestRegisterBulk(TestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        override_config(self, get_user_model(), {
+            'model': 'auth.user', 'verb': ' joined ', 'date_field': 'date_joined',
+            'check': 'is_active', 'filter_superuser': True,
+        })
+        now = datetime.datetime.now()
+        get_user_model().objects.bulk_create(
+            [get_user_model()(username='bulk{}'.format(i), date_joined=now) for i in range(30)] +
+            [get_user_model()(username='old', date_joined=now - datetime.timedelta(days=4))] +
+            [get_user_model()(username='boss', date_joined=now, is_superuser=True)]
+        )
+        self.users = get_user_model().objects.filter(username__startswith='bulk')
+
+    def test_register_bulk(self):
+        """
+        Test objects written without signals get their activities from whole chunks at a time
+        """
+        self.assertFalse(Activity.objects.exists())
+        # Per chunk of 10: its pks, its objects, then a savepoint around the existence check,
+        # rollups and insert. Beyond that, a delete for the inactive fixture user.
+        ContentType.objects.get_for_model(get_user_model())
+        with self.assertNumQueries(7 * 4 + 4):
+            written, removed = Activity.objects.register_bulk(get_user_model().objects.all(), chunk_size=10)
+        # Neither the old account nor the superuser registers; nor do the fixture users, joined years ago.
+        self.assertEqual((written, removed), (30, 0))
+        self.assertEqual(
+            set(Activity.objects.values_list('target', flat=True)),
+            set(self.users.values_list('username', flat=True))
+        )
+        self.assertEqual(rollups.count_since(datetime.date.today()), 30)
+
+        # QuerySet.update() doesn't send signals either.
+        self.users.filter(username__in=['bulk1', 'bulk2']).update(is_active=False)
+        self.users.filter(username='bulk3').update(username='bulk3b')
+        written, removed = Activity.objects.register_bulk(list(self.users))
+        self.assertEqual((written, removed), (1, 2))
+        self.assertEqual(Activity.objects.count(), 28)
+        self.assertTrue(Activity.objects.filter(actor_name='bulk3b', target='bulk3b').exists())
+
+    def test_unregister_bulk(self):
+        """
+        Test activities are removed for a queryset or a list of objects
+        """
+        Activity.objects.register_bulk(self.users)
+        self.assertEqual(Activity.objects.unregister_bulk(self.users.filter(username__endswith='1')), 3)
+        self.assertEqual(Activity.objects.unregister_bulk(list(self.users[:5])), 4)
+        self.assertEqual(Activity.objects.count(), 23)
+        self.assertEqual(rollups.count_since(datetime.date.today()), 23)
+
+
+@override_settings(ACTIVITY_MONITOR_COALESCE='local')
+class TestWriteCoalescing(TransactionTestCase):
+    # Fingerprints are recorded on commit, so this needs real transactions.
+
+    def setUp(self):
+        caching.get_cache().clear()
+        coalescing.clear()
+        coalescing.reset_stats()
+        ContentType.objects.get_for_model(get_user_model())
+        self.user = get_user_model().objects.create(username='busy')
+
+    def test_unchanged_saves_skipped(self):
+        """
+        Test re-saves that can't change the activity run no queries beyond the save itself
+        """
+        for i in range(3):
+            self.user.last_login = datetime.datetime.now()
+            with self.assertNumQueries(1):
+                self.user.save()
+        self.assertEqual(coalescing.get_stats(), {'skipped': 3, 'applied': 1})
+
+        self.user.username = 'renamed'
+        self.user.save()
+        self.assertEqual(Activity.objects.get(object_id=self.user.pk).target, 'renamed')
+        self.assertEqual(coalescing.get_stats(), {'skipped': 3, 'applied': 2})
+
+    def test_deleted_activity_written_again(self):
+        """
+        Test deleting activities retires the fingerprints, so the next save writes the activity again
+        """
+        Activity.objects.filter(object_id=self.user.pk).delete()
+        self.user.save()
+        self.assertTrue(Activity.objects.filter(object_id=self.user.pk).exists())
+        self.assertEqual(coalescing.get_stats(), {'skipped': 0, 'applied': 2})
+
+    def test_off_and_shared(self):
+        """
+        Test nothing is skipped when coalescing is off, and fingerprints can be shared through the cache
+        """
+        with override_settings(ACTIVITY_MONITOR_COALESCE=None):
+            with self.assertNumQueries(3):
+                self.user.save()
+        with override_settings(ACTIVITY_MONITOR_COALESCE='cache'):
+            self.user.username = 'shared'
+            self.user.save()
+            # As if the next save were in another process.
+            coalescing.clear()
+            with self.assertNumQueries(1):
+                self.user.save()
+        self.assertEqual(coalescing.get_stats(), {'skipped': 1, 'applied': 2})
+
+    def test_cache_mode_across_processes(self):
+        """
+        Test a save that undoes another process's change isn't skipped in 'cache' mode
+        """
+        with override_settings(ACTIVITY_MONITOR_COALESCE='cache'):
+            self.user.save()
+            # Another process, with fingerprints of its own.
+            with mock.patch.object(coalescing, '_fingerprints', OrderedDict()):
+                elsewhere = get_user_model().objects.get(pk=self.user.pk)
+                elsewhere.username = 'elsewhere'
+                elsewhere.save()
+            self.assertEqual(Activity.objects.get(object_id=self.user.pk).target, 'elsewhere')
+            # This process last saved 'busy', but the activity says 'elsewhere' now.
+            self.user.save()
+        self.assertEqual(Activity.objects.get(object_id=self.user.pk).target, 'busy')
+
+    def test_lru_bounded(self):
+        """
+        Test the in-process fingerprints are bounded
+        """
+        with override_settings(ACTIVITY_MONITOR_COALESCE_SIZE=2):
+            for i in range(4):
+                get_user_model().objects.create(username='user{}'.format(i))
+            self.assertEqual(len(coalescing._fingerprints), 2)
+
+
+@override_settings(ACTIVITY_MONITOR_ROLLUPS=True)
+class TestActivityRetention(TestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        override_config(self, get_user_model(), {'model': 'auth.user', 'verb': ' joined ', 'retention': 30})
+        self.user = get_user_model().objects.get(username='testclient')
+        self.content_type = ContentType.objects.get_for_model(get_user_model())
+        now = datetime.datetime.now()
+        for i, days in enumerate([1, 10, 40, 50, 60, 400]):
+            Activity.objects.create(
+                actor=self.user, content_type=self.content_type, object_id=100 + i, verb=' joined ',
+                timestamp=now - datetime.timedelta(days=days, microseconds=i), target='user {}'.format(i)
+            )
+        self.archive = os.path.join(tempfile.mkdtemp(), 'activity.ndjson.gz')
+
+    def tearDown(self):
+        if os.path.exists(self.archive):
+            os.remove(self.archive)
+
+    def test_prune(self):
+        """
+        Test expired activities are deleted a range at a time, taking the rollups with them
+        """
+        out = StringIO()
+        call_command('prune_activity', dry_run=True, stdout=out)
+        self.assertIn('4 activities', out.getvalue())
+        self.assertEqual(Activity.objects.count(), 6)
+
+        # With 3 to a chunk, two chunks of: their pks, then a count of their rollups, the delete
+        # and the rollup changes in a savepoint. Then the empty pk queries, here and in the archive.
+        config = registry.get_config(get_user_model())
+        cutoff = retention.get_cutoff(config)
+        with self.assertNumQueries(2 * 6 + 2):
+            self.assertEqual(list(retention.prune(config, cutoff, chunk_size=3)), [3, 1])
+        self.assertEqual(sorted(Activity.objects.values_list('object_id', flat=True)), [100, 101])
+        self.assertEqual(rollups.count_since(datetime.date(2000, 1, 1)), 2)
+
+        out = StringIO()
+        call_command('prune_activity', 'auth.user', stdout=out)
+        self.assertIn('Pruned 0 activities', out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('prune_activity', 'activity_monitor.activityrollup', stdout=StringIO())
+
+    def test_default_retention(self):
+        """
+        Test ACTIVITY_MONITOR_RETENTION covers models without a retention of their own
+        """
+        registry.register(get_user_model(), {'model': 'auth.user', 'verb': ' joined '})
+        call_command('prune_activity', stdout=StringIO())
+        self.assertEqual(Activity.objects.count(), 6)
+        with override_settings(ACTIVITY_MONITOR_RETENTION=100):
+            call_command('prune_activity', stdout=StringIO())
+        self.assertEqual(Activity.objects.count(), 5)
+
+    def test_archive_and_restore(self):
+        """
+        Test pruned activities are archived and can be loaded back as they were
+        """
+        pruned = list(Activity.objects.filter(object_id__gte=102).order_by('pk').values())
+        call_command('prune_activity', archive=self.archive, chunk_size=2, stdout=StringIO())
+        self.assertEqual(Activity.objects.count(), 2)
+
+        # One object has an activity again, and another's id is taken.
+        Activity.objects.create(
+            actor=self.user, content_type=self.content_type, object_id=105, verb=' joined ',
+            timestamp=datetime.datetime.now(), target='user 5'
+        )
+        Activity.objects.filter(object_id=105).update(id=pruned[2]['id'])
+        out = StringIO()
+        call_command('restore_activity', self.archive, stdout=out)
+        self.assertIn('Restored 3 of 4 archived activities', out.getvalue())
+
+        restored = list(Activity.objects.filter(object_id__in=[102, 103]).order_by('pk').values())
+        self.assertEqual(restored, pruned[:2])
+        self.assertNotEqual(Activity.objects.get(object_id=104).pk, pruned[2]['id'])
+        self.assertEqual(Activity.objects.get(object_id=104).timestamp, pruned[2]['timestamp'])
+        self.assertEqual(rollups.count_since(datetime.date(2000, 1, 1)), 6)
+
+        # Restoring again changes nothing.
+        call_command('restore_activity', self.archive, stdout=StringIO())
+        self.assertEqual(Activity.objects.count(), 6)
+        with self.assertRaises(CommandError):
+            call_command('restore_activity', self.archive + '.missing', stdout=StringIO())
+
+
+@override_settings(ACTIVITY_MONITOR_HOT_MONTHS=1, ACTIVITY_MONITOR_ROLLUPS=True)
+class TestPartitionedStorage(TestCase):
+    fixtures = ['auth_users.json']
+
+    def setUp(self):
+        partitions.clear_boundary()
+        self.user = get_user_model().objects.get(username='testclient')
+        self.content_type = ContentType.objects.get_for_model(Activity)
+        self.today = datetime.date.today()
+        self.old_month = partitions.add_months(self.today, -3)
+        for i, month in enumerate([self.old_month, self.old_month, partitions.add_months(self.today, -14)]):
+            self.create_activity(i, datetime.datetime.combine(month.replace(day=10 + i), datetime.time(12)))
+        self.create_activity(3, datetime.datetime.now())
+
+    def tearDown(self):
+        partitions.clear_boundary()
+
+    def create_activity(self, object_id, timestamp):
+        return Activity.objects.create(
+            actor=self.user, content_type=self.content_type, object_id=object_id, verb='posted',
+            timestamp=timestamp, target='post {}'.format(object_id), absolute_url='/posts/{}/'.format(object_id)
+        )
+
+    def test_archive(self):
+        """
+        Test old months move to the archive, keeping their ids and counts
+        """
+        old = list(Activity.objects.filter(object_id__lt=3).order_by('pk').values())
+        self.assertIsNone(partitions.get_boundary())
+        out = StringIO()
+        call_command('archive_activity', chunk_size=1, stdout=out)
+        self.assertIn('Moved 3 activities', out.getvalue())
+        self.assertEqual(list(Activity.objects.values_list('object_id', flat=True)), [3])
+        self.assertEqual(list(ArchivedActivity.objects.order_by('pk').values()), old)
+        self.assertEqual(
+            partitions.get_boundary(), rollups.get_midnight(partitions.add_months(self.today, -1))
+        )
+        # Every month up to the horizon is recorded, including empty ones.
+        self.assertEqual(ArchivedMonth.objects.count(), 13)
+        self.assertEqual(ArchivedMonth.objects.get(month=self.old_month).count, 2)
+        self.assertEqual(rollups.count_since(datetime.date(2000, 1, 1)), 4)
+
+        # Running it again moves nothing, but sweeps up anything old written since.
+        self.create_activity(4, datetime.datetime.combine(self.old_month, datetime.time(12)))
+        call_command('archive_activity', stdout=StringIO())
+        self.assertEqual(ArchivedMonth.objects.get(month=self.old_month).count, 3)
+        self.assertEqual(Activity.objects.count(), 1)
+
+        with override_settings(ACTIVITY_MONITOR_HOT_MONTHS=None):
+            with self.assertRaises(CommandError):
+                call_command('archive_activity', stdout=StringIO())
+
+    def test_archive_month_atomic(self):
+        """
+        Test a month moves in one transaction, which invalidates cached output when it commits
+        """
+        with mock.patch('django.db.models.query.QuerySet.get_or_create', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                partitions.archive_month(self.old_month, chunk_size=1)
+        self.assertFalse(ArchivedActivity.objects.exists())
+        self.assertEqual(Activity.objects.count(), 4)
+
+        with mock.patch.object(caching, 'invalidate') as invalidate, \
+                mock.patch.object(transaction, 'on_commit') as on_commit:
+            self.assertEqual(partitions.archive_month(self.old_month, chunk_size=1), 2)
+        self.assertEqual(ArchivedActivity.objects.count(), 2)
+        invalidate.assert_called_with('default')
+        on_commit.assert_any_call(partitions.clear_boundary, using='default')
+
+    @override_settings(ACTIVITY_MONITOR_DEFERRED=True)
+    def test_deferred_delete_archived(self):
+        """
+        Test a deferred delete removes the object's activity from the archive too
+        """
+        call_command('archive_activity', stdout=StringIO())
+        self.assertTrue(ArchivedActivity.objects.filter(object_id=0).exists())
+        ActivityOutbox.objects.enqueue(self.content_type, 0, ActivityOutbox.DELETE)
+        self.assertEqual(outbox.drain(), 1)
+        self.assertFalse(ArchivedActivity.objects.filter(object_id=0).exists())
+        self.assertEqual(ArchivedActivity.objects.count(), 2)
+
+    def test_queries_routed(self):
+        """
+        Test periods are read from whichever table holds them
+        """
+        call_command('archive_activity', stdout=StringIO())
+        next_month = partitions.add_months(self.old_month, 1)
+        # The boundary is looked up once, then comes from the cache.
+        partitions.get_boundary()
+        with self.assertNumQueries(1):
+            month = Activity.objects.for_period(self.old_month, next_month)
+            self.assertIs(month.model, ArchivedActivity)
+            self.assertEqual(month.count(), 2)
+        today = Activity.objects.for_period(self.today)
+        self.assertIs(today.model, Activity)
+        self.assertEqual(today.count(), 1)
+        since = Activity.objects.for_period(self.old_month, None)
+        self.assertEqual(since.count(), 3)
+        self.assertEqual([activity.object_id for activity in since.order_by('-timestamp')], [3, 1, 0])
+
+        response = self.client.get(
+            reverse('actions_for_month', args=[self.old_month.year, '{:02d}'.format(self.old_month.month)])
+        )
+        self.assertEqual([group.target for group in response.context['groups']], ['post 1', 'post 0'])
+        response = self.client.get(reverse('actions_for_today'))
+        self.assertEqual([group.target for group in response.context['groups']], ['post 3'])
+
+        # The archive list carries on from the activity table into the archive.
+        response = self.client.get(reverse('action_archive'))
+        self.assertEqual([activity.object_id for activity in response.context['object_list']], [3, 1, 0, 2])
+        paginator = pagination.CursorPaginator(
+            Activity.objects.all(), 2, older=ArchivedActivity.objects.all()
+        )
+        page = paginator.page()
+        self.assertEqual([activity.object_id for activity in page], [3, 1])
+        page = paginator.page(page.next_page_number())
+        self.assertEqual([activity.object_id for activity in page], [0, 2])
+        self.assertFalse(page.has_next())
+        page = paginator.page(page.previous_page_number())
+        self.assertEqual([activity.object_id for activity in page], [3, 1])
+
+    def test_archived_activity_replaced_and_deleted(self):
+        """
+        Test a new activity for an object replaces its archived one, and deleting objects removes both
+        """
+        call_command('archive_activity', stdout=StringIO())
+        Activity.objects.upsert(
+            self.content_type, 0, actor=self.user, timestamp=datetime.datetime.now(), verb='posted',
+            target='post 0'
+        )
+        self.assertFalse(ArchivedActivity.objects.filter(object_id=0).exists())
+        self.assertEqual(Activity.objects.delete_for_objects(self.content_type, [0, 1]), 2)
+        self.assertEqual(list(ArchivedActivity.objects.values_list('object_id', flat=True)), [2])
+        self.assertEqual(rollups.count_since(datetime.date(2000, 1, 1)), 2)
+        self.user.delete()
+        self.assertFalse(ArchivedActivity.objects.exists())
+        self.assertEqual(rollups.count_since(datetime.date(2000, 1, 1)), 0)
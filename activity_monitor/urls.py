@@ -1,5 +1,7 @@
 from django.urls import path, re_path
 
+from .feeds import activity_feed
+from .live import activity_stream
 from .views import action_list, actions_for_period, actions_for_today
 
 urlpatterns = [
@@ -17,4 +19,7 @@ urlpatterns = [
     ),
     path('archive/', action_list, name="action_archive"),
     path('archive/<slug:username>/', action_list, name="action_archive_for_user"),
+    re_path(r"^feed\.(?P<format>ndjson|json|atom)$", activity_feed, name="activity_feed"),
+    path('live/', activity_stream, name="activity_stream"),
+    path('live/poll/', activity_stream, {'format': 'poll'}, name="activity_poll"),
 ]
@@ -2,40 +2,253 @@ import datetime
 
 from collections import OrderedDict
 
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, Max
+
+# Length of the denormalized string columns on Activity.
+MAX_LENGTH = 255
+
+# Actor names kept per group by group_activities_in_db. The grouped templates
+# list everyone when there are fewer than five, so this keeps them working.
+MAX_GROUP_ACTORS = 4
+
+
+class ActivityGroup(object):
+    """
+    A group of activities on the same target, as built by group_activities_in_db():
+
+    content_type_id and target: what the group was keyed on.
+    item: the most recent Activity in the group.
+    actors: up to max_actors distinct actor names, most recent first.
+    actor_total: the number of distinct actors.
+    verb: the item's verb string, to avoid extra lookups
+    last_modified: the time the target was last acted upon.
+    current_item: whether that was within the past day.
+    """
+    __slots__ = (
+        'content_type_id', 'target', 'item', 'actors', 'actor_total',
+        'verb', 'last_modified', 'current_item'
+    )
+
+    def __init__(self, content_type_id, target, actor_total, last_modified, current_item):
+        self.content_type_id = content_type_id
+        self.target = target
+        self.actor_total = actor_total
+        self.last_modified = last_modified
+        self.current_item = current_item
+        self.item = None
+        self.actors = []
+        self.verb = None
+
+    def __repr__(self):
+        return '<ActivityGroup: {} ({} actors)>'.format(self.target, self.actor_total)
+
+    def as_dict(self):
+        """
+        The dict shape group_activities() has always returned.
+        """
+        return {
+            'item': self.item,
+            'actors': self.actors,
+            'actor_count': self.actor_total - 1,
+            'verb': self.verb,
+            'last_modified': self.last_modified,
+            'current_item': self.current_item,
+        }
+
+
+def group_activities_in_db(queryset, max_actors=MAX_GROUP_ACTORS):
+    """
+    Groups a queryset of activities by content type and target in the database,
+    returning a list of ActivityGroups, most recently modified first.
+
+    Activity is unique on (content_type, object_id), so each object only ever has
+    one activity; grouping is on the target string, as it always has been, so that
+    activities on objects that render the same (posts in the same topic, say) are
+    shown together. Including the content type keeps a user and a topic that share
+    a name apart.
+
+    This takes three queries however many activities there are: the aggregates,
+    the actor names for the groups, and the representative activities.
+    Only the latter are loaded as models.
+    """
+    if not queryset.query.can_filter():
+        # A sliced queryset can't be regrouped, so group the activities it holds.
+        depth = getattr(queryset, '_content_object_depth', 0)
+        queryset = queryset.model._default_manager.filter(pk__in=list(queryset.values_list('pk', flat=True)))
+        queryset._content_object_depth = depth
+    return build_groups(queryset, get_group_rows(queryset), max_actors)
+
+
+def get_group_rows(queryset):
+    """
+    Returns a values() queryset with one row of aggregates per group in the queryset,
+    most recently modified first. It can be sliced or paginated like any other,
+    and the rows passed on to build_groups().
+    """
+    return queryset.order_by().values('content_type_id', 'target').annotate(
+        actor_total=Count('actor', distinct=True),
+        last_modified=Max('timestamp'),
+    ).order_by('-last_modified', 'content_type_id', 'target')
+
+
+def build_groups(queryset, rows, max_actors=MAX_GROUP_ACTORS):
+    """
+    Turns aggregate rows from get_group_rows() into ActivityGroups, fetching
+    the latest activity and actor names for just those groups.
+    """
+    current = datetime.datetime.now() - datetime.timedelta(days=1)
+    groups = OrderedDict(
+        ((row['content_type_id'], row['target']), ActivityGroup(
+            row['content_type_id'],
+            row['target'],
+            row['actor_total'],
+            row['last_modified'],
+            # current is defined as within the past day.
+            row['last_modified'] >= current,
+        ))
+        for row in rows
+    )
+    if not groups:
+        return []
+
+    # Walk the groups' activities newest first, for each group's latest activity and actors.
+    latest = {}
+    members = queryset.filter(
+        content_type_id__in=set(key[0] for key in groups),
+        target__in=set(key[1] for key in groups),
+    ).order_by('-timestamp', '-pk').values_list('pk', 'content_type_id', 'target', 'actor_name')
+    for pk, content_type_id, target, actor_name in members:
+        group = groups.get((content_type_id, target))
+        if group is None:
+            continue
+        if group.item is None:
+            latest[pk] = group
+            group.item = pk
+        if len(group.actors) < max_actors and actor_name not in group.actors:
+            group.actors.append(actor_name)
+
+    items = queryset.model._default_manager.in_bulk(list(latest))
+    depth = getattr(queryset, '_content_object_depth', 0)
+    if depth:
+        from activity_monitor.managers import prefetch_generic
+        objects = prefetch_generic(items.values())
+        if depth > 1:
+            prefetch_generic(objects)
+    for pk, group in latest.items():
+        group.item = items.get(pk)
+        if group.item is not None:
+            group.verb = group.item.override_string if group.item.override_string else group.item.verb
+    return list(groups.values())
+
+
+def groups_as_dict(groups):
+    """
+    Returns ActivityGroups in the OrderedDict shape described in group_activities(),
+    keyed by target.
+    """
+    actions = OrderedDict()
+    for group in groups:
+        key = group.target
+        if key in actions:
+            # The same target on a different content type.
+            key = '{} ({})'.format(group.target, ContentType.objects.get_for_id(group.content_type_id).model)
+        actions[key] = group.as_dict()
+    return actions
+
 
 def group_activities(queryset):
     """
     Given a queryset of activity objects, will group them by actors and return an OrderedDict including:
 
     item: The original target item being acted upon (activity.content_object)
-    actors: a list of all actors who have acted upon the target.
+    actors: a list of the actors who have acted upon the target.
     actor_count: zero-indexed count of actors. Useful for "Joe and {{ actor_count }} others have..."
     verb: the item's verb string, to avoid extra lookups
     last_modified: the time the target was last acted upon.
 
     The string version of the target is also available as the dict key.
+
+    The grouping itself is done in the database by group_activities_in_db();
+    this keeps the dict shape the templates expect.
     """
-    actions = OrderedDict()
-    for item in queryset:
-        # current is defined as within the past day.
-        if item.timestamp >= datetime.datetime.now() - datetime.timedelta(days=1):
-            current_item = True
-        else:
-            current_item = False
-        if item.target not in actions.keys():
-            actions[item.target] = {
-                'item': item,
-                'actors': [item.actor_name],
-                'actor_count': 0,
-                'verb': item.override_string if item.override_string else item.verb,
-                'last_modified': item.timestamp,
-                'current_item': current_item
-            }
-        else: # item was previously added, but we need to update attributes
-            if item.actor_name not in actions[item.target]['actors']:
-                actions[item.target]['actors'].append(item.actor_name)
-                actions[item.target]['actor_count'] += 1
-            if actions[item.target]['last_modified'] < item.timestamp:
-                actions[item.target]['last_modified'] = item.timestamp
+    return groups_as_dict(group_activities_in_db(queryset))
 
-    return actions
+
+def get_absolute_url(obj):
+    """
+    Returns obj.get_absolute_url(), or None if it doesn't have one (or it fails),
+    for storing on the activity.
+    """
+    try:
+        url = obj.get_absolute_url()
+    except Exception:
+        return None
+    if not url or len(url) > MAX_LENGTH:
+        return None
+    return url
+
+
+def get_image(obj):
+    """
+    Attempts to provide a representative image from obj based on its get_image() method,
+    following to obj.content_object if needed, then falling back to obj.image.
+    See Activity.image.
+    """
+    # First, try to get from a get_image() helper method
+    try:
+        image = obj.get_image()
+    except AttributeError:
+        try:
+            image = obj.content_object.get_image()
+        except:
+            image = None
+
+    # if we didn't find one, try to get it from foo.image
+    # This allows get_image to take precedence for greater control.
+    if not image:
+        try:
+            image = obj.image
+        except AttributeError:
+            try:
+                image = obj.content_object.image
+            except:
+                return None
+
+    # Finally, ensure we're getting an image, not an image object
+    # with caption and byline and other things.
+    try:
+        return image.image
+    except AttributeError:
+        return image
+
+
+def get_image_url(obj):
+    """
+    Returns the URL of obj's representative image, or None, for storing on the activity.
+    """
+    image = get_image(obj)
+    if not image:
+        return None
+    try:
+        url = image.url
+    except Exception:
+        # Not a file, so hopefully already a path or URL.
+        url = image if isinstance(image, str) else None
+    if not url or len(url) > MAX_LENGTH:
+        return None
+    return url
+
+
+def get_actor_id(username):
+    """
+    Returns the pk of the user with the given username, or None,
+    so activities can be filtered on the indexed actor column.
+    Usernames are unique and indexed, so this is a single cheap lookup.
+    It isn't cached: users can be renamed, or deleted and their username reused.
+    """
+    UserModel = get_user_model()
+    return UserModel._default_manager.filter(
+        **{UserModel.USERNAME_FIELD: username}
+    ).values_list('pk', flat=True).first()
@@ -5,15 +5,38 @@ The origins are hazy at this point.
 """
 import calendar
 import datetime
+import functools
+import hashlib
+import logging
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.http import Http404
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.functional import cached_property
+from django.utils.http import quote_etag
 from django.views.generic import ListView
 
-from .models import Activity
-from .utils import group_activities
+from . import caching, partitions, rollups
+from .models import Activity, ArchivedActivity
+from .pagination import CursorPaginator, InvalidCursor
+from .utils import build_groups, get_actor_id, get_group_rows, groups_as_dict
 
 UserModel = get_user_model()
 
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def warn_unshared_cache():
+    """
+    Logs, once per process, why the views aren't answering conditional requests.
+    """
+    logger.warning(
+        "The activity views send no ETags: ACTIVITY_MONITOR_CACHE is a local-memory or dummy cache, "
+        "which can't tell other processes when activities change. Point it at a shared cache to enable them."
+    )
+
 
 class ActionList(ListView):
     """
@@ -24,20 +47,117 @@ class ActionList(ListView):
     template_name = "activity_monitor/activity_list.html"
     paginate_by = 100
     allow_empty = True
+    # Page with ?cursor= tokens on (timestamp, id) rather than OFFSET page numbers.
+    cursor_paginate = True
+    cursor_kwarg = 'cursor'
 
     def get_queryset(self, *args, **kwargs):
-        qs = super(ActionList, self).get_queryset(*args, **kwargs).order_by('-timestamp').select_related('actor')
-        if 'user' in kwargs:
-            qs = qs.filter(actor_name=kwargs['user'])
+        # Activities carry their own URL and display strings, so the list needs no joins.
+        qs = super(ActionList, self).get_queryset(*args, **kwargs).order_by('-timestamp')
+        return self.filter_actor(qs)
+
+    @cached_property
+    def actor_id(self):
+        # Looked up once per request, for both the ETag and the list.
+        return get_actor_id(self.kwargs['username'])
+
+    def filter_actor(self, qs):
+        if 'username' in self.kwargs:
+            # Filter on the indexed actor, rather than the free-text actor_name.
+            if self.actor_id is None:
+                return qs.none()
+            qs = qs.filter(actor_id=self.actor_id)
         return qs
+
+    def get(self, request, *args, **kwargs):
+        """
+        Answers conditional requests from the ETag alone,
+        without evaluating the list itself.
+
+        There's no Last-Modified: activities carry the time things happened,
+        not the time they were written, so an activity upserted with an older
+        timestamp wouldn't move it.
+        """
+        etag = self.get_etag()
+        response = None
+        if etag is not None:
+            response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = super(ActionList, self).get(request, *args, **kwargs)
+        if etag is not None:
+            response['ETag'] = etag
+        # The page may show the logged-in user, so shared caches keep a copy per session.
+        patch_vary_headers(response, ('Cookie',))
+        if self.is_final():
+            cache_control = {'max_age': getattr(settings, 'ACTIVITY_MONITOR_ARCHIVE_MAX_AGE', 2592000)}
+            if getattr(settings, 'ACTIVITY_MONITOR_ARCHIVE_PUBLIC', False):
+                cache_control['public'] = True
+            else:
+                cache_control['private'] = True
+            patch_cache_control(response, **cache_control)
+        return response
+
+    def get_etag(self):
+        """
+        Returns the ETag for the list, from its newest activity (a single row
+        off an index) and the activity generation, which catches everything
+        else, such as deletions and rewritten activities.
+
+        Returns None, so there are no conditional responses, if the cache the
+        generation lives in isn't shared: other processes would never see it bumped.
+        """
+        if not caching.is_shared():
+            warn_unshared_cache()
+            return None
+        queryset = self.get_queryset()
+        newest = queryset.order_by('-timestamp', '-pk').values_list('timestamp', 'pk').first()
+        digest = hashlib.md5(repr(
+            (self.request.get_full_path(), newest, self.get_extra_validator(queryset), caching.get_generation())
+        ).encode('utf-8')).hexdigest()
+        return quote_etag(digest)
+
+    def get_extra_validator(self, queryset):
+        """
+        Anything else the list's ETag should change with.
+        """
+        return None
+
+    def is_final(self):
+        """
+        True if the list can't change any more, so may be cached for a long time.
+        """
+        return False
+
+    def get_context_data(self, **kwargs):
+        context = super(ActionList, self).get_context_data(**kwargs)
+        context['timeline_for'] = self.kwargs.get('username')
+        return context
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.cursor_paginate:
+            return super(ActionList, self).paginate_queryset(queryset, page_size)
+        older = None
+        boundary = partitions.get_boundary()
+        if boundary is not None and queryset.model is Activity:
+            # Past the activity table, the list carries on into the archive.
+            queryset = queryset.filter(timestamp__gte=boundary)
+            older = self.filter_actor(ArchivedActivity.objects.filter(timestamp__lt=boundary))
+        paginator = CursorPaginator(queryset, page_size, older=older)
+        try:
+            page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+        except InvalidCursor:
+            raise Http404("Invalid cursor.")
+        return (paginator, page, page.object_list, page.has_other_pages())
 action_list = ActionList.as_view()
 
 
 class ActionsForPeriod(ActionList):
     previous = None
     template_name = "activity_monitor/grouped.html"
+    cursor_paginate = False
     next = None
     previous = None
+    groups = ()
 
     def dispatch(self, request, *args, **kwargs):
         self.day   = int(kwargs['day']) if 'day' in kwargs else None
@@ -47,32 +167,70 @@ class ActionsForPeriod(ActionList):
         self.current_day = datetime.date.today()
         return super(ActionsForPeriod, self).dispatch(request, *args, **kwargs)
 
-    def get_queryset(self, *args, **kwargs):
-        qs = super(ActionsForPeriod, self).get_queryset(*args, **kwargs).order_by('-timestamp').select_related('actor')
-
+    def get_period(self):
+        """
+        Returns the (start, end) of the period shown. end may be None.
+        """
         if self.day: # Get actions for a particular day
-            qs = qs.filter(timestamp__year=self.year, timestamp__month=self.month, timestamp__day=self.day)
             self.current_day = datetime.date(self.year, self.month, self.day)
-            self.previous = self.current_day - datetime.timedelta(days=1)
-            if self.current_day == datetime.date.today():
-                self.next = None
-            else:
-                self.next = self.current_day + datetime.timedelta(days=1)
-        else:
-            # Get actions for a particular month
-            start_date = datetime.date(self.year, self.month, 1)
-            end_date   = datetime.date(self.year, self.month, calendar.monthrange(self.year, self.month)[1])
-            qs = qs.filter(timestamp__gte=start_date, timestamp__lte=end_date)
-        return qs
+            return self.current_day, self.current_day + datetime.timedelta(days=1)
+        # Get actions for a particular month
+        start_date = datetime.date(self.year, self.month, 1)
+        end_date   = start_date + datetime.timedelta(days=calendar.monthrange(self.year, self.month)[1])
+        return start_date, end_date
+
+    def get_queryset(self, *args, **kwargs):
+        # Filter on plain timestamp ranges, which can use the timestamp index,
+        # in the archive if the period has been moved there.
+        start, end = self.get_period()
+        return self.filter_actor(Activity.objects.for_period(start, end)).order_by('-timestamp')
 
+    def is_final(self):
+        """
+        Days and months that are over are final.
+        """
+        today = datetime.date.today()
+        if self.day:
+            return datetime.date(self.year, self.month, self.day) < today
+        return (self.year, self.month) < (today.year, today.month)
+
+    def get_day_counts(self):
+        """
+        Returns {date: count} for the days of the month with any activity, from the rollups.
+        """
+        if self.day or not rollups.enabled():
+            return None
+        start_date = datetime.date(self.year, self.month, 1)
+        end_date = start_date + datetime.timedelta(days=calendar.monthrange(self.year, self.month)[1])
+        return rollups.get_day_counts(start_date, end_date)
+
+    def paginate_queryset(self, queryset, page_size):
+        """
+        Paginates over groups of activities, rather than rows, so the period's queryset
+        is only evaluated once, as aggregates, and only the groups on the page get built.
+        """
+        paginator, page, rows, is_paginated = super(ActionsForPeriod, self).paginate_queryset(
+            get_group_rows(queryset), page_size
+        )
+        self.groups = build_groups(queryset, rows)
+        return paginator, page, [group.item for group in self.groups], is_paginated
 
     def get_context_data(self, **kwargs):
         context = super(ActionsForPeriod, self).get_context_data(**kwargs)
+        if self.day:
+            # The nearest days that have any activity, from the rollups.
+            self.previous, self.next = rollups.get_adjacent_days(self.current_day)
         context['previous_day'] = self.previous
         context['next_day'] = self.next
 
-        # the QS is used for pagination, so let's reorganize and group them here
-        context['actions'] = group_activities(self.get_queryset())
+        # the groups on this page, in the dict shape the templates expect
+        context['groups'] = self.groups
+        context['actions'] = groups_as_dict(self.groups)
+        # a calendar of the month's busy days, and the month's total
+        day_counts = self.get_day_counts()
+        if day_counts is not None:
+            context['day_counts'] = day_counts
+            context['activity_count'] = sum(day_counts.values())
         if self.day:
             context['current_date_string'] = self.current_day.strftime('%B %d %Y')
         else:
@@ -83,17 +241,18 @@ actions_for_period = ActionsForPeriod.as_view()
 
 
 class ActionsForToday(ActionsForPeriod):
-    def get_queryset(self, *args, **kwargs):
-        today = datetime.datetime.now() - datetime.timedelta(hours = 24)
-        qs = super(ActionsForToday, self).get_queryset(*args, **kwargs)
-        qs = qs.filter(timestamp__gte=today)
-        return qs
+    def get_period(self):
+        # The past 24 hours can span two months, so skip the month filter.
+        return datetime.datetime.now() - datetime.timedelta(hours = 24), None
 
-    def get_context_data(self, **kwargs):
-        context = super(ActionsForToday, self).get_context_data(**kwargs)
+    def is_final(self):
+        return False
 
-        # the QS is used for pagination, so let's reorganize and group them here
-        context['actions'] = group_activities(self.get_queryset())
-        return context
+    def get_extra_validator(self, queryset):
+        # Activities drop out of the last 24 hours without anything being written.
+        return queryset.order_by('timestamp', 'pk').values_list('timestamp', 'pk').first()
+
+    def get_day_counts(self):
+        return None
 actions_for_today = ActionsForToday.as_view()
 
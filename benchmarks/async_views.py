@@ -0,0 +1,121 @@
+"""
+Compares concurrent-request throughput of the async archive view against the
+sync view run the way an ASGI server runs sync views: every request handed to
+the one shared thread with sync_to_async(thread_sensitive=True).
+
+Django 2.2 has no ASGI handler of its own, so rather than going through
+uvicorn, requests are driven straight at both views from one event loop,
+concurrency at a time. The database is a SQLite file, so every worker thread
+sees the same data. SQLite answers in microseconds and the rest of a request
+holds the GIL, so --latency adds a sleep (in milliseconds) to every query, as a
+database across the network would.
+
+Run from the repository root:
+
+    python benchmarks/async_views.py [--latency=ms] [requests] [concurrency ...]
+"""
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'activity.sqlite3')
+settings.DATABASES['default']['NAME'] = DB_FILE
+
+django.setup()
+
+from asgiref.sync import sync_to_async  # noqa: E402
+
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.contrib.contenttypes.models import ContentType  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db import close_old_connections  # noqa: E402
+from django.db.backends.signals import connection_created  # noqa: E402
+from django.test import RequestFactory, override_settings  # noqa: E402
+
+from activity_monitor import async_views  # noqa: E402
+from activity_monitor.models import Activity  # noqa: E402
+from activity_monitor.views import action_list  # noqa: E402
+
+
+def populate(rows):
+    get_user_model().objects.bulk_create([
+        get_user_model()(username='user{}'.format(i)) for i in range(50)
+    ])
+    users = list(get_user_model().objects.all())
+    content_type = ContentType.objects.get_for_model(Activity)
+    start = datetime.datetime(2014, 1, 1)
+    Activity.objects.bulk_create([
+        Activity(
+            actor_id=users[i % len(users)].pk, actor_name=users[i % len(users)].username,
+            content_type=content_type, object_id=i, verb='posted in', target='topic {}'.format(i // 10),
+            timestamp=start + datetime.timedelta(minutes=i), absolute_url='/topics/{}/'.format(i // 10),
+        )
+        for i in range(rows)
+    ], batch_size=400)
+
+
+def add_latency(seconds):
+    def wait(execute, sql, params, many, context):
+        time.sleep(seconds)
+        return execute(sql, params, many, context)
+
+    def on_connect(sender, connection, **kwargs):
+        # The wrapper outlives the connection it was added on.
+        if wait not in connection.execute_wrappers:
+            connection.execute_wrappers.append(wait)
+    connection_created.connect(on_connect, weak=False)
+
+
+def sync_view(request):
+    close_old_connections()
+    try:
+        return action_list(request).render()
+    finally:
+        close_old_connections()
+shared_thread_view = sync_to_async(sync_view, thread_sensitive=True)
+
+
+async def drive(view, requests, concurrency):
+    factory = RequestFactory()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            response = await view(factory.get('/archive/', {'n': i}))
+            assert response.status_code == 200
+
+    start = time.time()
+    await asyncio.gather(*[one(i) for i in range(requests)])
+    return time.time() - start
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+def run(requests, concurrencies, latency=0):
+    call_command('migrate', verbosity=0)
+    populate(5000)
+    if latency:
+        add_latency(latency / 1000.0)
+    print("{} requests for the archive view on {}, {}ms added per query".format(
+        requests, settings.DATABASES['default']['ENGINE'], latency
+    ))
+    for concurrency in concurrencies:
+        for name, view in (('sync', shared_thread_view), ('async', async_views.action_list)):
+            elapsed = asyncio.run(drive(view, requests, concurrency))
+            print("{:5s} x{:<4d} {:7.2f}s  {:8.1f} req/sec".format(name, concurrency, elapsed, requests / elapsed))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    latency = 0
+    if args and args[0].startswith('--latency='):
+        latency = float(args.pop(0).split('=', 1)[1])
+    run(int(args[0]) if args else 200, [int(arg) for arg in args[1:]] or [1, 10, 50], latency)
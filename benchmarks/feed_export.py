@@ -0,0 +1,81 @@
+"""
+Streams the NDJSON feed over growing tables and reports time and peak Python memory,
+which should stay flat however many activities are exported.
+
+Run from the repository root:
+
+    python benchmarks/feed_export.py [rows ...]
+"""
+import datetime
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.contrib.contenttypes.models import ContentType  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.test import RequestFactory, override_settings  # noqa: E402
+
+from activity_monitor.feeds import activity_feed  # noqa: E402
+from activity_monitor.models import Activity  # noqa: E402
+
+
+def populate(rows):
+    """
+    Tops the table up to rows activities.
+    """
+    users = list(get_user_model().objects.all())
+    content_type = ContentType.objects.get_for_model(Activity)
+    start = datetime.datetime(2014, 1, 1)
+    batch = []
+    for i in range(Activity.objects.count(), rows):
+        user = users[i % len(users)]
+        batch.append(Activity(
+            actor_id=user.pk, actor_name=user.username, content_type=content_type, object_id=i,
+            timestamp=start + datetime.timedelta(seconds=i), target='topic {}'.format(i // 10),
+            verb='posted in', absolute_url='/topics/{}/'.format(i // 10),
+        ))
+        if len(batch) == 10000:
+            Activity.objects.bulk_create(batch)
+            batch = []
+    Activity.objects.bulk_create(batch)
+
+
+def measure(rows):
+    request = RequestFactory().get('/feed.ndjson')
+    tracemalloc.start()
+    start = time.time()
+    exported = size = 0
+    for line in activity_feed(request, format='ndjson').streaming_content:
+        exported += 1
+        size += len(line)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("{:9d} rows  {:7.1f} MB out  {:7.2f}s  {:9.0f} rows/sec  peak {:6.1f} MB".format(
+        exported, size / 1024.0 / 1024.0, elapsed, exported / elapsed if elapsed else exported,
+        peak / 1024.0 / 1024.0
+    ))
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+def run(sizes):
+    call_command('migrate', verbosity=0)
+    get_user_model().objects.bulk_create([
+        get_user_model()(username='user{}'.format(i)) for i in range(50)
+    ])
+    for rows in sizes:
+        populate(rows)
+        measure(rows)
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000])
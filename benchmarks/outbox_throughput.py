@@ -0,0 +1,60 @@
+"""
+Compares write throughput of the synchronous post_save handler against
+deferred mode (ACTIVITY_MONITOR_DEFERRED) plus draining the outbox.
+
+Run from the repository root:
+
+    python benchmarks/outbox_throughput.py [count]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+
+from activity_monitor import outbox  # noqa: E402
+from activity_monitor.apps import register_app_activity  # noqa: E402
+from activity_monitor.models import Activity  # noqa: E402
+
+
+def create_users(prefix, count):
+    User = get_user_model()
+    for i in range(count):
+        User.objects.create(username='{}{}'.format(prefix, i))
+
+
+def run(count):
+    call_command('migrate', verbosity=0)
+    register_app_activity()
+
+    start = time.time()
+    create_users('sync', count)
+    sync = time.time() - start
+
+    with override_settings(ACTIVITY_MONITOR_DEFERRED=True):
+        start = time.time()
+        create_users('deferred', count)
+        deferred = time.time() - start
+        start = time.time()
+        outbox.drain()
+        drained = time.time() - start
+
+    assert Activity.objects.count() == count * 2
+    print("{} saves on {}".format(count, settings.DATABASES['default']['ENGINE']))
+    print("sync:      {:.2f}s  {:8.0f} saves/sec".format(sync, count / sync))
+    print("deferred:  {:.2f}s  {:8.0f} saves/sec (request path)".format(deferred, count / deferred))
+    print("drain:     {:.2f}s  {:8.0f} rows/sec".format(drained, count / drained))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
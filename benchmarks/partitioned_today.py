@@ -0,0 +1,109 @@
+"""
+Times the today view against a table holding years of activity, then again
+after archive_activity has moved everything but the last month to the archive.
+
+The activities are spread evenly over the past three years, plus a day's worth
+in the last 24 hours. The database is a SQLite file, so the table is read from
+pages rather than living in memory. Rows are inserted with executemany, so
+there are no rollups, which the today view doesn't use.
+
+Run from the repository root (10,000,000 rows takes a while to insert):
+
+    python benchmarks/partitioned_today.py [rows] [requests]
+"""
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'activity.sqlite3')
+settings.DATABASES['default']['NAME'] = DB_FILE
+
+django.setup()
+
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.contrib.contenttypes.models import ContentType  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db import connection, transaction  # noqa: E402
+from django.test import RequestFactory, override_settings  # noqa: E402
+
+from activity_monitor import partitions  # noqa: E402
+from activity_monitor.models import Activity, ArchivedActivity  # noqa: E402
+from activity_monitor.views import actions_for_today  # noqa: E402
+
+TODAY_ROWS = 2000
+
+
+def populate(rows):
+    call_command('migrate', verbosity=0)
+    get_user_model().objects.bulk_create([
+        get_user_model()(username='user{}'.format(i)) for i in range(50)
+    ])
+    user_ids = list(get_user_model().objects.values_list('pk', flat=True))
+    content_type = ContentType.objects.get_for_model(Activity)
+    now = datetime.datetime.now()
+    start = now - datetime.timedelta(days=3 * 365)
+    step = (now - datetime.timedelta(days=1) - start) / (rows - TODAY_ROWS)
+    recent = datetime.timedelta(days=1) / TODAY_ROWS
+
+    def timestamp(i):
+        if i < rows - TODAY_ROWS:
+            return start + step * i
+        return now - recent * (rows - i)
+
+    sql = (
+        'INSERT INTO activity_monitor_activity (actor_id, actor_name, content_type_id, object_id, '
+        'timestamp, verb, target, absolute_url) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)'
+    )
+    with transaction.atomic(), connection.cursor() as cursor:
+        for low in range(0, rows, 100000):
+            cursor.executemany(sql, [
+                (
+                    user_ids[i % len(user_ids)], 'user{}'.format(i % len(user_ids)), content_type.pk, i,
+                    connection.ops.adapt_datetimefield_value(timestamp(i)), 'posted in',
+                    'topic {}'.format(i // 10), '/topics/{}/'.format(i // 10),
+                )
+                for i in range(low, min(low + 100000, rows))
+            ])
+
+
+def measure(label, requests):
+    request = RequestFactory().get('/')
+    actions_for_today(request).render()
+    timings = []
+    for i in range(requests):
+        start = time.time()
+        actions_for_today(request).render()
+        timings.append(time.time() - start)
+    timings.sort()
+    print("{:10} {:8d} rows in the activity table  median {:7.2f}ms  p90 {:7.2f}ms".format(
+        label, Activity.objects.count(), timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.9)] * 1000
+    ))
+
+
+def run(rows, requests):
+    print("Populating {} activities...".format(rows))
+    populate(rows)
+    connection.cursor().execute('ANALYZE')
+    with override_settings(ACTIVITY_MONITOR_HOT_MONTHS=1):
+        measure('unarchived', requests)
+        start = time.time()
+        moved = sum(moved for month, moved in partitions.archive(chunk_size=10000))
+        print("Archived {} activities in {:.1f}s".format(moved, time.time() - start))
+        connection.cursor().execute('ANALYZE')
+        measure('archived', requests)
+    assert Activity.objects.count() + ArchivedActivity.objects.count() == rows
+
+
+if __name__ == '__main__':
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1000000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 50,
+    )
@@ -0,0 +1,110 @@
+"""
+Measures the month view over a large month: queries, peak Python memory and time.
+
+The previous implementation (evaluating the month's queryset for pagination,
+again for grouping, and grouping every row in Python) is reproduced inline for
+comparison with the current page-aware, database-grouped view.
+
+Run from the repository root:
+
+    python benchmarks/period_views.py [rows]
+"""
+import datetime
+import os
+import sys
+import time
+import tracemalloc
+
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.contrib.contenttypes.models import ContentType  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+
+from activity_monitor.models import Activity  # noqa: E402
+from activity_monitor.views import actions_for_period  # noqa: E402
+
+YEAR, MONTH = 2014, 12
+
+
+def populate(rows):
+    call_command('migrate', verbosity=0)
+    get_user_model().objects.bulk_create([
+        get_user_model()(username='user{}'.format(i)) for i in range(50)
+    ])
+    users = list(get_user_model().objects.all())
+    content_type = ContentType.objects.get_for_model(Activity)
+    start = datetime.datetime(YEAR, MONTH, 1)
+    step = datetime.timedelta(days=31) / rows
+    batch = []
+    for i in range(rows):
+        user = users[i % len(users)]
+        batch.append(Activity(
+            actor_id=user.pk, actor_name=user.username, content_type=content_type, object_id=i,
+            timestamp=start + step * i, target='topic {}'.format(i // 10), verb='posted in',
+            absolute_url='/topics/{}/'.format(i // 10),
+        ))
+        if len(batch) == 10000:
+            Activity.objects.bulk_create(batch)
+            batch = []
+    Activity.objects.bulk_create(batch)
+
+
+def legacy_month(queryset):
+    """
+    What ActionsForPeriod used to do: a page of rows, then every row again for grouping.
+    """
+    page = list(queryset[:100])
+    actions = OrderedDict()
+    for item in queryset:
+        current_item = item.timestamp >= datetime.datetime.now() - datetime.timedelta(days=1)
+        if item.target not in actions.keys():
+            actions[item.target] = {
+                'item': item, 'actors': [item.actor_name], 'actor_count': 0,
+                'verb': item.verb, 'last_modified': item.timestamp, 'current_item': current_item,
+            }
+        else:
+            if item.actor_name not in actions[item.target]['actors']:
+                actions[item.target]['actors'].append(item.actor_name)
+                actions[item.target]['actor_count'] += 1
+    return page, actions
+
+
+def measure(label, func):
+    tracemalloc.start()
+    start = time.time()
+    with CaptureQueriesContext(connection) as queries:
+        func()
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("{:8} {:3d} queries  {:7.2f}s  peak {:8.1f} MB".format(
+        label, len(queries), elapsed, peak / 1024.0 / 1024.0
+    ))
+
+
+def run(rows):
+    populate(rows)
+    start = datetime.date(YEAR, MONTH, 1)
+    queryset = Activity.objects.filter(
+        timestamp__gte=start, timestamp__lt=datetime.date(YEAR + 1, 1, 1)
+    ).order_by('-timestamp')
+    request = RequestFactory().get('/{}/{}/'.format(YEAR, MONTH))
+
+    print("Month view over {} activities".format(rows))
+    measure('legacy', lambda: legacy_month(queryset))
+    measure('current', lambda: actions_for_period(request, year=str(YEAR), month=str(MONTH)).render())
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 500000)
@@ -0,0 +1,61 @@
+"""
+Registers objects created with bulk_create(), which sends no signals, with
+Activity.objects.register_bulk(), against running the post_save handler for
+each object as a save would.
+
+The per-object path is timed over a sample and extrapolated.
+
+Run from the repository root:
+
+    python benchmarks/register_bulk.py [objects] [sample]
+"""
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+
+from activity_monitor.models import Activity  # noqa: E402
+from activity_monitor.signals import create_or_update  # noqa: E402
+
+
+def run(count, sample):
+    call_command('migrate', verbosity=0)
+    User = get_user_model()
+    now = datetime.datetime.now()
+    User.objects.bulk_create(
+        [User(username='user{}'.format(i), date_joined=now) for i in range(count)], batch_size=500
+    )
+    print("{} objects on {}".format(count, settings.DATABASES['default']['ENGINE']))
+
+    start = time.time()
+    for user in User.objects.order_by('pk')[:sample]:
+        create_or_update(User, instance=user, created=True)
+    per_object = (time.time() - start) / sample
+    print("post_save:      {:7.2f}s  {:8.0f} objects/sec (est. from {})".format(
+        per_object * count, 1 / per_object, sample
+    ))
+    Activity.objects.all().delete()
+
+    start = time.time()
+    written, removed = Activity.objects.register_bulk(User.objects.all())
+    elapsed = time.time() - start
+    assert written == count and Activity.objects.count() == count
+    print("register_bulk:  {:7.2f}s  {:8.0f} objects/sec".format(elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 2000,
+    )
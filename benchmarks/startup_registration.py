@@ -0,0 +1,85 @@
+"""
+Times registering 50 watched models at startup, with the current app-registry
+lookups against the previous ContentType query per model, reproduced inline.
+
+The current registration runs first, before the database has any tables, to
+show it doesn't need one.
+
+Run from the repository root:
+
+    python benchmarks/startup_registration.py [models]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.contrib.contenttypes.models import ContentType  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db import connection, models  # noqa: E402
+from django.test.utils import CaptureQueriesContext, override_settings  # noqa: E402
+
+from activity_monitor import registry  # noqa: E402
+from activity_monitor.apps import register_app_activity  # noqa: E402
+from activity_monitor.models import Activity  # noqa: E402
+
+
+def make_models(count):
+    """
+    Defines count watched models, each with a date and a user field.
+    """
+    entries = []
+    for i in range(count):
+        name = 'Watched{}'.format(i)
+        type(name, (models.Model,), {
+            '__module__': __name__,
+            'created': models.DateTimeField(),
+            'user': models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+'),
+            'Meta': type('Meta', (), {'app_label': 'activity_monitor'}),
+        })
+        entries.append({'model': 'activity_monitor.{}'.format(name.lower()), 'verb': 'posted'})
+    return tuple(entries)
+
+
+def register_with_queries():
+    """
+    The previous registration: a content type query for every watched model.
+    """
+    for item in settings.ACTIVITY_MONITOR_MODELS:
+        try:
+            app_label, model = item['model'].split('.', 1)
+            content_type = ContentType.objects.get(app_label=app_label, model=model)
+            model = content_type.model_class()
+            registry.register(model, item)
+            Activity.objects.follow_model(model)
+        except ContentType.DoesNotExist:
+            pass
+    Activity.objects.follow_actors()
+
+
+def measure(name, func):
+    with CaptureQueriesContext(connection) as queries:
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+    print("{:9s} {:8.2f}ms  {:3d} queries".format(name, elapsed * 1000, len(queries.captured_queries)))
+
+
+def run(count):
+    with override_settings(ACTIVITY_MONITOR_MODELS=make_models(count)):
+        print("Registering {} watched models".format(count))
+        measure('current', register_app_activity)
+        call_command('migrate', verbosity=0)
+        measure('previous', register_with_queries)
+        measure('current', register_app_activity)
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -17,4 +17,8 @@ setup(
     packages=find_packages(),
     zip_safe=False,
     include_package_data=True,
+    extras_require={
+        # The async views and manager helpers.
+        'async': ['asgiref>=3.2'],
+    },
 )